@@ -227,12 +227,7 @@ class FourDs(_m.Tool()):
 
         mgra_nodes = nodes[nodes.MGRA > 0][['MGRA','XCOORD','YCOORD']]
         mgra_nodes.columns = ['mgra','x','y']
-        int_dict = {}
-        for int in intersections.iterrows():
-            mgra_nodes['dist'] = np.sqrt((int[1][1] - mgra_nodes['x'])**2+(int[1][2] - mgra_nodes['y'])**2)
-            int_dict[int[1][0]] = mgra_nodes.loc[mgra_nodes['dist'] == mgra_nodes['dist'].min()]['mgra'].values[0]
-
-        intersections['near_mgra'] = intersections['N'].map(int_dict)
+        intersections['near_mgra'] = gen_utils.nearest_mgra(intersections['X'], intersections['Y'], mgra_nodes)
         intersections = intersections.groupby('near_mgra', as_index = False).count()[['near_mgra','N']].rename(columns = {'near_mgra':'mgra','N':'icnt'})
         try:
             self.mgra_data = self.mgra_data.drop('icnt',axis = 1).merge(intersections, how = 'outer', on = "mgra")
@@ -261,34 +256,12 @@ class FourDs(_m.Tool()):
         equiv_min['dist'] = equiv_min['actual']/60*3
         print("MGRA input landuse: " + self.mgradata_file)
 
-        def density_function(mgra_in):
-            eqmn = equiv_min[equiv_min['i'] == mgra_in]
-            mgra_circa_int = eqmn[eqmn['dist'] < self.int_radius]['j'].unique()
-            mgra_circa_oth = eqmn[eqmn['dist'] < self.oth_radius]['j'].unique()
-            totEmp = mgra_landuse[mgra_landuse.mgra.isin(mgra_circa_oth)]['emp_total'].sum()
-            totRet = mgra_landuse[mgra_landuse.mgra.isin(mgra_circa_oth)]['emp_retail'].sum() + mgra_landuse[mgra_landuse.mgra.isin(mgra_circa_oth)]['emp_personal_svcs_retail'].sum() + mgra_landuse[mgra_landuse.mgra.isin(mgra_circa_oth)]['emp_restaurant_bar'].sum()
-            totHH = mgra_landuse[mgra_landuse.mgra.isin(mgra_circa_oth)]['hh'].sum()
-            totPop = mgra_landuse[mgra_landuse.mgra.isin(mgra_circa_oth)]['persons'].sum()
-            totAcres = mgra_landuse[mgra_landuse.mgra.isin(mgra_circa_oth)]['land_acres'].sum()
-            totInt = mgra_landuse[mgra_landuse.mgra.isin(mgra_circa_int)]['icnt'].sum()
-            if(totAcres>0):
-                empDen = totEmp/totAcres
-                retDen = totRet/totAcres
-                duDen = totHH/totAcres
-                popDen = totPop/totAcres
-                popEmpDenPerMi = (totEmp+totPop)/(totAcres/640) #Acres to miles
-                tot_icnt = totInt
-            else:
-                empDen = 0
-                retDen = 0
-                duDen = 0
-                popDen = 0
-                popEmpDenPerMi = 0
-                tot_icnt = 0
-            return tot_icnt,duDen,empDen,popDen,retDen,popEmpDenPerMi
-
+        densities = gen_utils.buffer_densities(
+            mgra_landuse, equiv_min, pop_col='persons',
+            int_radius=self.int_radius, oth_radius=self.oth_radius)
         #new_cols = [0-'totint',1-'duden',2-'empden',3-'popden',4-'retempden',5-'totintbin',6-'empdenbin',7-'dudenbin',8-'PopEmpDenPerMi']
-        mgra_landuse[self.new_cols[0]],mgra_landuse[self.new_cols[1]],mgra_landuse[self.new_cols[2]],mgra_landuse[self.new_cols[3]],mgra_landuse[self.new_cols[4]],mgra_landuse[self.new_cols[8]] = zip(*mgra_landuse['mgra'].map(density_function))
+        for col in [self.new_cols[i] for i in (0, 1, 2, 3, 4, 8)]:
+            mgra_landuse[col] = densities[col]
 
         mgra_landuse = mgra_landuse.fillna(0)
         mgra_landuse[self.new_cols[5]] = np.where(mgra_landuse[self.new_cols[0]] < 80, 1, np.where(mgra_landuse[self.new_cols[0]] < 130, 2, 3))
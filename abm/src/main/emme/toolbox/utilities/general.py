@@ -126,6 +126,114 @@ def backup_and_restore(scenario, backup_attributes):
             scenario.set_attribute_values(elem_type, attributes, backup[elem_type])
 
 
+def nearest_mgra(x, y, mgra_nodes, k=8):
+    """Nearest MGRA node of every point, found with a KD-tree.
+
+    Ties go to the first of the equally near nodes in mgra_nodes, as when
+    taking the first minimum of the distances to all nodes. Points with
+    more than k near ties are checked against all nodes.
+
+    mgra_nodes is a DataFrame with mgra, x and y columns. Returns an array
+    of the mgra of the nearest node, NaN for points without coordinates.
+    """
+    from scipy.spatial import cKDTree
+
+    node_x = _numpy.asarray(mgra_nodes['x'], dtype=_numpy.float64)
+    node_y = _numpy.asarray(mgra_nodes['y'], dtype=_numpy.float64)
+    node_mgra = _numpy.asarray(mgra_nodes['mgra'])
+    x = _numpy.asarray(x, dtype=_numpy.float64)
+    y = _numpy.asarray(y, dtype=_numpy.float64)
+    valid = _numpy.flatnonzero(_numpy.isfinite(x) & _numpy.isfinite(y))
+    if len(valid) < len(x) or len(node_x) == 0:
+        near = _numpy.full(len(x), _numpy.nan)
+    else:
+        near = _numpy.empty(len(x), dtype=node_mgra.dtype)
+    if len(valid) == 0 or len(node_x) == 0:
+        return near
+    x, y = x[valid, None], y[valid, None]
+
+    k = min(k, len(node_x))
+    tree = cKDTree(_numpy.column_stack([node_x, node_y]))
+    candidates = tree.query(
+        _numpy.column_stack([x[:, 0], y[:, 0]]), k=k)[1].reshape(len(valid), k)
+    # same arithmetic as the distance to every node, so ties are exact
+    dist = _numpy.sqrt((x - node_x[candidates])**2 + (y - node_y[candidates])**2)
+    min_dist = dist.min(axis=1)[:, None]
+    first = _numpy.where(dist == min_dist, candidates, len(node_x)).min(axis=1)
+
+    # nodes beyond the k candidates could still tie
+    for i in _numpy.flatnonzero(dist[:, -1] <= min_dist[:, 0] * (1 + 1e-9)):
+        all_dist = _numpy.sqrt((x[i, 0] - node_x)**2 + (y[i, 0] - node_y)**2)
+        first[i] = _numpy.flatnonzero(all_dist == all_dist.min())[0]
+
+    near[valid] = node_mgra[first]
+    return near
+
+
+def buffer_densities(mgra_data, equiv_min, pop_col='pop', int_radius=0.65, oth_radius=0.65):
+    """Density variables within a walk buffer around every MGRA.
+
+    The buffers are sparse MGRA x MGRA indicator matrices built once from
+    the equivalent minutes table (i, j and the distance dist in miles), and
+    every buffer total is taken in one sparse matrix product with the MGRA
+    data. Returns a DataFrame with totint, duden, empden, popden, retempden
+    and PopEmpDenPerMi indexed like mgra_data, all zero for MGRAs without
+    land in their buffer.
+    """
+    import pandas as _pd
+    from scipy import sparse as _sparse
+
+    oth_cols = ['emp_total', 'emp_retail', 'emp_personal_svcs_retail', 'emp_restaurant_bar',
+                'hh', pop_col, 'land_acres']
+    mgra_ids = _pd.Index(mgra_data['mgra'].dropna().unique())
+    n_ids = len(mgra_ids)
+    row_code = mgra_ids.get_indexer(mgra_data['mgra'])
+    has_id = _numpy.flatnonzero(row_code >= 0)
+
+    # totals of the rows of each mgra, missing values count as zero
+    rows_by_id = _sparse.csr_matrix(
+        (_numpy.ones(len(has_id)), (row_code[has_id], has_id)), shape=(n_ids, len(mgra_data)))
+    values = _numpy.asarray(mgra_data[oth_cols + ['icnt']], dtype=_numpy.float64)
+    values = _numpy.where(_numpy.isnan(values), 0, values)
+    values_by_id = rows_by_id.dot(values)
+
+    i_code = mgra_ids.get_indexer(equiv_min['i'])
+    j_code = mgra_ids.get_indexer(equiv_min['j'])
+    dist = _numpy.asarray(equiv_min['dist'])
+
+    def _buffer(radius):
+        pairs = (i_code >= 0) & (j_code >= 0) & (dist < radius)
+        buffer = _sparse.csr_matrix(
+            (_numpy.ones(pairs.sum()), (i_code[pairs], j_code[pairs])), shape=(n_ids, n_ids))
+        # an mgra counts once however often it appears in the table
+        buffer.sum_duplicates()
+        buffer.data[:] = 1
+        return buffer
+
+    oth_buffer = _buffer(oth_radius)
+    int_buffer = oth_buffer if int_radius == oth_radius else _buffer(int_radius)
+    oth_totals = oth_buffer.dot(values_by_id[:, :-1])
+    tot_int = int_buffer.dot(values_by_id[:, -1])
+
+    # mgras missing from the data have empty buffers
+    totals = _numpy.zeros((len(mgra_data), len(oth_cols) + 1))
+    totals[has_id, :-1] = oth_totals[row_code[has_id]]
+    totals[has_id, -1] = tot_int[row_code[has_id]]
+    tot_emp, tot_ret1, tot_ret2, tot_ret3, tot_hh, tot_pop, tot_acres, tot_int = totals.T
+    tot_ret = tot_ret1 + tot_ret2 + tot_ret3
+
+    has_land = tot_acres > 0
+    acres = _numpy.where(has_land, tot_acres, 1)
+    densities = _pd.DataFrame(index=mgra_data.index)
+    densities['totint'] = _numpy.where(has_land, tot_int, 0)
+    densities['duden'] = _numpy.where(has_land, tot_hh / acres, 0)
+    densities['empden'] = _numpy.where(has_land, tot_emp / acres, 0)
+    densities['popden'] = _numpy.where(has_land, tot_pop / acres, 0)
+    densities['retempden'] = _numpy.where(has_land, tot_ret / acres, 0)
+    densities['PopEmpDenPerMi'] = _numpy.where(has_land, (tot_emp + tot_pop) / (acres / 640), 0)  # acres to miles
+    return densities
+
+
 class DataTableProc(object):
 
     def __init__(self, table_name, path=None, data=None, convert_numeric=False):
@@ -1,29 +1,436 @@
+import hashlib
 import logging
 import os
 from pathlib import Path
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from rsm.utility import *
 
 logger = logging.getLogger(__name__)
 
 
-# function to convert to final trip roster
-def _merge_joint_and_indiv_trips(indiv_trips, joint_trips):
-    joint_trips = joint_trips[["hh_id", "tour_id", "num_participants", "trip_mode"]]
-    joint_trips = joint_trips.reindex(
-        joint_trips.index.repeat(joint_trips.num_participants)
-    ).reset_index(drop=True)
-    joint_trips = joint_trips.drop(columns=["num_participants"])
+def _household_zones(households):
+    """
+    Home zone of every household, as a lookup for `_count_trips`.
+
+    Returns
+    -------
+    hhids, zone_codes, zones, zoneid : (numpy.ndarray, numpy.ndarray, numpy.ndarray, str)
+        sorted household ids, the position of each household's home zone in
+        the sorted unique `zones`, and the name of the home zone column
+    """
+    hh_columns = pd.read_csv(households, nrows=0).columns
+    hh_id_col_names = ["hhid", "hh_id", "household_id"]
+    for hhid in hh_id_col_names:
+        if hhid in hh_columns:
+            break
+    else:
+        raise KeyError(f"none of {hh_id_col_names!r} in household file")
+    homezone_col_names = ["mgra", "home_mgra"]
+    for zoneid in homezone_col_names:
+        if zoneid in hh_columns:
+            break
+    else:
+        raise KeyError(f"none of {homezone_col_names!r} in household file")
+    hh = pd.read_csv(households, usecols=[hhid, zoneid]).dropna()
+    hh = hh.drop_duplicates(hhid).sort_values(hhid)
+    zones, zone_codes = np.unique(hh[zoneid].to_numpy(), return_inverse=True)
+    return hh[hhid].to_numpy(), zone_codes, zones, zoneid
+
+
+def _count_trips(trips, household_zones, counts=None, joint=False):
+    """
+    Count trips by home zone and trip mode, added to `counts`.
+
+    Joint trips count once per participant.  Trips of households without a
+    home zone are not counted.
+
+    Parameters
+    ----------
+    trips : trips (pandas.DataFrame)
+        trips with "hh_id", "trip_mode" and, for joint trips, "num_participants"
+    household_zones : household_zones (tuple)
+        from `_household_zones`
+    counts : counts (numpy.ndarray, optional)
+        (zones x trip modes) counts to add to
+    joint : joint (boolean)
+        True for joint trips
+
+    Returns
+    -------
+    numpy.ndarray
+        (zones x trip modes) counts, trip modes indexed by their value
+    """
+    hhids, zone_codes, zones, _ = household_zones
+    n_zones = len(zones)
+    if counts is None:
+        counts = np.zeros((n_zones, 0))
 
-    indiv_trips = indiv_trips[["hh_id", "tour_id", "trip_mode"]]
-    trips = pd.concat([joint_trips, indiv_trips], ignore_index=True).reset_index(
-        drop=True
+    hh_id = trips["hh_id"].to_numpy()
+    modes = trips["trip_mode"].to_numpy().astype(np.int64)
+    weights = None
+    if joint:
+        weights = trips["num_participants"].to_numpy()
+
+    found = _isin_sorted(hh_id, hhids)
+    zone = zone_codes[np.searchsorted(hhids, hh_id[found])]
+    modes = modes[found]
+    if weights is not None:
+        weights = weights[found]
+    n_modes = max(counts.shape[1], int(modes.max()) + 1 if len(modes) else 0)
+
+    new_counts = np.bincount(
+        zone * n_modes + modes, weights=weights, minlength=n_zones * n_modes
+    ).reshape(n_zones, n_modes).astype(np.float64)
+    new_counts[:, : counts.shape[1]] += counts
+    return new_counts
+
+
+def _trip_changes_by_zone(orig_counts, rsm_counts, household_zones):
+    """
+    Summary of changes in trips by mode, by household home zone.
+
+    Parameters
+    ----------
+    orig_counts, rsm_counts : orig_counts, rsm_counts (numpy.ndarray)
+        (zones x trip modes) counts from `_count_trips` for the trips of the
+        resimulated households, in the original model and in the RSM
+    household_zones : household_zones (tuple)
+        from `_household_zones`
+
+    Returns
+    -------
+    pandas.DataFrame
+        zone, trip_mode, n_trips_orig, n_trips_rsm, net_change and
+        pct_change, for the zone and mode pairs with trips on either side
+    """
+    _, _, zones, zoneid = household_zones
+    n_modes = max(orig_counts.shape[1], rsm_counts.shape[1])
+    orig = np.zeros((len(zones), n_modes))
+    rsm = np.zeros((len(zones), n_modes))
+    orig[:, : orig_counts.shape[1]] = orig_counts
+    rsm[:, : rsm_counts.shape[1]] = rsm_counts
+
+    zone, mode = np.nonzero((orig > 0) | (rsm > 0))
+    n_trips_orig = orig[zone, mode]
+    n_trips_rsm = rsm[zone, mode]
+    net_change = n_trips_rsm - n_trips_orig
+    return pd.DataFrame(
+        {
+            zoneid: zones[zone],
+            "trip_mode": mode,
+            "n_trips_orig": n_trips_orig,
+            "n_trips_rsm": n_trips_rsm,
+            "net_change": net_change,
+            "pct_change": net_change / np.fmax(n_trips_rsm, n_trips_orig) * 100,
+        }
     )
 
+
+def _apply_mgra_crosswalk(trips, mgra_crosswalk):
+    for col in [c for c in trips.columns if c.lower().endswith("_mgra")]:
+        trips[col] = trips[col].map(mgra_crosswalk)
+    return trips
+
+
+def _file_hash(filename, block_size=2**20):
+    h = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _compact_dtypes(trips):
+    """
+    Downcast integer columns and store strings as categoricals.
+
+    Floats are left alone, so values are unchanged.  Every string column
+    becomes a categorical, whatever its number of distinct values, so the
+    chunks of a streamed table get the same types as the whole table.
+    """
+    for col in trips.columns:
+        if pd.api.types.is_integer_dtype(trips[col]):
+            trips[col] = pd.to_numeric(trips[col], downcast="integer")
+        elif trips[col].dtype == object or pd.api.types.is_string_dtype(trips[col]):
+            trips[col] = trips[col].astype("category")
+    return trips
+
+
+def _cache_schema(schemas):
+    """
+    Schema that every chunk of a streamed table can be cast to.
+
+    Integer columns get the widest integer type of the chunks, a column
+    that is floating point in any chunk becomes float64 and a column that
+    holds strings in any chunk becomes a dictionary of strings.  Columns
+    that are all missing in a chunk take the type of the other chunks.
+
+    Returns
+    -------
+    pyarrow.Schema, or None if the column names or types cannot be reconciled
+    """
+    names = schemas[0].names
+    if any(schema.names != names for schema in schemas):
+        return None
+    fields = []
+    for name in names:
+        types = [schema.field(name).type for schema in schemas]
+        types = [t for t in types if not pa.types.is_null(t)] or [pa.null()]
+        if any(
+            pa.types.is_dictionary(t)
+            or pa.types.is_string(t)
+            or pa.types.is_large_string(t)
+            for t in types
+        ):
+            field_type = pa.dictionary(pa.int32(), pa.string())
+        elif any(pa.types.is_floating(t) for t in types):
+            field_type = pa.float64()
+        elif all(pa.types.is_integer(t) for t in types):
+            field_type = max(types, key=lambda t: t.bit_width)
+        elif all(t.equals(types[0]) for t in types):
+            field_type = types[0]
+        else:
+            return None
+        fields.append(pa.field(name, field_type))
+    return pa.schema(fields)
+
+
+def _cast_table(table, schema):
+    # columns that are all missing in this chunk may not be castable
+    # (e.g. float64 to strings), so they are rebuilt as nulls of the type
+    columns = []
+    for field, column in zip(schema, table.columns):
+        if column.null_count == len(column):
+            columns.append(pa.nulls(len(column), field.type))
+        else:
+            columns.append(column.cast(field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def _read_mgra_crosswalk(mgra_crosswalk):
+    mgra_crosswalk = pd.read_csv(mgra_crosswalk).set_index("MGRA")["cluster_id"]
+    mgra_crosswalk[-1] = -1
+    mgra_crosswalk[0] = 0
+    return mgra_crosswalk
+
+
+def _donor_cache_file(trips_file, mgra_crosswalk, cache_dir):
+    key = hashlib.sha1(_file_hash(trips_file).encode("utf-8"))
+    if mgra_crosswalk is not None:
+        key.update(_file_hash(mgra_crosswalk).encode("utf-8"))
+    stem = Path(trips_file).stem
+    return Path(cache_dir).expanduser().joinpath(f"{stem}_{key.hexdigest()[:16]}.parquet")
+
+
+def _read_donor_trips(trips_file, mgra_crosswalk=None, cache_dir=None):
+    """
+    Read a donor model trip table, with the MGRA crosswalk applied.
+
+    The donor tables don't change during an RSM run, so with `cache_dir`
+    the table is parsed only once and stored there as Parquet, with the
+    crosswalk applied and compact dtypes.  The cache is keyed by a hash of
+    the trip file and the crosswalk file, and later calls memory-map it
+    instead of parsing the CSV again.
+
+    Parameters
+    ----------
+    trips_file : trips_file (path_like)
+    mgra_crosswalk : mgra_crosswalk (path_like, optional)
+        Crosswalk from original MGRA to clustered zone ids, applied to
+        every "*_mgra" column.
+    cache_dir : cache_dir (path_like, optional)
+        Directory of the Parquet cache, default None does not cache.
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = _donor_cache_file(trips_file, mgra_crosswalk, cache_dir)
+        if cache_file.exists():
+            logger.info(f"reading {trips_file} from cache {cache_file}")
+            return pd.read_parquet(cache_file, memory_map=True)
+
+    logger.info(f"reading {trips_file}")
+    trips = pd.read_csv(trips_file)
+
+    if mgra_crosswalk is not None:
+        logger.info("applying mgra_crosswalk to original data")
+        trips = _apply_mgra_crosswalk(trips, _read_mgra_crosswalk(mgra_crosswalk))
+
+    if cache_file is not None:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        _remove_stale_caches(cache_file, trips_file)
+        trips = _compact_dtypes(trips)
+        table = pa.Table.from_pandas(trips, preserve_index=False)
+        temp_file = cache_file.with_suffix(".tmp")
+        pq.write_table(_cast_table(table, _cache_schema([table.schema])), temp_file)
+        os.replace(temp_file, cache_file)
+        logger.info(f"cached {trips_file} in {cache_file}")
+
     return trips
 
 
+def _remove_stale_caches(cache_file, trips_file):
+    # caches of older versions of the same file are not needed anymore
+    stem = Path(trips_file).stem
+    for stale_file in cache_file.parent.glob(f"{stem}_*.parquet"):
+        stale_file.unlink()
+
+
+def _cache_chunks(chunks, trips_file, cache_file):
+    """
+    Pass trip chunks through while writing them to the Parquet cache.
+
+    Each chunk is compacted with `_compact_dtypes` like the whole table in
+    `_read_donor_trips`, and written to a temporary part file.  Once the
+    last chunk has been passed on, the parts are cast to one schema (see
+    `_cache_schema`) and written to `cache_file`, so a column that is
+    all missing or holds larger integers in some chunks does not prevent
+    caching, and an interrupted pass never leaves a partial cache behind.
+    """
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    temp_file = cache_file.with_suffix(".tmp")
+    part_files = []
+    try:
+        for chunk in chunks:
+            table = pa.Table.from_pandas(
+                _compact_dtypes(chunk.copy()), preserve_index=False
+            ).replace_schema_metadata()
+            part_file = cache_file.with_suffix(f".part{len(part_files)}")
+            pq.write_table(table, part_file)
+            part_files.append(part_file)
+            yield chunk
+        if not part_files:
+            return
+        schema = _cache_schema([pq.read_schema(f) for f in part_files])
+        try:
+            if schema is None:
+                raise pa.ArrowInvalid("different columns or column types")
+            with pq.ParquetWriter(temp_file, schema) as writer:
+                for part_file in part_files:
+                    writer.write_table(_cast_table(pq.read_table(part_file), schema))
+        except pa.ArrowException as e:
+            logger.warning(
+                f"column types of {trips_file} differ between chunks ({e}), not caching it"
+            )
+            return
+        _remove_stale_caches(cache_file, trips_file)
+        os.replace(temp_file, cache_file)
+        logger.info(f"cached {trips_file} in {cache_file}")
+    finally:
+        for part_file in part_files:
+            if part_file.exists():
+                part_file.unlink()
+        if temp_file.exists():
+            temp_file.unlink()
+
+
+def _stream_indiv_trips(
+    orig_indiv,
+    rsm_indiv,
+    output_indiv,
+    other_hh_ids_rsm,
+    mgra_crosswalk=None,
+    chunksize=1_000_000,
+    cache_dir=None,
+    household_zones=None,
+):
+    """
+    Write the assembled individual trips to a CSV file chunk by chunk.
+
+    The RSM trips are copied to `output_indiv` first, collecting their
+    household ids.  The donor trips are then read in chunks and the trips
+    of households that were not resimulated are appended, with the columns
+    of the RSM trips.  With `cache_dir`, the donor trips are streamed from
+    the Parquet cache if there is one, otherwise the cache is written
+    during this pass, for the next iterations.
+
+    With `household_zones`, the RSM trips and the donor trips of the
+    resimulated households are also counted by home zone and trip mode.
+
+    Returns
+    -------
+    hh_ids_rsm, orig_counts, rsm_counts : (numpy.ndarray, numpy.ndarray, numpy.ndarray)
+        sorted unique ids of the resimulated households, from the RSM
+        trips and `other_hh_ids_rsm`, and the trip counts by zone and mode
+        (None without `household_zones`)
+    """
+    output_indiv = Path(output_indiv).expanduser()
+    if output_indiv.resolve() == Path(rsm_indiv).resolve():
+        raise ValueError("output_indiv must not be the rsm_indiv file")
+
+    logger.info(f"writing RSM individual trips to {output_indiv}")
+    hh_ids_rsm = [np.unique(other_hh_ids_rsm)]
+    orig_counts = rsm_counts = None
+    columns = None
+    for chunk in pd.read_csv(rsm_indiv, chunksize=chunksize):
+        if columns is None:
+            columns = chunk.columns
+            chunk.to_csv(output_indiv, index=False)
+        else:
+            chunk.to_csv(output_indiv, mode="a", header=False, index=False)
+        hh_ids_rsm.append(np.unique(chunk["hh_id"].to_numpy()))
+        if household_zones is not None:
+            rsm_counts = _count_trips(chunk, household_zones, rsm_counts)
+    hh_ids_rsm = np.unique(np.concatenate(hh_ids_rsm))
+
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = _donor_cache_file(orig_indiv, mgra_crosswalk, cache_dir)
+    if cache_file is not None and cache_file.exists():
+        logger.info(f"streaming donor individual trips from cache {cache_file}")
+        batches = pq.ParquetFile(cache_file, memory_map=True).iter_batches(
+            batch_size=chunksize
+        )
+        chunks = (batch.to_pandas() for batch in batches)
+    else:
+        logger.info(f"streaming donor individual trips from {orig_indiv}")
+        chunks = pd.read_csv(orig_indiv, chunksize=chunksize)
+        if mgra_crosswalk is not None:
+            mgra_crosswalk = _read_mgra_crosswalk(mgra_crosswalk)
+            chunks = (_apply_mgra_crosswalk(chunk, mgra_crosswalk) for chunk in chunks)
+        if cache_file is not None:
+            chunks = _cache_chunks(chunks, orig_indiv, cache_file)
+
+    n_kept = 0
+    for chunk in chunks:
+        if columns is None:
+            columns = chunk.columns
+            chunk.iloc[:0].to_csv(output_indiv, index=False)
+        resimulated = _isin_sorted(chunk["hh_id"].to_numpy(), hh_ids_rsm)
+        if household_zones is not None:
+            orig_counts = _count_trips(
+                chunk.loc[resimulated], household_zones, orig_counts
+            )
+        chunk = chunk.loc[~resimulated]
+        chunk.reindex(columns=columns).to_csv(
+            output_indiv, mode="a", header=False, index=False
+        )
+        n_kept += len(chunk)
+    logger.info(f"appended {n_kept} donor individual trips to {output_indiv}")
+
+    return hh_ids_rsm, orig_counts, rsm_counts
+
+
+def _isin_sorted(values, sorted_ids):
+    """
+    Boolean mask of `values` found in `sorted_ids`.
+
+    A binary search in the sorted unique ids, instead of building a hash
+    table each time as `Series.isin` does.
+    """
+    if len(sorted_ids) == 0:
+        return np.zeros(len(values), dtype=bool)
+    position = np.searchsorted(sorted_ids, values)
+    position[position == len(sorted_ids)] = 0
+    return sorted_ids[position] == values
+
+
 def rsm_assemble(
     orig_indiv,
     orig_joint,
@@ -35,6 +442,13 @@ def rsm_assemble(
     sample_rate=0.25,
     study_area_taz=None,
     run_assembler=1,
+    weighted_output=False,
+    household_weights=None,
+    donor_cache_dir=None,
+    output_indiv=None,
+    chunksize=1_000_000,
+    trip_changes=False,
+    trip_changes_file=None,
 ):
     """
     Assemble and evaluate RSM trip making.
@@ -72,15 +486,44 @@ def rsm_assemble(
         this is used to scale the trips if run_assembler is 0
     study_area_rsm_zones :  list
         it is list of study area RSM zones
+    weighted_output : weighted_output (boolean)
+        Only used if run_assembler is 0.  If True, the trip tables keep one row
+        per trip and get a `weight` column with the household's scale factor
+        (1 in the study area) instead of repeating each trip.  Default False
+        repeats the trips, for consumers that can't read weights.
+    household_weights : household_weights (path_like, optional)
+        Only used if run_assembler is 0.  Household expansion weights written
+        by the sampler, used instead of the fixed sample rate.
+    donor_cache_dir : donor_cache_dir (path_like, optional)
+        Directory for a Parquet cache of the `orig_indiv` and `orig_joint`
+        tables, with the crosswalk applied.  The donor tables are then parsed
+        only on the first iteration, later iterations read the cache.
+    output_indiv : output_indiv (path_like, optional)
+        Only used if run_assembler is 1.  Stream the individual trips to this
+        CSV file instead of returning them: the RSM trips are written first,
+        then the donor trips are read `chunksize` rows at a time and the
+        trips of households that were not resimulated are appended.  Memory
+        is then bounded by the chunk size and the set of resimulated
+        household ids.  Must not be the same file as `rsm_indiv`.  The
+        returned final_ind_trips is None.
+    chunksize : chunksize (int)
+        Number of trips read at a time when streaming to output_indiv.
+    trip_changes : trip_changes (boolean)
+        Only used if run_assembler is 1.  If True, also return the changes in
+        trips by mode, by household home zone (combined_trips_by_zone).
+    trip_changes_file : trip_changes_file (path_like, optional)
+        Only used if run_assembler is 1.  Write combined_trips_by_zone to
+        this CSV file.
     
     Returns
     -------
     final_trips_rsm : final_ind_trips (pd.DataFrame)
         Assembled trip table for RSM run, filling in archived trip values for
         non-resimulated households.
-    combined_trips_by_zone : final_jnt_trips (pd.DataFrame)
+    combined_trips_by_zone : combined_trips_by_zone (pd.DataFrame)
         Summary table of changes in trips by mode, by household home zone.
         Used to check whether undersampled zones have stable travel behavior.
+        Only returned, as the third item, if trip_changes is True.
     
     Separate tables for individual and joint trips, as required by java.
     
@@ -107,123 +550,78 @@ def rsm_assemble(
         assert os.path.isfile(taz_crosswalk)
 
     # load trip data - partial simulation of RSM model
-    logger.info("reading ind_trips_rsm")
-    ind_trips_rsm = pd.read_csv(rsm_indiv)
     logger.info("reading jnt_trips_rsm")
     jnt_trips_rsm = pd.read_csv(rsm_joint)
 
+    summarize_changes = run_assembler == 1 and (trip_changes or trip_changes_file)
+    household_zones = _household_zones(households) if summarize_changes else None
+    orig_counts = rsm_counts = None
+
     scale_factor = int(1.0/sample_rate)
 
-    if run_assembler == 1:
+    if run_assembler == 1 and output_indiv is not None:
+        # individual trips go straight from the input files to output_indiv
+        hh_ids_rsm, orig_counts, rsm_counts = _stream_indiv_trips(
+            orig_indiv,
+            rsm_indiv,
+            output_indiv,
+            jnt_trips_rsm["hh_id"].to_numpy(),
+            mgra_crosswalk,
+            chunksize,
+            donor_cache_dir,
+            household_zones,
+        )
+        final_ind_trips = None
+
+        logger.info("reading jnt_trips_full")
+        jnt_trips_full = _read_donor_trips(orig_joint, mgra_crosswalk, donor_cache_dir)
+        jnt_resimulated = _isin_sorted(jnt_trips_full["hh_id"].to_numpy(), hh_ids_rsm)
+        final_jnt_trips = pd.concat(
+            [jnt_trips_rsm, jnt_trips_full.loc[~jnt_resimulated]], ignore_index=True
+        )
+
+    elif run_assembler == 1:
+        logger.info("reading ind_trips_rsm")
+        ind_trips_rsm = pd.read_csv(rsm_indiv)
+
         # load trip data - full simulation of residual/source model
         logger.info("reading ind_trips_full")
-        ind_trips_full = pd.read_csv(orig_indiv)
+        ind_trips_full = _read_donor_trips(orig_indiv, mgra_crosswalk, donor_cache_dir)
         logger.info("reading jnt_trips_full")
-        jnt_trips_full = pd.read_csv(orig_joint)
+        jnt_trips_full = _read_donor_trips(orig_joint, mgra_crosswalk, donor_cache_dir)
 
-        if mgra_crosswalk is not None:
-            logger.info("applying mgra_crosswalk to original data")
-            mgra_crosswalk = pd.read_csv(mgra_crosswalk).set_index("MGRA")["cluster_id"]
-            mgra_crosswalk[-1] = -1
-            mgra_crosswalk[0] = 0
-            for col in [c for c in ind_trips_full.columns if c.lower().endswith("_mgra")]:
-                ind_trips_full[col] = ind_trips_full[col].map(mgra_crosswalk)
-            for col in [c for c in jnt_trips_full.columns if c.lower().endswith("_mgra")]:
-                jnt_trips_full[col] = jnt_trips_full[col].map(mgra_crosswalk)
-        
-        # convert to rsm trips
-        logger.info("convert to common table platform")
-        rsm_trips = _merge_joint_and_indiv_trips(ind_trips_rsm, jnt_trips_rsm)
-        original_trips = _merge_joint_and_indiv_trips(ind_trips_full, jnt_trips_full)
-        
         logger.info("get all hhids in trips produced by RSM")
-        hh_ids_rsm = rsm_trips["hh_id"].unique()
-        
-        logger.info("remove orginal model trips made by households chosen in RSM trips")
-        original_trips_not_resimulated = original_trips.loc[
-            ~original_trips["hh_id"].isin(hh_ids_rsm)
-        ]
-        original_ind_trips_not_resimulated = ind_trips_full[
-            ~ind_trips_full["hh_id"].isin(hh_ids_rsm)
-        ]
-        original_jnt_trips_not_resimulated = jnt_trips_full[
-            ~jnt_trips_full["hh_id"].isin(hh_ids_rsm)
-        ]
-        
+        hh_ids_rsm = np.unique(
+            np.concatenate(
+                [ind_trips_rsm["hh_id"].to_numpy(), jnt_trips_rsm["hh_id"].to_numpy()]
+            )
+        )
+
+        # one mask per table, reused for every split below
+        ind_resimulated = _isin_sorted(ind_trips_full["hh_id"].to_numpy(), hh_ids_rsm)
+        jnt_resimulated = _isin_sorted(jnt_trips_full["hh_id"].to_numpy(), hh_ids_rsm)
+
         logger.info("concatenate trips from rsm and original model")
-        final_trips_rsm = pd.concat(
-            [rsm_trips, original_trips_not_resimulated], ignore_index=True
-        ).reset_index(drop=True)
         final_ind_trips = pd.concat(
-            [ind_trips_rsm, original_ind_trips_not_resimulated], ignore_index=True
-        ).reset_index(drop=True)
-        final_jnt_trips = pd.concat(
-            [jnt_trips_rsm, original_jnt_trips_not_resimulated], ignore_index=True
-        ).reset_index(drop=True)
-        
-        # Get percentage change in total trips by mode for each home zone
-        
-        # extract trips made by households in RSM and Original model
-        original_trips_that_were_resimulated = original_trips.loc[
-            original_trips["hh_id"].isin(hh_ids_rsm)
-        ]
-        
-        def _agg_by_hhid_and_tripmode(df, name):
-            return df.groupby(["hh_id", "trip_mode"]).size().rename(name).reset_index()
-        
-        # combining trips by hhid and trip mode
-        combined_trips = pd.merge(
-            _agg_by_hhid_and_tripmode(original_trips_that_were_resimulated, "n_trips_orig"),
-            _agg_by_hhid_and_tripmode(rsm_trips, "n_trips_rsm"),
-            on=["hh_id", "trip_mode"],
-            how="outer",
-            sort=True,
-        ).fillna(0)
-        
-        # aggregating by Home zone
-        hh_rsm = pd.read_csv(households)
-        hh_id_col_names = ["hhid", "hh_id", "household_id"]
-        for hhid in hh_id_col_names:
-            if hhid in hh_rsm.columns:
-                break
-        else:
-            raise KeyError(f"none of {hh_id_col_names!r} in household file")
-        homezone_col_names = ["mgra", "home_mgra"]
-        for zoneid in homezone_col_names:
-            if zoneid in hh_rsm.columns:
-                break
-        else:
-            raise KeyError(f"none of {homezone_col_names!r} in household file")
-        hh_rsm = hh_rsm[[hhid, zoneid]]
-        
-        # attach home zone id
-        combined_trips = pd.merge(
-            combined_trips, hh_rsm, left_on="hh_id", right_on=hhid, how="left"
-        )
-        
-        combined_trips_by_zone = (
-            combined_trips.groupby([zoneid, "trip_mode"])[["n_trips_orig", "n_trips_rsm"]]
-            .sum()
-            .reset_index()
-        )
-        
-        combined_trips_by_zone = combined_trips_by_zone.eval(
-            "net_change = (n_trips_rsm - n_trips_orig)"
-        )
-        
-        combined_trips_by_zone["max_trips"] = np.fmax(
-            combined_trips_by_zone.n_trips_rsm, combined_trips_by_zone.n_trips_orig
+            [ind_trips_rsm, ind_trips_full.loc[~ind_resimulated]], ignore_index=True
         )
-        combined_trips_by_zone = combined_trips_by_zone.eval(
-            "pct_change = net_change / max_trips * 100"
+
+        final_jnt_trips = pd.concat(
+            [jnt_trips_rsm, jnt_trips_full.loc[~jnt_resimulated]], ignore_index=True
         )
-        combined_trips_by_zone = combined_trips_by_zone.drop(columns="max_trips")
+
+        if summarize_changes:
+            # trips made by households in RSM and Original model
+            orig_counts = _count_trips(ind_trips_full.loc[ind_resimulated], household_zones)
+            rsm_counts = _count_trips(ind_trips_rsm, household_zones)
+
     else:
+        logger.info("reading ind_trips_rsm")
+        ind_trips_rsm = pd.read_csv(rsm_indiv)
+
         # if assembler is set to be turned off
         # then scale the trips in the trip list using the fixed sample rate 
         # trips in the final trip lists will be 100%
-        scale_factor = int(1.0/sample_rate)
-
         if study_area_taz:
             sa_rsm = study_area_taz
         else:
@@ -234,17 +632,46 @@ def rsm_assemble(
         #final_ind_trips = pd.concat([ind_trips_rsm]*scale_factor, ignore_index=True)
         #final_jnt_trips = pd.concat([jnt_trips_rsm]*scale_factor, ignore_index=True)
 
+        if weighted_output:
+            # weights need not be whole trips
+            scale_factor = 1.0/sample_rate
+        else:
+            scale_factor = int(1.0/sample_rate)
+            household_weights = None
+
+        # households are read once for both trip tables
+        scale_factors = household_scale_factors(households,
+                                                taz_crosswalk,
+                                                scale_factor,
+                                                study_area_tazs=sa_rsm,
+                                                household_weights=household_weights)
 
         final_ind_trips = scaleup_to_rsm_samplingrate(ind_trips_rsm, 
-                                                      households, 
+                                                      scale_factors, 
                                                       taz_crosswalk, 
                                                       scale_factor, 
-                                                      study_area_tazs=sa_rsm)
+                                                      study_area_tazs=sa_rsm,
+                                                      weighted=weighted_output)
 
         final_jnt_trips = scaleup_to_rsm_samplingrate(jnt_trips_rsm, 
-                                                      households, 
+                                                      scale_factors, 
                                                       taz_crosswalk, 
                                                       scale_factor,
-                                                      study_area_tazs=sa_rsm) 
+                                                      study_area_tazs=sa_rsm,
+                                                      weighted=weighted_output) 
+
+    if summarize_changes:
+        # Get percentage change in total trips by mode for each home zone
+        orig_counts = _count_trips(
+            jnt_trips_full.loc[jnt_resimulated], household_zones, orig_counts, joint=True
+        )
+        rsm_counts = _count_trips(jnt_trips_rsm, household_zones, rsm_counts, joint=True)
+        combined_trips_by_zone = _trip_changes_by_zone(
+            orig_counts, rsm_counts, household_zones
+        )
+        if trip_changes_file is not None:
+            combined_trips_by_zone.to_csv(trip_changes_file, index=False)
+        if trip_changes:
+            return final_ind_trips, final_jnt_trips, combined_trips_by_zone
                      
     return final_ind_trips, final_jnt_trips
@@ -1,14 +1,17 @@
-
 import os
 import sys
-from pathlib import Path
+import fnmatch
+import itertools
 import logging
+import multiprocessing
+import time
+from collections import namedtuple
+from pathlib import Path
 import numpy as np
 import pandas as pd
+import pyarrow.csv as pa_csv
 from tabulate import tabulate
 
-import itertools
-
 logger = logging.getLogger(__name__)
 
 
@@ -21,6 +24,449 @@ def to_fwf(df,
 
 pd.DataFrame.to_fwf = to_fwf
 
+
+# aggregation rule for one donor model file, see INPUT_FILES
+#   name: file name in input_files and the skip list
+#   folder: donor model folder of the file, "input", "output" or "uec"
+#   file: file name on disk when it differs from name
+#   out_folder: RSM folder of the aggregated file, default folder
+#   read: "csv", "csv_noheader" or "fwf", None for generated files
+#   columns: column names of files without header, or of generated files
+#   mgra_cols, taz_cols: columns renumbered with the mgra or taz crosswalk
+#   keys: columns grouped by after renumbering, None keeps every row
+#   values: columns aggregated, None for every column that is not a key
+#   agg: aggregation of the values ("mean", "sum", "min", "max"), a dict by
+#       column, or a function returning that dict from the file's columns
+#   dedupe: drop duplicate rows after renumbering
+#   order: output columns in their order
+#   post: function applied to the aggregated table before it is written
+#   write: "csv", "csv_noheader", "fwf" or "tap_ptype"
+#   generate: "taz" or "mgra", one row per aggregated zone with every column
+#       holding the zone number, instead of reading a donor file
+#   use: "required" raises FileNotFoundError when the file is not in
+#       input_files, "optional" aggregates it only when listed, "always"
+#       aggregates it whether listed or not
+#   engine: "pandas", or "numpy" for the mean of values by a pair of zone
+#       keys over tens of millions of rows, see _pair_means
+InputFile = namedtuple(
+    "InputFile",
+    [
+        "name",
+        "folder",
+        "file",
+        "out_folder",
+        "read",
+        "columns",
+        "mgra_cols",
+        "taz_cols",
+        "keys",
+        "values",
+        "agg",
+        "dedupe",
+        "order",
+        "post",
+        "write",
+        "generate",
+        "use",
+        "engine",
+    ],
+    defaults=(
+        None, None, "csv", None, (), (), None, None, "mean", False, None, None,
+        "csv", None, "required", "pandas",
+    ),
+)
+
+AggOptions = namedtuple(
+    "AggOptions", ["model_dir", "rsm_dir", "taz_cwk", "mgra_cwk", "taz_zones", "mgra_zones"]
+)
+
+EQUIV_MIN_COLS = [
+    "walkTime", "dist", "mmTime", "mmCost", "mtTime", "mtCost", "mmGenTime", "mtGenTime", "minTime"
+]
+TRIP_ENDS_MGRA = ("originMGRA", "destinationMGRA")
+TRIP_ENDS_TAZ = ("originTAZ", "destinationTAZ")
+
+
+def _shadow_price_agg(columns):
+    """
+    aggregation of the shadow pricing columns, sizes and counts are summed,
+    shadow prices take the maximum
+    """
+    agg_instructions = {}
+    for col in columns:
+        if "size" in col:
+            agg_instructions.update({col: "sum"})
+        if "shadowPrices" in col:
+            agg_instructions.update({col: "max"})
+        if "_origins" in col:
+            agg_instructions.update({col: "sum"})
+        if "_modeledDests" in col:
+            agg_instructions.update({col: "sum"})
+    return agg_instructions
+
+
+def _shadow_price_alternatives(df):
+    """
+    adds the alternative column and the trailing row of zeros the shadow
+    pricing files carry
+    """
+    df.insert(loc=0, column="alt", value=list(df["mgra"]))
+    df.loc[len(df.index)] = 0
+    return df
+
+
+def _number_alternatives(df):
+    """
+    numbers the rows as alternatives "a" from 1
+    """
+    df.insert(loc=0, column="a", value=range(1, len(df) + 1))
+    return df
+
+
+def _write_tap_ptype(df, fname):
+    """
+    writes tap.ptype with its right justified fixed widths
+    """
+    widths = [5, 6, 6, 5, 5, 5, 3]
+    with open(fname, "w") as f:
+        for row in df.values:
+            f.write("".join(str(value).rjust(width) for value, width in zip(row, widths)) + "\n")
+
+
+# the donor model files aggregated by agg_input_files, in processing order.
+# Adding a donor file that only needs renumbering and grouping is a new entry
+INPUT_FILES = [
+    InputFile(
+        "microMgraEquivMinutes.csv", "output", out_folder="input",
+        mgra_cols=("i", "j"), keys=["i", "j"], values=EQUIV_MIN_COLS,
+        engine="numpy",
+    ),
+    InputFile(
+        "microMgraTapEquivMinutes.csv", "output", out_folder="input",
+        mgra_cols=("mgra",), keys=["mgra", "tap"], values=EQUIV_MIN_COLS,
+    ),
+    InputFile(
+        "walkMgraTapEquivMinutes.csv", "output", out_folder="input",
+        mgra_cols=("mgra",), keys=["mgra", "tap"],
+        values=[
+            "boardingPerceived", "boardingActual", "alightingPerceived",
+            "alightingActual", "boardingGain", "alightingGain",
+        ],
+        use="optional",
+    ),
+    InputFile(
+        "walkMgraEquivMinutes.csv", "output", out_folder="input",
+        mgra_cols=("i", "j"), keys=["i", "j"], values=["percieved", "actual", "gain"],
+        use="optional",
+        engine="numpy",
+    ),
+    InputFile(
+        "bikeTazLogsum.csv", "output", out_folder="input",
+        taz_cols=("i", "j"), keys=["i", "j"], values=["logsum", "time"],
+    ),
+    InputFile(
+        "bikeMgraLogsum.csv", "output", out_folder="input",
+        mgra_cols=("i", "j"), keys=["i", "j"], values=["logsum", "time"],
+        engine="numpy",
+    ),
+    InputFile(
+        "zone.term", "input", read="fwf", columns=["taz", "terminal_time"],
+        taz_cols=("taz",), keys=["taz"], agg="max", write="fwf",
+    ),
+    InputFile(
+        "zones.park", "input", file="zone.park", read="fwf", columns=["taz", "park_zones"],
+        taz_cols=("taz",), keys=["taz"], agg="max", write="fwf",
+    ),
+    InputFile(
+        "tap.ptype", "input", read="fwf",
+        columns=["tap", "lot id", "parking type", "taz", "capacity", "distance", "transit mode"],
+        taz_cols=("taz",), write="tap_ptype",
+    ),
+    InputFile(
+        "accessam.csv", "input", read="csv_noheader",
+        columns=["TAZ", "TAP", "TIME", "DISTANCE", "MODE"],
+        taz_cols=("TAZ",), keys=["TAZ", "TAP", "MODE"], values=["TIME", "DISTANCE"],
+        order=["TAZ", "TAP", "TIME", "DISTANCE", "MODE"], write="csv_noheader",
+    ),
+    # assuming parkarea 1 is "parking" and 2 is "no parking"
+    InputFile(
+        "ParkLocationAlts.csv", "uec",
+        mgra_cols=("mgra",), keys=["mgra"], values=["parkarea"], agg="min",
+        post=_number_alternatives, use="optional",
+    ),
+    InputFile(
+        "CrossBorderDestinationChoiceSoaAlternatives.csv", "uec",
+        mgra_cols=("mgra_entry", "mgra_return", "a"), taz_cols=("dest",), dedupe=True,
+        order=["a", "dest", "poe", "mgra_entry", "mgra_return", "poe_taz"], use="optional",
+    ),
+    InputFile(
+        "households.csv", "input", mgra_cols=("mgra",), taz_cols=("taz",), use="optional",
+    ),
+    InputFile(
+        "ShadowPricingOutput_school_9.csv", "input",
+        mgra_cols=("mgra",), keys=["mgra"], agg=_shadow_price_agg,
+        post=_shadow_price_alternatives, use="optional",
+    ),
+    InputFile(
+        "ShadowPricingOutput_work_9.csv", "input",
+        mgra_cols=("mgra",), keys=["mgra"], agg=_shadow_price_agg,
+        post=_shadow_price_alternatives, use="optional",
+    ),
+    InputFile(
+        "TourDcSoaDistanceAlts.csv", "uec", read=None, columns=["a", "dest"],
+        generate="taz", use="optional",
+    ),
+    InputFile(
+        "DestinationChoiceAlternatives.csv", "uec", read=None, columns=["a", "mgra"],
+        generate="mgra", use="optional",
+    ),
+    InputFile(
+        "SoaTazDistAlts.csv", "uec", read=None, columns=["a", "dest"],
+        generate="taz", use="optional",
+    ),
+    InputFile(
+        "TripMatrices.csv", "output", taz_cols=("i", "j"), keys=["i", "j"], agg="sum",
+        use="optional",
+    ),
+    InputFile(
+        "transponderModelAccessibilities.csv", "output",
+        taz_cols=("TAZ",), keys=["TAZ"], values=["DIST", "AVGTTS", "PCTDETOUR"],
+    ),
+    InputFile(
+        "crossBorderTours.csv", "output", mgra_cols=TRIP_ENDS_MGRA, taz_cols=TRIP_ENDS_TAZ,
+    ),
+    InputFile(
+        "crossBorderTrips.csv", "output", mgra_cols=TRIP_ENDS_MGRA, taz_cols=TRIP_ENDS_TAZ,
+    ),
+    InputFile(
+        "internalExternalTrips.csv", "output", mgra_cols=TRIP_ENDS_MGRA, taz_cols=TRIP_ENDS_TAZ,
+    ),
+    InputFile("visitorTours.csv", "output", mgra_cols=TRIP_ENDS_MGRA),
+    InputFile("visitorTrips.csv", "output", mgra_cols=TRIP_ENDS_MGRA),
+    InputFile(
+        "householdAVTrips.csv", "output",
+        mgra_cols=("orig_mgra", "dest_gra", "trip_orig_mgra", "trip_dest_mgra"),
+    ),
+    InputFile(
+        "airport_out.CBX.csv", "output", mgra_cols=TRIP_ENDS_MGRA, taz_cols=TRIP_ENDS_TAZ,
+    ),
+    InputFile(
+        "airport_out.SAN.csv", "output", mgra_cols=TRIP_ENDS_MGRA, taz_cols=TRIP_ENDS_TAZ,
+    ),
+    InputFile(
+        "TNCtrips.csv", "output",
+        mgra_cols=("originMgra", "destinationMgra"), taz_cols=("originTaz", "destinationTaz"),
+    ),
+] + [
+    InputFile(
+        "Trip" + "_" + i + "_" + j + ".csv", "output",
+        taz_cols=("I", "J", "HomeZone"), use="always",
+    )
+    for i, j in itertools.product(
+        ["FA", "GO", "IN", "RE", "SV", "TH", "WH"], ["OE", "AM", "MD", "PM", "OL"]
+    )
+]
+
+
+def _read_input_file(spec, options):
+    """
+    reads (or generates) the donor model file of one spec
+    """
+    if spec.generate is not None:
+        n_zones = options.taz_zones if spec.generate == "taz" else options.mgra_zones
+        return pd.DataFrame({col: range(1, n_zones + 1) for col in spec.columns})
+
+    fname = os.path.join(options.model_dir, spec.folder, spec.file or spec.name)
+    if spec.read == "fwf":
+        df = pd.read_fwf(fname, header=None)
+    elif spec.read == "csv_noheader":
+        df = pd.read_csv(fname, header=None)
+    else:
+        df = pd.read_csv(fname)
+    if spec.columns is not None:
+        df.columns = spec.columns
+    return df
+
+
+def _write_input_file(spec, df, options):
+    """
+    writes the aggregated file of one spec to the RSM
+    """
+    fname = os.path.join(
+        options.rsm_dir, spec.out_folder or spec.folder, spec.file or spec.name
+    )
+    if spec.write == "fwf":
+        to_fwf(df, fname)
+    elif spec.write == "tap_ptype":
+        _write_tap_ptype(df, fname)
+    elif spec.write == "csv_noheader":
+        df.to_csv(fname, index=False, header=False)
+    else:
+        df.to_csv(fname, index=False)
+
+
+def _zone_lookup(crosswalk):
+    """
+    crosswalk dict as an array indexed by the original zone number, -1 for
+    zones missing from the crosswalk
+    """
+    zones = np.fromiter(crosswalk.keys(), dtype=np.int64, count=len(crosswalk))
+    agg_zones = np.fromiter(crosswalk.values(), dtype=np.int64, count=len(crosswalk))
+    lookup = np.full(zones.max() + 1, -1, dtype=np.int64)
+    lookup[zones] = agg_zones
+    return lookup
+
+
+def _renumber(zones, lookup):
+    """
+    renumbers an array of zone numbers with a lookup array, -1 for zones
+    missing from it
+    """
+    if zones.dtype.kind in "iu" and len(zones) and zones.min() >= 0 and zones.max() < len(lookup):
+        return lookup.take(zones)
+    renumbered = np.full(len(zones), -1, dtype=np.int64)
+    valid = (zones >= 0) & (zones < len(lookup))
+    renumbered[valid] = lookup[zones[valid].astype(np.int64)]
+    return renumbered
+
+
+def _pair_means(spec, options):
+    """
+    mean of the values by a pair of renumbered zone keys, the numpy engine
+
+    Only the key and value columns are read, with the multithreaded pyarrow
+    reader.  Zones are renumbered through lookup arrays and each pair of
+    aggregated zones is encoded as one int64 key, the means are then taken
+    with np.bincount over the keys.  Like the pandas groupby, rows with a
+    zone missing from the crosswalk are dropped (the number dropped is
+    logged), missing values are left out of the means and the pairs come
+    out sorted.
+
+    Returns
+    -------
+    aggregated table and rows read
+    """
+    fname = os.path.join(options.model_dir, spec.folder, spec.file or spec.name)
+    table = pa_csv.read_csv(
+        fname,
+        read_options=pa_csv.ReadOptions(use_threads=True),
+        convert_options=pa_csv.ConvertOptions(include_columns=spec.keys + spec.values),
+    )
+
+    codes = []
+    for key in spec.keys:
+        lookup = _zone_lookup(options.mgra_cwk if key in spec.mgra_cols else options.taz_cwk)
+        codes.append(_renumber(table.column(key).to_numpy(), lookup))
+    i, j = codes
+    valid = (i >= 0) & (j >= 0)
+    n_dropped = len(valid) - int(valid.sum())
+    if n_dropped:
+        logger.warning(
+            "{} - dropped {} of {} rows with a zone missing from the crosswalk".format(
+                spec.name, n_dropped, table.num_rows
+            )
+        )
+    else:
+        valid = slice(None)
+    i = i[valid]
+    j = j[valid]
+
+    n_j = int(j.max()) + 1 if len(j) else 1
+    pair = i * n_j + j
+    n_pairs = int(pair.max()) + 1 if len(pair) else 0
+    if n_pairs <= 4 * len(pair) + 2 ** 20:
+        # few enough possible pairs to count them directly
+        group = pair
+        rows = np.bincount(group, minlength=n_pairs)
+        pairs = np.flatnonzero(rows)
+    else:
+        pairs, group = np.unique(pair, return_inverse=True)
+        n_pairs = len(pairs)
+        rows = np.bincount(group, minlength=n_pairs)
+
+    agg = {spec.keys[0]: pairs // n_j, spec.keys[1]: pairs % n_j}
+    for col in spec.values:
+        values = table.column(col).to_numpy().astype(np.float64, copy=False)[valid]
+        missing = np.isnan(values)
+        if missing.any():
+            sums = np.bincount(group[~missing], weights=values[~missing], minlength=n_pairs)
+            counts = np.bincount(group[~missing], minlength=n_pairs)
+        else:
+            sums = np.bincount(group, weights=values, minlength=n_pairs)
+            counts = rows
+        if len(pairs) < n_pairs:
+            sums = sums[pairs]
+            counts = counts[pairs]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            agg[col] = sums / counts
+
+    return pd.DataFrame(agg), table.num_rows
+
+
+def _agg_input_file(spec, options):
+    """
+    renumbers, aggregates and writes one donor model file
+
+    Returns
+    -------
+    name, rows read, rows written and seconds taken
+    """
+    start_time = time.time()
+    if spec.engine == "numpy":
+        df, n_rows = _pair_means(spec, options)
+    else:
+        df = _read_input_file(spec, options)
+        n_rows = len(df)
+
+        for col in spec.mgra_cols:
+            df[col] = df[col].map(options.mgra_cwk)
+        for col in spec.taz_cols:
+            df[col] = df[col].map(options.taz_cwk)
+
+        if spec.keys is not None:
+            if callable(spec.agg) or isinstance(spec.agg, dict):
+                agg = spec.agg(df.columns) if callable(spec.agg) else spec.agg
+                df = df.groupby(spec.keys).agg(agg).reset_index()
+            else:
+                values = spec.values
+                if values is None:
+                    values = [col for col in df.columns if col not in spec.keys]
+                df = df.groupby(spec.keys)[values].agg(spec.agg).reset_index()
+
+    if spec.dedupe:
+        df = df.drop_duplicates()
+    if spec.order is not None:
+        df = df[spec.order]
+    if spec.post is not None:
+        df = spec.post(df)
+
+    _write_input_file(spec, df, options)
+    return spec.name, n_rows, len(df), time.time() - start_time
+
+
+# module level state of the pool workers, set once per worker by _init_worker
+_worker_options = None
+
+
+def _init_worker(options):
+    global _worker_options
+    _worker_options = options
+
+
+def _agg_input_file_worker(spec):
+    return _agg_input_file(spec, _worker_options)
+
+
+def _source_size(spec, model_dir):
+    """
+    size of the donor file of a spec in bytes, to hand out the largest first
+    """
+    fname = os.path.join(model_dir, spec.folder, spec.file or spec.name)
+    if spec.generate is not None or not os.path.exists(fname):
+        return 0
+    return os.path.getsize(fname)
+
+
 # aggregating input/uec files
 def agg_input_files(
     model_dir = ".", 
@@ -37,7 +483,10 @@ def agg_input_files(
     "TripMatrices.csv", "transponderModelAccessibilities.csv", "crossBorderTours.csv", 
     "internalExternalTrips.csv", "visitorTours.csv", "visitorTrips.csv", "householdAVTrips.csv", 
     "crossBorderTrips.csv", "TNCTrips.csv", "airport_out.SAN.csv", "airport_out.CBX.csv", 
-    "TNCtrips.csv"]
+    "TNCtrips.csv"],
+    skip=(),
+    max_workers=1,
+    specs=None,
     ):
     
     """
@@ -65,6 +514,17 @@ def agg_input_files(
                 "internalExternalTrips.csv", "visitorTours.csv", "visitorTrips.csv", "householdAVTrips.csv",
                 "crossBorderTrips.csv", "TNCTrips.csv", "airport_out.SAN.csv", "airport_out.CBX.csv",
                 "TNCtrips.csv"
+        skip : skip (list, optional)
+            file names or wildcard patterns (e.g. "Trip_*.csv") not to
+            aggregate, whether listed in input_files, required or not
+        max_workers : max_workers (int, optional)
+            number of processes aggregating files in parallel, each worker
+            aggregates whole files.  1 (default) aggregates the files one at a
+            time in this process, None uses all available cores.
+            When called from a script with max_workers other than 1, the script
+            must be guarded by `if __name__ == "__main__":`.
+        specs : specs (list, optional)
+            aggregation rules by file as InputFile, default INPUT_FILES
         
         Returns
         -------
@@ -79,445 +539,61 @@ def agg_input_files(
     mgra_cwk.columns= mgra_cwk.columns.str.strip().str.lower()
     mgra_cwk = dict(zip(mgra_cwk['mgra'], mgra_cwk['cluster_id']))
     
-    taz_zones = int(agg_zones) + int(ext_zones)
-    mgra_zones = int(agg_zones)
-
-    # aggregating microMgraEquivMinutes.csv
-    if "microMgraEquivMinutes.csv" in input_files:
-        logging.info("Aggregating - microMgraEquivMinutes.csv")
-        df_mm_eqmin = pd.read_csv(os.path.join(model_dir, "output", "microMgraEquivMinutes.csv"))
-        df_mm_eqmin['i_new'] = df_mm_eqmin['i'].map(mgra_cwk)
-        df_mm_eqmin['j_new'] = df_mm_eqmin['j'].map(mgra_cwk)
-
-        df_mm_eqmin_agg = df_mm_eqmin.groupby(['i_new', 'j_new'])['walkTime', 'dist', 'mmTime', 'mmCost', 'mtTime', 'mtCost',
-       'mmGenTime', 'mtGenTime', 'minTime'].mean().reset_index()
-
-        df_mm_eqmin_agg = df_mm_eqmin_agg.rename(columns = {'i_new' : 'i', 'j_new' : 'j'})
-        df_mm_eqmin_agg.to_csv(os.path.join(rsm_dir, "input", "microMgraEquivMinutes.csv"), index = False)
-
-    else:
-        raise FileNotFoundError("microMgraEquivMinutes.csv")
-
-
-    # aggregating microMgraTapEquivMinutes.csv"   
-    if "microMgraTapEquivMinutes.csv" in input_files:
-        logging.info("Aggregating - microMgraTapEquivMinutes.csv")
-        df_mm_tap = pd.read_csv(os.path.join(model_dir, "output", "microMgraTapEquivMinutes.csv"))
-        df_mm_tap['mgra'] = df_mm_tap['mgra'].map(mgra_cwk)
-
-        df_mm_tap_agg = df_mm_tap.groupby(['mgra', 'tap'])['walkTime', 'dist', 'mmTime', 'mmCost', 'mtTime',
-       'mtCost', 'mmGenTime', 'mtGenTime', 'minTime'].mean().reset_index()
-
-        df_mm_tap_agg.to_csv(os.path.join(rsm_dir, "input", "microMgraTapEquivMinutes.csv"), index = False)
-
-    else:
-        raise FileNotFoundError("microMgraTapEquivMinutes.csv")
-
-    # aggregating walkMgraTapEquivMinutes.csv
-    if "walkMgraTapEquivMinutes.csv" in input_files:
-        logging.info("Aggregating - walkMgraTapEquivMinutes.csv")
-        df_wlk_mgra_tap = pd.read_csv(os.path.join(model_dir, "output", "walkMgraTapEquivMinutes.csv"))
-        df_wlk_mgra_tap["mgra"] = df_wlk_mgra_tap["mgra"].map(mgra_cwk)
-
-        df_wlk_mgra_agg = df_wlk_mgra_tap.groupby(["mgra", "tap"])["boardingPerceived", "boardingActual","alightingPerceived","alightingActual","boardingGain","alightingGain"].mean().reset_index()
-        df_wlk_mgra_agg.to_csv(os.path.join(rsm_dir, "input", "walkMgraTapEquivMinutes.csv"), index = False)
-
-    else:
-        FileNotFoundError("walkMgraTapEquivMinutes.csv")
-
-    # aggregating walkMgraEquivMinutes.csv
-    if "walkMgraEquivMinutes.csv" in input_files:
-        logging.info("Aggregating - walkMgraEquivMinutes.csv")
-        df_wlk_min = pd.read_csv(os.path.join(model_dir, "output", "walkMgraEquivMinutes.csv"))
-        df_wlk_min["i"] = df_wlk_min["i"].map(mgra_cwk)
-        df_wlk_min["j"] = df_wlk_min["j"].map(mgra_cwk)
-
-        df_wlk_min_agg = df_wlk_min.groupby(["i", "j"])["percieved","actual", "gain"].mean().reset_index()
-
-        df_wlk_min_agg.to_csv(os.path.join(rsm_dir, "input", "walkMgraEquivMinutes.csv"), index = False)
-
-    else:
-        FileNotFoundError("walkMgraEquivMinutes.csv")
-
-    # aggregating biketazlogsum
-    if "bikeTazLogsum.csv" in input_files:
-        logging.info("Aggregating - bikeTazLogsum.csv")
-        bike_taz = pd.read_csv(os.path.join(model_dir, "output", "bikeTazLogsum.csv"))
-
-        bike_taz["i"] = bike_taz["i"].map(dict_clusters)
-        bike_taz["j"] = bike_taz["j"].map(dict_clusters)
-
-        bike_taz_agg = bike_taz.groupby(["i", "j"])["logsum", "time"].mean().reset_index()
-        bike_taz_agg.to_csv(os.path.join(rsm_dir, "input", "bikeTazLogsum.csv"), index = False)
-
-    else:
-        raise FileNotFoundError("bikeTazLogsum.csv")
-
-    # aggregating bikeMgraLogsum.csv
-    if "bikeMgraLogsum.csv" in input_files:
-        logging.info("Aggregating - bikeMgraLogsum.csv")
-        bike_mgra = pd.read_csv(os.path.join(model_dir, "output", "bikeMgraLogsum.csv"))
-        bike_mgra["i"] = bike_mgra["i"].map(mgra_cwk)
-        bike_mgra["j"] = bike_mgra["j"].map(mgra_cwk)
-
-        bike_mgra_agg = bike_mgra.groupby(["i", "j"])["logsum", "time"].mean().reset_index()
-        bike_mgra_agg.to_csv(os.path.join(rsm_dir, "input", "bikeMgraLogsum.csv"), index = False)
-    else:
-        raise FileNotFoundError("bikeMgraLogsum.csv")
-
-    # aggregating zone.term
-    if "zone.term" in input_files:
-        logging.info("Aggregating - zone.term")
-        df_zone_term = pd.read_fwf(os.path.join(model_dir, "input", "zone.term"), header = None)
-        df_zone_term.columns = ["taz", "terminal_time"]
-
-        df_agg = pd.merge(df_zone_term, df_clusters, on = "taz", how = 'left')
-        df_zones_agg = df_agg.groupby(["cluster_id"])['terminal_time'].max().reset_index()
-
-        df_zones_agg.columns = ["taz", "terminal_time"]
-        df_zones_agg.to_fwf(os.path.join(rsm_dir, "input", "zone.term"))
-    
-    else:
-        raise FileNotFoundError("zone.term")
-
-    # aggregating zones.park
-    if "zones.park" in input_files:
-        logging.info("Aggregating - zone.park")
-        df_zones_park = pd.read_fwf(os.path.join(model_dir, "input", "zone.park"), header = None)
-        df_zones_park.columns = ["taz", "park_zones"]
-
-        df_zones_park_agg = pd.merge(df_zones_park, df_clusters, on = "taz", how = 'left')
-        df_zones_park_agg = df_zones_park_agg.groupby(["cluster_id"])['park_zones'].max().reset_index()
-        df_zones_park_agg.columns = ["taz", "park_zones"]
-        df_zones_park_agg.to_fwf(os.path.join(rsm_dir, "input", "zone.park"))
-
-    else:
-        raise FileNotFoundError("zone.park")
-
-
-    # aggregating tap.ptype 
-    if "tap.ptype" in input_files:
-        logging.info("Aggregating - tap.ptype")
-        df_tap_ptype = pd.read_fwf(os.path.join(model_dir, "input", "tap.ptype"), header = None)
-        df_tap_ptype.columns = ["tap", "lot id", "parking type", "taz", "capacity", "distance", "transit mode"]
-
-        df_tap_ptype = pd.merge(df_tap_ptype, df_clusters, on = "taz", how = 'left')
-
-        df_tap_ptype = df_tap_ptype[["tap", "lot id", "parking type", "cluster_id", "capacity", "distance", "transit mode"]]
-        df_tap_ptype = df_tap_ptype.rename(columns = {"cluster_id": "taz"})
-        #df_tap_ptype.to_fwf(os.path.join(rsm_dir, "input", "tap.ptype"))
-
-        widths = [5, 6, 6, 5, 5, 5, 3]
-
-        with open(os.path.join(rsm_dir, "input", "tap.ptype"), 'w') as f:
-            for index, row in df_tap_ptype.iterrows():
-                field1 = str(row[0]).rjust(widths[0])
-                field2 = str(row[1]).rjust(widths[1])
-                field3 = str(row[2]).rjust(widths[2])
-                field4 = str(row[3]).rjust(widths[3])
-                field5 = str(row[4]).rjust(widths[4])
-                field6 = str(row[5]).rjust(widths[5])
-                field7 = str(row[6]).rjust(widths[6])
-                f.write(f'{field1}{field2}{field3}{field4}{field5}{field6}{field7}\n')
-
-    else:
-        raise FileNotFoundError("tap.ptype")
-
-    #aggregating accessam.csv
-    if "accessam.csv" in input_files:
-        logging.info("Aggregating - accessam.csv")
-        df_acc = pd.read_csv(os.path.join(model_dir, "input", "accessam.csv"), header = None)
-        df_acc.columns = ['TAZ', 'TAP', 'TIME', 'DISTANCE', 'MODE']
-
-        df_acc['TAZ'] = df_acc['TAZ'].map(dict_clusters)
-        df_acc_agg = df_acc.groupby(['TAZ', 'TAP', 'MODE'])['TIME', 'DISTANCE'].mean().reset_index()
-        df_acc_agg = df_acc_agg[["TAZ", "TAP", "TIME", "DISTANCE", "MODE"]]
-
-        df_acc_agg.to_csv(os.path.join(rsm_dir, "input", "accessam.csv"), index = False, header =False)
-    else:
-        raise FileNotFoundError("accessam.csv")
-
-    # aggregating ParkLocationAlts.csv
-    if "ParkLocationAlts.csv" in input_files:
-        logging.info("Aggregating - ParkLocationAlts.csv")
-        df_park = pd.read_csv(os.path.join(model_dir, "uec", "ParkLocationAlts.csv"))
-        df_park['mgra_new'] = df_park["mgra"].map(mgra_cwk)
-        df_park_agg = df_park.groupby(["mgra_new"])["parkarea"].min().reset_index() # assuming 1 is "parking" and 2 is "no parking"
-        df_park_agg['a'] = [i+1 for i in range(len(df_park_agg))]
-
-        df_park_agg.columns = ["a", "mgra", "parkarea"]
-        df_park_agg.to_csv(os.path.join(rsm_dir, "uec", "ParkLocationAlts.csv"), index = False)
-
-    else:
-        FileNotFoundError("ParkLocationAlts.csv")
-
-    # aggregating CrossBorderDestinationChoiceSoaAlternatives.csv
-    if "CrossBorderDestinationChoiceSoaAlternatives.csv" in input_files:
-        logging.info("Aggregating - CrossBorderDestinationChoiceSoaAlternatives.csv")
-        df_cb = pd.read_csv(os.path.join(model_dir, "uec","CrossBorderDestinationChoiceSoaAlternatives.csv"))
-
-        df_cb["mgra_entry"] = df_cb["mgra_entry"].map(mgra_cwk)
-        df_cb["mgra_return"] = df_cb["mgra_return"].map(mgra_cwk)
-        df_cb["a"] = df_cb["a"].map(mgra_cwk)
-
-        df_cb = pd.merge(df_cb, df_clusters, left_on = "dest", right_on = "taz", how = 'left')
-        df_cb = df_cb.drop(columns = ["dest", "taz"])
-        df_cb = df_cb.rename(columns = {'cluster_id' : 'dest'})
-
-        df_cb_final  = df_cb.drop_duplicates()
-
-        df_cb_final = df_cb_final[["a", "dest", "poe", "mgra_entry", "mgra_return", "poe_taz"]]
-        df_cb_final.to_csv(os.path.join(rsm_dir, "uec", "CrossBorderDestinationChoiceSoaAlternatives.csv"), index = False)
-
-    else:
-        FileNotFoundError("CrossBorderDestinationChoiceSoaAlternatives.csv")
-
-    # aggregating households.csv
-    if "households.csv" in input_files:
-        logging.info("Aggregating - households.csv")
-        df_hh = pd.read_csv(os.path.join(model_dir, "input", "households.csv"))
-        df_hh["mgra"] = df_hh["mgra"].map(mgra_cwk)
-        df_hh["taz"] = df_hh["taz"].map(dict_clusters)
-
-        df_hh.to_csv(os.path.join(rsm_dir, "input", "households.csv"), index = False)
-
-    else:
-        FileNotFoundError("households.csv")
-
-    # aggregating ShadowPricingOutput_school_9.csv
-    if "ShadowPricingOutput_school_9.csv" in input_files:
-        logging.info("Aggregating - ShadowPricingOutput_school_9.csv")
-        df_sp_sch = pd.read_csv(os.path.join(model_dir, "input", "ShadowPricingOutput_school_9.csv"))
-
-        agg_instructions = {}
-        for col in df_sp_sch.columns:
-            if "size" in col:
-                agg_instructions.update({col: "sum"})
-                
-            if "shadowPrices" in col:
-                agg_instructions.update({col: "max"})
-                
-            if "_origins" in col:
-                agg_instructions.update({col: "sum"})
-                
-            if "_modeledDests" in col:
-                agg_instructions.update({col: "sum"})
-
-        df_sp_sch['mgra'] = df_sp_sch['mgra'].map(mgra_cwk)
-        df_sp_sch_agg = df_sp_sch.groupby(['mgra']).agg(agg_instructions).reset_index()
-
-        alt = list(df_sp_sch_agg['mgra'])
-        df_sp_sch_agg.insert(loc=0, column="alt", value=alt)
-        df_sp_sch_agg.loc[len(df_sp_agg.index)] = 0
-
-        df_sp_sch_agg.to_csv(os.path.join(rsm_dir, "input", "ShadowPricingOutput_school_9.csv"), index=False)
-
-    else:
-        FileNotFoundError("ShadowPricingOutput_school_9.csv")
-
-    # aggregating ShadowPricingOutput_work_9.csv
-    if "ShadowPricingOutput_work_9.csv" in input_files:
-        logging.info("Aggregating - ShadowPricingOutput_work_9.csv")
-        df_sp_wrk = pd.read_csv(os.path.join(model_dir, "input", "ShadowPricingOutput_work_9.csv"))
-
-        agg_instructions = {}
-        for col in df_sp_wrk.columns:
-            if "size" in col:
-                agg_instructions.update({col: "sum"})
-                
-            if "shadowPrices" in col:
-                agg_instructions.update({col: "max"})
-                
-            if "_origins" in col:
-                agg_instructions.update({col: "sum"})
-                
-            if "_modeledDests" in col:
-                agg_instructions.update({col: "sum"})
-
-        df_sp_wrk['mgra'] = df_sp_wrk['mgra'].map(mgra_cwk)
-
-        df_sp_wrk_agg = df_sp_wrk.groupby(['mgra']).agg(agg_instructions).reset_index()
-
-        alt = list(df_sp_wrk_agg['mgra'])
-        df_sp_wrk_agg.insert(loc=0, column="alt", value=alt)
-
-        df_sp_wrk_agg.loc[len(df_sp_wrk_agg.index)] = 0
-
-        df_sp_wrk_agg.to_csv(os.path.join(rsm_dir, "input", "ShadowPricingOutput_work_9.csv"), index=False)
-
-    else:
-        FileNotFoundError("ShadowPricingOutput_work_9.csv")
-        
-    if "TourDcSoaDistanceAlts.csv" in input_files:
-        logging.info("Aggregating - TourDcSoaDistanceAlts.csv")
-        df_TourDcSoaDistanceAlts = pd.DataFrame({"a" : range(1,taz_zones+1), "dest" : range(1, taz_zones+1)})
-        df_TourDcSoaDistanceAlts.to_csv(os.path.join(rsm_dir, "uec", "TourDcSoaDistanceAlts.csv"), index=False)
-        
-    if "DestinationChoiceAlternatives.csv" in input_files:
-        logging.info("Aggregating - DestinationChoiceAlternatives.csv")
-        df_DestinationChoiceAlternatives = pd.DataFrame({"a" : range(1,mgra_zones+1), "mgra" : range(1, mgra_zones+1)})
-        df_DestinationChoiceAlternatives.to_csv(os.path.join(rsm_dir, "uec", "DestinationChoiceAlternatives.csv"), index=False)
-        
-    if "SoaTazDistAlts.csv" in input_files:
-        logging.info("Aggregating - SoaTazDistAlts.csv")
-        df_SoaTazDistAlts = pd.DataFrame({"a" : range(1,taz_zones+1), "dest" : range(1, taz_zones+1)})
-        df_SoaTazDistAlts.to_csv(os.path.join(rsm_dir, "uec", "SoaTazDistAlts.csv"), index=False)
-
-    if "TripMatrices.csv" in input_files:
-        logging.info("Aggregating - TripMatrices.csv")
-        trips = pd.read_csv(os.path.join(model_dir,"output", "TripMatrices.csv"))
-        trips['i'] = trips['i'].map(dict_clusters)
-        trips['j'] = trips['j'].map(dict_clusters)
-
-        cols = list(trips.columns)
-        cols.remove("i")
-        cols.remove("j")
-
-        trips_df = trips.groupby(['i', 'j'])[cols].sum().reset_index()
-        trips_df.to_csv(os.path.join(rsm_dir, "output", "TripMatrices.csv"), index = False)
-
+    options = AggOptions(
+        model_dir,
+        rsm_dir,
+        dict_clusters,
+        mgra_cwk,
+        int(agg_zones) + int(ext_zones),
+        int(agg_zones),
+    )
+
+    if specs is None:
+        specs = INPUT_FILES
+
+    selected = []
+    for spec in specs:
+        if any(fnmatch.fnmatchcase(spec.name, pattern) for pattern in skip):
+            logger.info("Skipping - {}".format(spec.name))
+        elif spec.use == "always" or spec.name in input_files:
+            selected.append(spec)
+        elif spec.use == "required":
+            raise FileNotFoundError(spec.name)
+
+    if max_workers is None:
+        max_workers = multiprocessing.cpu_count()
+    max_workers = max(1, min(int(max_workers), len(selected)))
+
+    start_time = time.time()
+    logger.info(
+        "Aggregating {} input files with {} worker(s)".format(len(selected), max_workers)
+    )
+
+    if max_workers == 1:
+        pool = None
+        results = (_agg_input_file(spec, options) for spec in selected)
     else:
-        FileNotFoundError("TripMatrices.csv")
-
-    if "transponderModelAccessibilities.csv" in input_files:
-        logging.info("Aggregating - transponderModelAccessibilities.csv")
-        tran_access = pd.read_csv(os.path.join(model_dir, "output", "transponderModelAccessibilities.csv"))
-        tran_access['TAZ'] = tran_access['TAZ'].map(dict_clusters)
-
-        tran_access_agg = tran_access.groupby(['TAZ'])['DIST','AVGTTS','PCTDETOUR'].mean().reset_index()
-        tran_access_agg.to_csv(os.path.join(rsm_dir, "output","transponderModelAccessibilities.csv"), index = False)
-
-    else:
-        raise FileNotFoundError("transponderModelAccessibilities.csv")
-
-    if "crossBorderTours.csv" in input_files:
-        logging.info("Aggregating - crossBorderTours.csv")
-        df = pd.read_csv(os.path.join(model_dir, "output", "crossBorderTours.csv"))
-        df['originMGRA'] = df['originMGRA'].map(mgra_cwk)
-        df['destinationMGRA'] = df['destinationMGRA'].map(mgra_cwk)
-
-        df['originTAZ'] = df['originTAZ'].map(dict_clusters)
-        df['destinationTAZ'] = df['destinationTAZ'].map(dict_clusters)
-        df.to_csv(os.path.join(rsm_dir, "output", "crossBorderTours.csv"), index = False)
-
-    else:
-        raise FileNotFoundError("crossBorderTours.csv")
-
-    if "crossBorderTrips.csv" in input_files:
-        logging.info("Aggregating - crossBorderTrips.csv")
-        df = pd.read_csv(os.path.join(model_dir, "output", "crossBorderTrips.csv"))
-        df['originMGRA'] = df['originMGRA'].map(mgra_cwk)
-        df['destinationMGRA'] = df['destinationMGRA'].map(mgra_cwk)
-        
-        df['originTAZ'] = df['originTAZ'].map(dict_clusters)
-        df['destinationTAZ'] = df['destinationTAZ'].map(dict_clusters)
-        df.to_csv(os.path.join(rsm_dir, "output", "crossBorderTrips.csv"), index = False)
-
-    else:
-        raise FileNotFoundError("crossBorderTrips.csv")
-
-    if "internalExternalTrips.csv" in input_files:
-        logging.info("Aggregating - internalExternalTrips.csv")
-        df = pd.read_csv(os.path.join(model_dir, "output", "internalExternalTrips.csv"))
-        df['originMGRA'] = df['originMGRA'].map(mgra_cwk)
-        df['destinationMGRA'] = df['destinationMGRA'].map(mgra_cwk)
-
-        df['originTAZ'] = df['originTAZ'].map(dict_clusters)
-        df['destinationTAZ'] = df['destinationTAZ'].map(dict_clusters)
-        df.to_csv(os.path.join(rsm_dir, "output", "internalExternalTrips.csv"), index = False)
-
-    else:
-        raise FileNotFoundError("internalExternalTrips.csv")
-
-    if "visitorTours.csv" in input_files:
-        logging.info("Aggregating - visitorTours.csv")
-        df = pd.read_csv(os.path.join(model_dir, "output", "visitorTours.csv"))
-        
-        df['originMGRA'] = df['originMGRA'].map(mgra_cwk)
-        df['destinationMGRA'] = df['destinationMGRA'].map(mgra_cwk)
-        
-        df.to_csv(os.path.join(rsm_dir, "output", "visitorTours.csv"), index = False)
-
-    else:
-        raise FileNotFoundError("visitorTours.csv")
-        
-    if "visitorTrips.csv" in input_files:
-        logging.info("Aggregating - visitorTrips.csv")
-        df = pd.read_csv(os.path.join(model_dir, "output", "visitorTrips.csv"))
-        
-        df['originMGRA'] = df['originMGRA'].map(mgra_cwk)
-        df['destinationMGRA'] = df['destinationMGRA'].map(mgra_cwk)
-        
-        df.to_csv(os.path.join(rsm_dir, "output", "visitorTrips.csv"), index = False)
-
-    else:
-        raise FileNotFoundError("visitorTrips.csv")
-
-    if "householdAVTrips.csv" in input_files:
-        logging.info("Aggregating - householdAVTrips.csv")
-        df = pd.read_csv(os.path.join(model_dir, "output", "householdAVTrips.csv"))
-        #print(os.path.join(model_dir, "output", "householdAVTrips.csv"))
-        df['orig_mgra'] = df['orig_mgra'].map(mgra_cwk)
-        df['dest_gra'] = df['dest_gra'].map(mgra_cwk)
-
-        df['trip_orig_mgra'] = df['trip_orig_mgra'].map(mgra_cwk)
-        df['trip_dest_mgra'] = df['trip_dest_mgra'].map(mgra_cwk)
-        df.to_csv(os.path.join(rsm_dir, "output", "householdAVTrips.csv"), index = False)
-
-    else:
-        raise FileNotFoundError("householdAVTrips.csv")
-
-    if "airport_out.CBX.csv" in input_files:
-        logging.info("Aggregating - airport_out.CBX.csv")
-        df = pd.read_csv(os.path.join(model_dir, "output", "airport_out.CBX.csv"))
-        df['originMGRA'] = df['originMGRA'].map(mgra_cwk)
-        df['destinationMGRA'] = df['destinationMGRA'].map(mgra_cwk)
-        
-        df['originTAZ'] = df['originTAZ'].map(dict_clusters)
-        df['destinationTAZ'] = df['destinationTAZ'].map(dict_clusters)
-        df.to_csv(os.path.join(rsm_dir, "output", "airport_out.CBX.csv"), index = False)
-
-    else:
-        raise FileNotFoundError("airport_out.CBX.csv")
-
-    if "airport_out.SAN.csv" in input_files:
-        logging.info("Aggregating - airport_out.SAN.csv")
-        df = pd.read_csv(os.path.join(model_dir, "output", "airport_out.SAN.csv"))
-        df['originMGRA'] = df['originMGRA'].map(mgra_cwk)
-        df['destinationMGRA'] = df['destinationMGRA'].map(mgra_cwk)
-        
-        df['originTAZ'] = df['originTAZ'].map(dict_clusters)
-        df['destinationTAZ'] = df['destinationTAZ'].map(dict_clusters)
-        df.to_csv(os.path.join(rsm_dir, "output", "airport_out.SAN.csv"), index = False)
-
-    else:
-        raise FileNotFoundError("airport_out.SAN.csv")
-
-    if "TNCtrips.csv" in input_files:
-        logging.info("Aggregating - TNCtrips.csv")
-        df = pd.read_csv(os.path.join(model_dir, "output", "TNCtrips.csv"))
-        df['originMgra'] = df['originMgra'].map(mgra_cwk)
-        df['destinationMgra'] = df['destinationMgra'].map(mgra_cwk)
-        
-        df['originTaz'] = df['originTaz'].map(dict_clusters)
-        df['destinationTaz'] = df['destinationTaz'].map(dict_clusters)
-        df.to_csv(os.path.join(rsm_dir, "output", "TNCtrips.csv"), index = False)
-
-    else:
-        raise FileNotFoundError("TNCtrips.csv")
-
-    files = ["Trip" + "_" + i + "_" + j + ".csv" for i, j in
-                itertools.product(["FA", "GO", "IN", "RE", "SV", "TH", "WH"],
-                                   ["OE", "AM", "MD", "PM", "OL"])]
-
-    for file in files:
-        logging.info(f"Aggregating - {file}")
-        df = pd.read_csv(os.path.join(model_dir, "output", file))
-        df['I'] = df['I'].map(dict_clusters)
-        df['J'] = df['J'].map(dict_clusters)
-        df['HomeZone'] = df['HomeZone'].map(dict_clusters)
-        df.to_csv(os.path.join(rsm_dir, "output",file), index = False)
-
-    
-
-    
\ No newline at end of file
+        # largest files first so that no worker is left with a big one at the end
+        selected = sorted(selected, key=lambda spec: -_source_size(spec, model_dir))
+        pool = multiprocessing.Pool(
+            processes=max_workers,
+            initializer=_init_worker,
+            initargs=(options,),
+        )
+        results = pool.imap_unordered(_agg_input_file_worker, selected)
+
+    try:
+        for name, n_rows, n_agg_rows, seconds in results:
+            logger.info(
+                "Aggregated {} ({} rows to {}) in {:.2f} s".format(
+                    name, n_rows, n_agg_rows, seconds
+                )
+            )
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    logger.info(
+        "Aggregated {} input files in {:.2f} s".format(len(selected), time.time() - start_time)
+    )
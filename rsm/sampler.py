@@ -7,6 +7,104 @@ import pandas as pd
 logger = logging.getLogger(__name__)
 
 
+def _sample_households(household_df, sampling_rate, random_seed=42):
+    """
+    Sample households by zone, each zone at its own sampling rate.
+
+    Every household gets a random key, uniform on [0, 1), and is kept when
+    its key falls under the sampling rate of its zone.  All zones are
+    sampled in one vectorized pass, and the sample only depends on the
+    households, the rates and `random_seed`.
+
+    Parameters
+    ----------
+    household_df : household_df (pandas.DataFrame)
+        households with the RSM zone in the "mgra" column
+    sampling_rate : sampling_rate (pandas.Series)
+        sampling rate by RSM zone.  Households in zones without a rate are
+        not sampled.
+    random_seed : random_seed (int)
+
+    Returns
+    -------
+    pandas.DataFrame
+        the sampled households, in the order of household_df
+    """
+    for mgra_id, rate in sampling_rate.items():
+        logger.debug(f"Sampling rate of RSM zone {mgra_id}: {rate}")
+
+    rates = sampling_rate.reindex(household_df["mgra"].to_numpy()).fillna(0).to_numpy()
+    keys = np.random.default_rng(random_seed).random(len(household_df))
+    return household_df[keys < rates]
+
+
+def _filter_persons_chunked(input_person, output_person, sample_hhids, chunksize):
+    """
+    Copy the persons of sampled households from one CSV file to another.
+
+    The input is read `chunksize` rows at a time and each chunk's sampled
+    persons are appended to the output, in input order.  Values are copied
+    as text, so they are written exactly as they appear in the input file.
+
+    Parameters
+    ----------
+    input_person, output_person : input_person, output_person (Path-like)
+    sample_hhids : sample_hhids (array-like)
+        hhid of the sampled households
+    chunksize : chunksize (int)
+        number of person rows read at a time
+
+    Returns
+    -------
+    int
+        number of persons written
+    """
+    sample_hhids = np.unique(np.asarray(sample_hhids, dtype=np.int64))
+    n_persons = 0
+    chunks = pd.read_csv(
+        input_person, chunksize=chunksize, dtype=str, keep_default_na=False
+    )
+    for i, chunk in enumerate(chunks):
+        hhids = chunk["hhid"].to_numpy(dtype=np.int64)
+        found = np.searchsorted(sample_hhids, hhids)
+        keep = found < len(sample_hhids)
+        keep[keep] = sample_hhids[found[keep]] == hhids[keep]
+        chunk.loc[keep].to_csv(
+            output_person, mode="w" if i == 0 else "a", header=i == 0, index=False
+        )
+        n_persons += int(keep.sum())
+    logger.info(f"Wrote {n_persons} sampled persons to {output_person}")
+    return n_persons
+
+
+def _household_weights(sample_households_df, n_hh):
+    """
+    Expansion weights of the sampled households.
+
+    Parameters
+    ----------
+    sample_households_df : sample_households_df (pandas.DataFrame)
+        sampled households with "hhid" and the RSM zone in "mgra"
+    n_hh : n_hh (pandas.Series)
+        number of households by RSM zone before sampling
+
+    Returns
+    -------
+    pandas.DataFrame
+        "hhid" and "weight", the inverse of the realized sampling rate of
+        the household's zone, in the order of sample_households_df
+    """
+    zones = sample_households_df["mgra"]
+    n_sampled = zones.value_counts()
+    realized_rate = (n_sampled / n_hh.reindex(n_sampled.index)).rename("sampling_rate")
+    for mgra_id, rate in realized_rate.items():
+        logger.debug(f"Realized sampling rate of RSM zone {mgra_id}: {rate}")
+    weights = 1.0 / realized_rate.reindex(zones.to_numpy()).to_numpy()
+    return pd.DataFrame(
+        {"hhid": sample_households_df["hhid"].to_numpy(), "weight": weights}
+    )
+
+
 def rsm_household_sampler(
     input_dir=".",
     output_dir=".",
@@ -29,6 +127,8 @@ def rsm_household_sampler(
     random_seed=42,
     output_household="sampled_households.csv",
     output_person="sampled_person.csv",
+    person_chunksize=None,
+    output_household_weights="sampled_household_weights.csv",
 ):
     """
     Take an intelligent sampling of households.
@@ -64,6 +164,17 @@ def rsm_household_sampler(
         Sampling rates by zone will be truncated so they are never lower than this.
     upper_bound_sampling_rate : upper_bound_sampling_rate (float)
         Sampling rates by zone will be truncated so they are never higher than this.
+    person_chunksize : person_chunksize (int, optional)
+        Read a person file in chunks of this many rows, appending the persons of
+        sampled households to the output as each chunk is filtered, so memory
+        does not grow with the size of the person file.  The person rows are
+        then written as they appear in the input file, and sample_persons_df is
+        returned as None.  Default None reads the whole file at once.
+    output_household_weights : output_household_weights (Path-like, optional)
+        Expansion weights of the sampled households ("hhid", "weight") are
+        written here.  The weight is the inverse of the realized sampling rate
+        of the household's RSM zone, i.e. households in the zone over sampled
+        households in the zone.  Set to None to skip writing the weights.
 
     Returns
     -------
@@ -143,17 +254,9 @@ def rsm_household_sampler(
         if study_area is not None:
             mgra_hh.loc[mgra_hh.index.isin(study_area), "sampling_rate"] = 1
 
-        sample_households = []
-
-        for mgra_id, row in mgra_hh.iterrows():
-            df = input_household_df.loc[input_household_df["mgra"] == mgra_id]
-            sampling_rate = row["sampling_rate"]
-            logger.info(f"Sampling rate of RSM zone {mgra_id}: {sampling_rate}")
-            df = df.sample(frac=sampling_rate, random_state=mgra_id + random_seed)
-            sample_households.append(df)
-
-        # combine study are and non-study area households into single dataframe
-        sample_households_df = pd.concat(sample_households)
+        sample_households_df = _sample_households(
+            input_household_df, mgra_hh["sampling_rate"], random_seed
+        )
 
     else:
         # restrict to rows only where TAZs have households
@@ -187,32 +290,45 @@ def rsm_household_sampler(
             wgts, lower_bound_sampling_rate, upper_bound_sampling_rate
         )
 
-        sample_households = []
         sample_rate_df = compare_results[["sampling_rate"]].copy()
         if study_area is not None:
             sample_rate_df.loc[
                 sample_rate_df.index.isin(study_area), "sampling_rate"
             ] = 1
 
-        for mgra_id, row in sample_rate_df.iterrows():
-            df = input_household_df.loc[input_household_df["mgra"] == mgra_id]
-            sampling_rate = row["sampling_rate"]
-            logger.info(f"Sampling rate of RSM zone {mgra_id}: {sampling_rate}")
-            df = df.sample(frac=sampling_rate, random_state=mgra_id + random_seed)
-            sample_households.append(df)
-
-        # combine study are and non-study area households into single dataframe
-        sample_households_df = pd.concat(sample_households)
+        sample_households_df = _sample_households(
+            input_household_df, sample_rate_df["sampling_rate"], random_seed
+        )
 
     sample_households_df = sample_households_df.sort_values(by=["hhid"])
     sample_households_df.to_csv(_resolve_out_filename(output_household), index=False)
 
+    if output_household_weights is not None:
+        household_weights_df = _household_weights(
+            sample_households_df, mgra_hh["n_hh"]
+        )
+        household_weights_df.to_csv(
+            _resolve_out_filename(output_household_weights), index=False
+        )
+
     # select persons belonging to sampled households
     sample_hhids = sample_households_df["hhid"].to_numpy()
 
-    persons_df = _resolve_df(input_person, input_dir)
-    sample_persons_df = persons_df.loc[persons_df["hhid"].isin(sample_hhids)]
-    sample_persons_df.to_csv(_resolve_out_filename(output_person), index=False)
+    if person_chunksize and isinstance(input_person, (str, Path)):
+        input_person = Path(input_person).expanduser()
+        if not input_person.is_absolute():
+            input_person = input_dir.expanduser().joinpath(input_person)
+        _filter_persons_chunked(
+            input_person,
+            _resolve_out_filename(output_person),
+            sample_hhids,
+            person_chunksize,
+        )
+        sample_persons_df = None
+    else:
+        persons_df = _resolve_df(input_person, input_dir)
+        sample_persons_df = persons_df.loc[persons_df["hhid"].isin(sample_hhids)]
+        sample_persons_df.to_csv(_resolve_out_filename(output_person), index=False)
 
     global_sample_rate = round(len(sample_households_df) / len(input_household_df),2)
     logger.info(f"Total Sampling Rate : {global_sample_rate}")
@@ -0,0 +1,208 @@
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+
+from rsm.assembler import (
+    _cache_chunks,
+    _count_trips,
+    _donor_cache_file,
+    _household_zones,
+    _isin_sorted,
+    _read_donor_trips,
+    _trip_changes_by_zone,
+)
+
+
+def _trips(n_hh=500, n_trips=5000, seed=0):
+    rng = np.random.default_rng(seed)
+    households = pd.DataFrame(
+        {"hhid": np.arange(1, n_hh + 1), "mgra": rng.integers(1, 30, n_hh)}
+    )
+    indiv = pd.DataFrame(
+        {
+            "hh_id": rng.integers(1, n_hh + 1, n_trips),
+            "tour_id": rng.integers(0, 4, n_trips),
+            "orig_mgra": rng.integers(1, 30, n_trips),
+            "dest_mgra": rng.integers(1, 30, n_trips),
+            "trip_mode": rng.integers(1, 14, n_trips),
+        }
+    )
+    joint = indiv.sample(n_trips // 10, random_state=seed).assign(
+        num_participants=rng.integers(2, 6, n_trips // 10)
+    )
+    return households, indiv, joint
+
+
+def _old_trip_changes(orig_indiv, orig_joint, rsm_indiv, rsm_joint, households):
+    """
+    trip changes by home zone and mode, as computed by the original pandas
+    implementation of rsm_assemble
+    """
+
+    def _merge_joint_and_indiv_trips(indiv_trips, joint_trips):
+        joint_trips = joint_trips[["hh_id", "tour_id", "num_participants", "trip_mode"]]
+        joint_trips = joint_trips.reindex(
+            joint_trips.index.repeat(joint_trips.num_participants)
+        ).reset_index(drop=True)
+        joint_trips = joint_trips.drop(columns=["num_participants"])
+        indiv_trips = indiv_trips[["hh_id", "tour_id", "trip_mode"]]
+        return pd.concat([joint_trips, indiv_trips], ignore_index=True)
+
+    def _agg_by_hhid_and_tripmode(df, name):
+        return df.groupby(["hh_id", "trip_mode"]).size().rename(name).reset_index()
+
+    rsm_trips = _merge_joint_and_indiv_trips(rsm_indiv, rsm_joint)
+    original_trips = _merge_joint_and_indiv_trips(orig_indiv, orig_joint)
+    hh_ids_rsm = rsm_trips["hh_id"].unique()
+    combined_trips = pd.merge(
+        _agg_by_hhid_and_tripmode(
+            original_trips.loc[original_trips["hh_id"].isin(hh_ids_rsm)],
+            "n_trips_orig",
+        ),
+        _agg_by_hhid_and_tripmode(rsm_trips, "n_trips_rsm"),
+        on=["hh_id", "trip_mode"],
+        how="outer",
+        sort=True,
+    ).fillna(0)
+    combined_trips = pd.merge(
+        combined_trips, households, left_on="hh_id", right_on="hhid", how="left"
+    )
+    by_zone = (
+        combined_trips.groupby(["mgra", "trip_mode"])[["n_trips_orig", "n_trips_rsm"]]
+        .sum()
+        .reset_index()
+    )
+    by_zone["net_change"] = by_zone.n_trips_rsm - by_zone.n_trips_orig
+    by_zone["pct_change"] = (
+        by_zone.net_change / np.fmax(by_zone.n_trips_rsm, by_zone.n_trips_orig) * 100
+    )
+    return by_zone
+
+
+@pytest.mark.parametrize(
+    "sorted_ids",
+    [np.array([], dtype=np.int64), np.array([5]), np.array([-3, 0, 2, 7, 8, 1000])],
+)
+def test_isin_sorted_matches_isin(sorted_ids):
+    values = np.random.default_rng(0).integers(-10, 1010, 5000)
+    values[:3] = [-10, 1009, 1000]
+
+    np.testing.assert_array_equal(
+        _isin_sorted(values, sorted_ids), pd.Series(values).isin(sorted_ids).to_numpy()
+    )
+
+
+def test_trip_changes_match_pandas_groupby(tmp_path):
+    households, orig_indiv, orig_joint = _trips(seed=0)
+    _, rsm_indiv, rsm_joint = _trips(seed=1)
+    # only part of the households are resimulated
+    rsm_indiv = rsm_indiv.loc[rsm_indiv["hh_id"] % 3 == 0]
+    rsm_joint = rsm_joint.loc[rsm_joint["hh_id"] % 3 == 0]
+    households.to_csv(tmp_path / "households.csv", index=False)
+    household_zones = _household_zones(tmp_path / "households.csv")
+
+    hh_ids_rsm = np.unique(np.r_[rsm_indiv["hh_id"], rsm_joint["hh_id"]])
+    orig_counts = rsm_counts = None
+    for trips, joint in ((orig_indiv, False), (orig_joint, True)):
+        resimulated = _isin_sorted(trips["hh_id"].to_numpy(), hh_ids_rsm)
+        orig_counts = _count_trips(
+            trips.loc[resimulated], household_zones, orig_counts, joint=joint
+        )
+    # in chunks, as when the trips are streamed
+    for start in range(0, len(rsm_indiv), 300):
+        chunk = rsm_indiv.iloc[start : start + 300]
+        rsm_counts = _count_trips(chunk, household_zones, rsm_counts)
+    rsm_counts = _count_trips(rsm_joint, household_zones, rsm_counts, joint=True)
+
+    result = _trip_changes_by_zone(orig_counts, rsm_counts, household_zones)
+
+    expected = _old_trip_changes(orig_indiv, orig_joint, rsm_indiv, rsm_joint, households)
+    pd.testing.assert_frame_equal(
+        result.sort_values(["mgra", "trip_mode"]).reset_index(drop=True),
+        expected,
+        check_dtype=False,
+    )
+
+
+def test_donor_cache_matches_csv(tmp_path, caplog):
+    _, indiv, _ = _trips()
+    trips_file = tmp_path / "indivTripData_1.csv"
+    indiv.to_csv(trips_file, index=False)
+    mgra_crosswalk = tmp_path / "mgra_crosswalk.csv"
+    pd.DataFrame({"MGRA": range(1, 30), "cluster_id": np.arange(29) // 4 + 1}).to_csv(
+        mgra_crosswalk, index=False
+    )
+    cache_dir = tmp_path / "cache"
+
+    expected = _read_donor_trips(trips_file, mgra_crosswalk)
+    created = _read_donor_trips(trips_file, mgra_crosswalk, cache_dir=cache_dir)
+    cache_file = _donor_cache_file(trips_file, mgra_crosswalk, cache_dir)
+    with caplog.at_level("INFO", logger="rsm.assembler"):
+        reused = _read_donor_trips(trips_file, mgra_crosswalk, cache_dir=cache_dir)
+
+    assert f"from cache {cache_file}" in caplog.text
+    for trips in (created, reused):
+        pd.testing.assert_frame_equal(trips, expected, check_dtype=False)
+
+    # a changed trip file gets a new cache, and the stale one is removed
+    indiv.iloc[::2].to_csv(trips_file, index=False)
+    changed = _read_donor_trips(trips_file, mgra_crosswalk, cache_dir=cache_dir)
+    assert len(changed) == len(indiv.iloc[::2])
+    assert list(cache_dir.iterdir()) == [
+        _donor_cache_file(trips_file, mgra_crosswalk, cache_dir)
+    ]
+    assert not cache_file.exists()
+
+
+def _mixed_trips_file(tmp_path):
+    """
+    trips whose chunks of 3 rows have different dtypes: small then large
+    ids, a zone column with missing values in the second chunk only and a
+    string column that is all missing in the first chunk
+    """
+    trips = pd.DataFrame(
+        {
+            "hh_id": [1, 1, 2, 3, 4, 70000, 70001, 5000000000, 5000000001],
+            "orig_mgra": [10, 11, 12, 13, np.nan, 15, 16, 17, 18],
+            "tour_purpose": [None, None, None]
+            + ["Work", "Shop", "Work"]
+            + ["Work", None, "Escort"],
+            "trip_mode": [1, 2, 3, 1, 2, 3, 1, 2, 3],
+            "value_of_time": [1.5, 2.5, 3.5, 4.5, 5.5, 6.5, 7.5, 8.5, 9.5],
+        }
+    )
+    trips_file = tmp_path / "indivTripData_3.csv"
+    trips.to_csv(trips_file, index=False)
+    return trips_file
+
+
+def test_cache_chunks_casts_chunks_to_one_schema(tmp_path):
+    trips_file = _mixed_trips_file(tmp_path)
+    cache_file = _donor_cache_file(trips_file, None, tmp_path / "streamed")
+
+    chunks = pd.read_csv(trips_file, chunksize=3)
+    chunks = list(_cache_chunks(chunks, trips_file, cache_file))
+    # the chunks are passed on unchanged
+    for chunk, expected in zip(chunks, pd.read_csv(trips_file, chunksize=3)):
+        pd.testing.assert_frame_equal(chunk, expected)
+    assert cache_file.exists()
+    assert list(cache_file.parent.iterdir()) == [cache_file]
+
+    # the streamed cache has the schema and values of the whole-file cache
+    whole_cache_dir = tmp_path / "whole"
+    _read_donor_trips(trips_file, cache_dir=whole_cache_dir)
+    whole_file = _donor_cache_file(trips_file, None, whole_cache_dir)
+    streamed = pq.read_table(cache_file)
+    whole = pq.read_table(whole_file)
+    assert streamed.schema.equals(whole.schema.remove_metadata())
+
+    streamed_trips = pd.read_parquet(cache_file)
+    whole_trips = pd.read_parquet(whole_file)
+    assert (streamed_trips.dtypes == whole_trips.dtypes).all()
+    pd.testing.assert_frame_equal(streamed_trips, whole_trips, check_categorical=False)
+    pd.testing.assert_frame_equal(
+        streamed_trips.astype({"tour_purpose": object}),
+        pd.read_csv(trips_file).astype({"tour_purpose": object}),
+        check_dtype=False,
+    )
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from rsm.input_agg import AggOptions, InputFile, _pair_means
+
+
+def _pair_file(tmp_path, n_rows=20000, n_mgra=300, seed=0):
+    rng = np.random.default_rng(seed)
+    pairs = pd.DataFrame(
+        {
+            "i": rng.integers(1, n_mgra + 1, n_rows),
+            "j": rng.integers(1, n_mgra + 1, n_rows),
+            "logsum": rng.normal(size=n_rows),
+            "time": rng.random(n_rows) * 30,
+        }
+    )
+    pairs.loc[rng.random(n_rows) < 0.1, "logsum"] = np.nan
+    (tmp_path / "output").mkdir()
+    pairs.to_csv(tmp_path / "output" / "bikeMgraLogsum.csv", index=False)
+    return pairs
+
+
+@pytest.mark.parametrize(
+    "first_zone",
+    [
+        # dense pair keys, counted with bincount directly
+        1,
+        # sparse pair keys, counted over np.unique
+        10**6,
+    ],
+)
+def test_pair_means_match_groupby_mean(tmp_path, caplog, first_zone):
+    pairs = _pair_file(tmp_path)
+    rng = np.random.default_rng(1)
+    # mgras 1 to 290 are in the crosswalk, the rows of the others are dropped
+    mgra_cwk = dict(
+        zip(range(1, 291), first_zone + rng.integers(0, 40, 290) * (first_zone // 10 + 1))
+    )
+    spec = InputFile(
+        "bikeMgraLogsum.csv", "output", out_folder="input",
+        mgra_cols=("i", "j"), keys=["i", "j"], values=["logsum", "time"],
+        engine="numpy",
+    )
+    options = AggOptions(str(tmp_path), str(tmp_path), {}, mgra_cwk, None, None)
+
+    with caplog.at_level("WARNING", logger="rsm.input_agg"):
+        result, n_rows = _pair_means(spec, options)
+
+    expected = pairs.assign(i=pairs["i"].map(mgra_cwk), j=pairs["j"].map(mgra_cwk))
+    expected = expected.groupby(["i", "j"])[["logsum", "time"]].mean().reset_index()
+    assert n_rows == len(pairs)
+    n_dropped = (~(pairs["i"].isin(mgra_cwk) & pairs["j"].isin(mgra_cwk))).sum()
+    assert f"dropped {n_dropped} of {len(pairs)} rows" in caplog.text
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False, rtol=1e-13)
@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from rsm.sampler import (
+    _filter_persons_chunked,
+    _household_weights,
+    _sample_households,
+    rsm_household_sampler,
+)
+
+
+def _households(n_zones=20, n_hh=20000, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            "hhid": rng.permutation(n_hh) + 1,
+            "mgra": rng.integers(1, n_zones + 1, n_hh),
+            "taz": rng.integers(1, 5, n_hh),
+        }
+    )
+
+
+def _persons(households, seed=0):
+    rng = np.random.default_rng(seed)
+    hhids = np.repeat(households["hhid"].to_numpy(), rng.integers(1, 5, len(households)))
+    return pd.DataFrame(
+        {
+            "hhid": hhids,
+            "perid": np.arange(len(hhids)) + 1,
+            # written as text, e.g. "0.50", and read back as is
+            "value_of_time": [f"{v:.2f}" for v in rng.random(len(hhids))],
+            "occupation": rng.choice(["", "Sales", "Office"], len(hhids)),
+        }
+    )
+
+
+def test_sample_households_matches_zone_rates():
+    households = _households()
+    rates = pd.Series(np.linspace(0.1, 0.9, 18), index=np.arange(1, 19))
+    rates[1] = 1.0
+    rates[2] = 0.0
+    # zones 19 and 20 have no rate
+
+    sample = _sample_households(households, rates, random_seed=7)
+
+    assert sample.index.is_monotonic_increasing
+    pd.testing.assert_frame_equal(sample, _sample_households(households, rates, 7))
+    n_hh = households["mgra"].value_counts()
+    n_sampled = sample["mgra"].value_counts().reindex(n_hh.index, fill_value=0)
+    assert n_sampled[1] == n_hh[1]
+    assert n_sampled[[2, 19, 20]].sum() == 0
+    # the original per zone df.sample(frac=rate) drew round(rate * n_hh), the
+    # vectorized sample is binomial around it
+    for zone, rate in rates.items():
+        expected = (
+            households.loc[households["mgra"] == zone]
+            .sample(frac=rate, random_state=zone + 7)
+            .shape[0]
+        )
+        sd = np.sqrt(n_hh[zone] * rate * (1 - rate))
+        assert abs(n_sampled[zone] - expected) <= 4 * sd + 1
+
+
+@pytest.mark.parametrize("chunksize", [1, 7, 1000, 100000])
+def test_filter_persons_chunked_matches_isin(tmp_path, chunksize):
+    households = _households(n_hh=200)
+    persons = _persons(households)
+    persons.to_csv(tmp_path / "persons.csv", index=False)
+    # no sampled household in the first persons, and one household that
+    # has no persons
+    sample_hhids = np.r_[
+        households["hhid"].to_numpy()[10::3], households["hhid"].max() + 1
+    ]
+    sample_hhids = sample_hhids[~np.isin(sample_hhids, persons["hhid"][:20])]
+
+    n_persons = _filter_persons_chunked(
+        tmp_path / "persons.csv", tmp_path / "sampled.csv", sample_hhids, chunksize
+    )
+
+    persons = pd.read_csv(tmp_path / "persons.csv", dtype=str, keep_default_na=False)
+    expected = persons.loc[persons["hhid"].astype(int).isin(sample_hhids)]
+    sampled = pd.read_csv(tmp_path / "sampled.csv", dtype=str, keep_default_na=False)
+    assert n_persons == len(expected)
+    pd.testing.assert_frame_equal(sampled, expected.reset_index(drop=True))
+
+
+def test_household_weights_match_groupby():
+    households = _households()
+    rates = pd.Series(0.3, index=np.arange(1, 21))
+    sample = _sample_households(households, rates).sort_values("hhid")
+    n_hh = households.groupby("mgra").size()
+
+    weights = _household_weights(sample, n_hh)
+
+    expected = n_hh[sample["mgra"]].to_numpy() / sample.groupby("mgra")[
+        "hhid"
+    ].transform("size").to_numpy()
+    np.testing.assert_array_equal(weights["hhid"], sample["hhid"])
+    np.testing.assert_allclose(weights["weight"], expected, rtol=1e-15)
+    # the weights expand the sample back to the households of every zone
+    np.testing.assert_allclose(
+        weights.groupby(sample["mgra"].to_numpy())["weight"].sum(), n_hh, rtol=1e-12
+    )
+
+
+def test_sampler_person_chunks_match_whole_file(tmp_path):
+    households = _households(n_hh=3000)
+    households.to_csv(tmp_path / "households.csv", index=False)
+    _persons(households).to_csv(tmp_path / "persons.csv", index=False)
+    pd.DataFrame({"taz": range(1, 5), "cluster_id": [1, 1, 2, 2]}).to_csv(
+        tmp_path / "taz_crosswalk.csv", index=False
+    )
+    pd.DataFrame({"mgra": range(1, 21), "cluster_id": np.arange(20) // 2 + 1}).to_csv(
+        tmp_path / "mgra_crosswalk.csv", index=False
+    )
+
+    outputs = {}
+    for person_chunksize in (None, 500):
+        output_dir = tmp_path / f"chunks_{person_chunksize}"
+        sample_households_df, _ = rsm_household_sampler(
+            input_dir=tmp_path,
+            output_dir=output_dir,
+            study_area=[1],
+            person_chunksize=person_chunksize,
+        )
+        outputs[person_chunksize] = (
+            sample_households_df,
+            pd.read_csv(output_dir / "sampled_person.csv"),
+        )
+
+    pd.testing.assert_frame_equal(outputs[None][0], outputs[500][0])
+    pd.testing.assert_frame_equal(outputs[None][1], outputs[500][1])
+    assert (outputs[500][0]["mgra"] == 1).sum() == (
+        households["mgra"].isin([1, 2])
+    ).sum()
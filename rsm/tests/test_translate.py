@@ -0,0 +1,194 @@
+import numpy as np
+import openmatrix as omx
+import pandas as pd
+import pytest
+
+from rsm.translate import _aggregate_matrix, _zone_operator, translate_omx_demand
+
+
+def _groupby_aggregate(input_mtx, zone_mapping):
+    """
+    sum by aggregated zone pair with a pandas groupby over the stacked cells,
+    as in the original implementation of _aggregate_matrix
+    """
+    agg_zones = np.array(list(zone_mapping.values()))
+    n_zones = len(agg_zones)
+    cells = pd.DataFrame(
+        {
+            "orig": np.repeat(agg_zones, n_zones),
+            "dest": np.tile(agg_zones, n_zones),
+            "value": np.asarray(input_mtx).ravel(),
+        }
+    )
+    return cells.groupby(["orig", "dest"])["value"].sum().unstack().to_numpy()
+
+
+def _groupby_skim(input_mtx, zone_mapping, rule, weight_mtx=None, intrazonal=None):
+    """
+    skim aggregated by zone pair with a pandas groupby over the stacked
+    cells, skipping missing values
+    """
+    agg_zones = np.array(list(zone_mapping.values()))
+    n_zones = len(agg_zones)
+    cells = pd.DataFrame(
+        {
+            "orig": np.repeat(agg_zones, n_zones),
+            "dest": np.tile(agg_zones, n_zones),
+            "value": np.asarray(input_mtx, dtype=np.float64).ravel(),
+            "intrazonal": np.eye(n_zones, dtype=bool).ravel(),
+        }
+    )
+    if weight_mtx is not None:
+        cells["weight"] = np.asarray(weight_mtx, dtype=np.float64).ravel()
+    if intrazonal == "exclude":
+        # aggregated zones of one original zone keep their intrazonal cell
+        size = pd.Series(agg_zones).value_counts()
+        single = cells["orig"].map(size).eq(1) & (cells["orig"] == cells["dest"])
+        cells = cells.loc[~cells["intrazonal"] | single]
+    cells = cells.dropna(subset=["value"])
+    grouped = cells.groupby(["orig", "dest"])
+    if rule == "weighted_mean":
+        weighted = cells.assign(value=cells["value"] * cells["weight"])
+        weighted = weighted.groupby(["orig", "dest"])[["value", "weight"]].sum()
+        result = weighted["value"] / weighted["weight"]
+        result = result.where(weighted["weight"] > 0, grouped["value"].mean())
+    else:
+        result = grouped["value"].agg(rule)
+    all_zones = np.unique(agg_zones)
+    result = result.unstack().reindex(index=all_zones, columns=all_zones)
+    result = result.to_numpy(copy=True)
+    if intrazonal == "half_nearest":
+        other_cells = result.copy()
+        np.fill_diagonal(other_cells, np.nan)
+        nearest = np.nanmin(other_cells, axis=1)
+        diagonal = np.arange(len(all_zones))
+        result[diagonal, diagonal] = np.where(
+            np.isnan(nearest), result[diagonal, diagonal], 0.5 * nearest
+        )
+    return result
+
+
+def _demand(n_zones=300, n_agg_zones=37, dtype=np.float32, seed=0):
+    rng = np.random.default_rng(seed)
+    zone_mapping = dict(
+        zip(range(1, n_zones + 1), rng.integers(1, n_agg_zones + 1, n_zones) * 10)
+    )
+    # mostly small trip fractions with a few large cells, like person trips
+    demand = rng.exponential(0.05, (n_zones, n_zones))
+    demand[rng.random((n_zones, n_zones)) < 0.001] *= 1e4
+    return demand.astype(dtype), zone_mapping
+
+
+# float32 output is within one rounding of the float64 sum, float64 output
+# within a few ulps of a sum in a different order
+TOLERANCE = {np.float32: 2**-23, np.float64: 1e-13}
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+@pytest.mark.parametrize("block_rows", [None, 1, 7, 64])
+def test_aggregate_matrix_sum_matches_groupby(dtype, block_rows):
+    demand, zone_mapping = _demand(dtype=dtype)
+    expected = _groupby_aggregate(demand.astype(np.float64), zone_mapping)
+
+    result = _aggregate_matrix(demand, zone_mapping, block_rows=block_rows)
+
+    assert result.dtype == dtype
+    np.testing.assert_allclose(result, expected, rtol=TOLERANCE[dtype], atol=0)
+
+
+def test_aggregate_matrix_sum_of_integers_is_exact():
+    demand, zone_mapping = _demand(dtype=np.float64)
+    demand = (demand * 100).astype(np.int32)
+
+    result = _aggregate_matrix(demand, zone_mapping, block_rows=10)
+
+    assert result.dtype == np.int32
+    np.testing.assert_array_equal(result, _groupby_aggregate(demand, zone_mapping))
+
+
+@pytest.mark.parametrize("rule", ["sum", "mean", "weighted_mean", "min", "max"])
+def test_aggregate_matrix_does_not_depend_on_block_rows(rule):
+    demand, zone_mapping = _demand(n_zones=120, n_agg_zones=13)
+    demand[3, :40] = np.nan
+    weights, _ = _demand(n_zones=120, seed=1)
+    zone_operator = _zone_operator(zone_mapping)
+
+    results = [
+        _aggregate_matrix(
+            demand, zone_operator, rule=rule, weight_mtx=weights, block_rows=block_rows
+        )
+        for block_rows in (None, 1, 5, 50)
+    ]
+
+    for result in results[1:]:
+        np.testing.assert_allclose(result, results[0], rtol=2**-23, atol=0)
+
+
+def test_translate_omx_demand_matches_groupby(tmp_path):
+    demand, zone_mapping = _demand(n_zones=80, n_agg_zones=9)
+    pd.DataFrame(
+        {"taz": list(zone_mapping.keys()), "cluster_id": list(zone_mapping.values())}
+    ).to_csv(tmp_path / "taz_crosswalk.csv", index=False)
+    input_dir = tmp_path / "input"
+    output_dir = tmp_path / "output"
+    input_dir.mkdir()
+    output_dir.mkdir()
+    with omx.open_file(str(input_dir / "trip_AM.omx"), "w") as f:
+        f["SOV_GP_AM"] = demand
+        f["TRK_AM"] = demand[::-1].copy()
+        f.create_mapping("zone_number", list(zone_mapping.keys()))
+
+    translate_omx_demand(
+        ["trip_AM"],
+        tmp_path / "taz_crosswalk.csv",
+        input_dir=str(input_dir),
+        output_dir=str(output_dir),
+        block_rows=16,
+    )
+
+    with omx.open_file(str(output_dir / "trip_AM.omx")) as f:
+        assert f.mapping("zone_number") == dict(
+            (zone, i) for i, zone in enumerate(sorted(set(zone_mapping.values())))
+        )
+        for core, matrix in (("SOV_GP_AM", demand), ("TRK_AM", demand[::-1])):
+            expected = _groupby_aggregate(matrix.astype(np.float64), zone_mapping)
+            np.testing.assert_allclose(f[core].read(), expected, rtol=2**-23, atol=0)
+
+
+def _skim(n_zones=120, n_agg_zones=13, seed=0):
+    """
+    float32 travel times with missing cells, and weights that are all zero
+    for some aggregated zone pairs
+    """
+    rng = np.random.default_rng(seed)
+    zone_mapping = dict(
+        zip(range(1, n_zones + 1), rng.integers(1, n_agg_zones + 1, n_zones))
+    )
+    # one aggregated zone made of a single original zone
+    zone_mapping[n_zones] = n_agg_zones + 1
+    skim = (rng.random((n_zones, n_zones)) * 60 + 1).astype(np.float32)
+    skim[rng.random((n_zones, n_zones)) < 0.05] = np.nan
+    skim[:, 7] = np.nan
+    weights = rng.exponential(1.0, (n_zones, n_zones))
+    agg_zones = np.array(list(zone_mapping.values()))
+    weights[np.ix_(agg_zones == 1, agg_zones == 2)] = 0
+    return skim, weights, zone_mapping
+
+
+@pytest.mark.parametrize("intrazonal", [None, "exclude", "half_nearest"])
+@pytest.mark.parametrize("rule", ["mean", "weighted_mean", "min", "max"])
+def test_aggregate_matrix_skim_rules_match_groupby(rule, intrazonal):
+    skim, weights, zone_mapping = _skim()
+    expected = _groupby_skim(skim, zone_mapping, rule, weights, intrazonal)
+
+    result = _aggregate_matrix(
+        skim,
+        zone_mapping,
+        rule=rule,
+        weight_mtx=weights,
+        intrazonal=intrazonal,
+        block_rows=17,
+    )
+
+    assert result.dtype == np.float32
+    np.testing.assert_allclose(result, expected, rtol=2**-23, atol=0)
@@ -0,0 +1,261 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from rsm.utility import (
+    PropertiesFile,
+    ReplacementOfString,
+    buffer_densities,
+    get_property,
+    load_properties,
+    nearest_mgra,
+    set_property,
+)
+
+
+def _old_nearest_mgra(x, y, mgra_nodes):
+    """
+    nearest MGRA node of every point by the distance to all nodes, as in the
+    original implementation of add_intersection_count
+    """
+    near = []
+    for point_x, point_y in zip(x, y):
+        dist = np.sqrt((point_x - mgra_nodes["x"]) ** 2 + (point_y - mgra_nodes["y"]) ** 2)
+        near.append(mgra_nodes.loc[dist == dist.min()]["mgra"].values[0])
+    return np.array(near)
+
+
+def _mgra_nodes(n_nodes=400, seed=0):
+    rng = np.random.default_rng(seed)
+    # nodes on a coarse grid, so that many points are equally near to several
+    nodes = pd.DataFrame(
+        {
+            "mgra": rng.permutation(n_nodes) + 1,
+            "x": rng.integers(0, 30, n_nodes) * 100.0,
+            "y": rng.integers(0, 30, n_nodes) * 100.0,
+        }
+    )
+    return nodes
+
+
+@pytest.mark.parametrize("k", [1, 2, 8])
+def test_nearest_mgra_matches_all_node_distances(k):
+    rng = np.random.default_rng(1)
+    mgra_nodes = _mgra_nodes()
+    # random points, points halfway between grid nodes and points on nodes
+    x = np.r_[rng.random(300) * 3000, rng.integers(0, 60, 300) * 50.0, mgra_nodes["x"][:50]]
+    y = np.r_[rng.random(300) * 3000, rng.integers(0, 60, 300) * 50.0, mgra_nodes["y"][:50]]
+
+    near = nearest_mgra(x, y, mgra_nodes, k=k)
+
+    assert near.dtype == mgra_nodes["mgra"].dtype
+    np.testing.assert_array_equal(near, _old_nearest_mgra(x, y, mgra_nodes))
+
+
+def test_nearest_mgra_of_points_without_coordinates():
+    mgra_nodes = _mgra_nodes(n_nodes=50)
+    x = np.array([150.0, np.nan, 820.0])
+    y = np.array([260.0, 100.0, np.nan])
+
+    near = nearest_mgra(x, y, mgra_nodes)
+
+    assert np.isnan(near[1:]).all()
+    assert near[0] == _old_nearest_mgra(x[:1], y[:1], mgra_nodes)[0]
+    assert np.isnan(nearest_mgra(x, y, mgra_nodes.iloc[:0])).all()
+
+
+def _old_buffer_densities(mgra_data, equiv_min, int_radius=0.65, oth_radius=0.65):
+    """
+    density variables by MGRA, one buffer at a time, as in the original
+    implementation of add_density_variables
+    """
+
+    def _density_function(mgra_in):
+        eqmn = equiv_min[equiv_min["i"] == mgra_in]
+        mgra_circa_int = eqmn[eqmn["dist"] < int_radius]["j"].unique()
+        mgra_circa_oth = eqmn[eqmn["dist"] < oth_radius]["j"].unique()
+        in_oth = mgra_data[mgra_data.mgra.isin(mgra_circa_oth)]
+        tot_emp = in_oth["emp_total"].sum()
+        tot_ret = (
+            in_oth["emp_retail"].sum()
+            + in_oth["emp_personal_svcs_retail"].sum()
+            + in_oth["emp_restaurant_bar"].sum()
+        )
+        tot_hh = in_oth["hh"].sum()
+        tot_pop = in_oth["pop"].sum()
+        tot_acres = in_oth["land_acres"].sum()
+        tot_int = mgra_data[mgra_data.mgra.isin(mgra_circa_int)]["icnt"].sum()
+        if tot_acres > 0:
+            return (
+                tot_int,
+                tot_hh / tot_acres,
+                tot_emp / tot_acres,
+                tot_pop / tot_acres,
+                tot_ret / tot_acres,
+                (tot_emp + tot_pop) / (tot_acres / 640),
+            )
+        return 0, 0, 0, 0, 0, 0
+
+    columns = ["totint", "duden", "empden", "popden", "retempden", "PopEmpDenPerMi"]
+    return pd.DataFrame(
+        list(mgra_data["mgra"].map(_density_function)),
+        columns=columns,
+        index=mgra_data.index,
+    ).fillna(0)
+
+
+def _mgra_data(n_mgra=150, seed=0):
+    rng = np.random.default_rng(seed)
+    columns = ["emp_total", "emp_retail", "emp_personal_svcs_retail"]
+    columns += ["emp_restaurant_bar", "hh", "pop", "icnt"]
+    mgra_data = pd.DataFrame(
+        rng.integers(0, 500, (n_mgra, len(columns))).astype(float), columns=columns
+    )
+    mgra_data.insert(0, "mgra", np.arange(1, n_mgra + 1))
+    mgra_data["land_acres"] = rng.random(n_mgra) * 20
+    # mgras without land, and missing values as left by the intersection merge
+    mgra_data.loc[::10, "land_acres"] = 0
+    mgra_data.loc[5::17, "icnt"] = np.nan
+    mgra_data.loc[3::23, "emp_retail"] = np.nan
+    # an mgra on two rows counts both
+    mgra_data = pd.concat([mgra_data, mgra_data.iloc[[7]]], ignore_index=True)
+
+    n_pairs = n_mgra * 30
+    equiv_min = pd.DataFrame(
+        {
+            # a few pairs repeated, and pairs of mgras missing from the data
+            "i": rng.integers(1, n_mgra + 5, n_pairs),
+            "j": rng.integers(1, n_mgra + 5, n_pairs),
+            "dist": rng.random(n_pairs),
+        }
+    )
+    return mgra_data, equiv_min
+
+
+@pytest.mark.parametrize("radius", [(0.65, 0.65), (0.4, 0.8)])
+def test_buffer_densities_match_buffer_by_buffer(radius):
+    mgra_data, equiv_min = _mgra_data()
+    int_radius, oth_radius = radius
+
+    result = buffer_densities(mgra_data, equiv_min, "pop", int_radius, oth_radius)
+
+    expected = _old_buffer_densities(mgra_data, equiv_min, int_radius, oth_radius)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False, rtol=1e-12)
+
+
+PROPERTIES = """\
+# RSM settings
+rsm.enabled = true
+rsm.sample.rate=0.25   # sampling rate
+rsm.assembler.weighted.output = 0
+rsm.min.sampling.rate = 0.15
+Scenario.Year =2022
+path.with.equals = C:/abm=input/x
+duplicated.key = 1
+duplicated.key = 1
+empty.value =
+  indented.key = 5 # comment with = sign
+"""
+
+
+def _old_get_property(properties_file, property_name):
+    """
+    property lookup by reading the file, as in the original get_property
+    """
+    with open(properties_file, "r") as f:
+        for line in f.readlines():
+            if property_name in line:
+                key = line.split("=")[0].strip()
+                value = line.split("=")[1].strip()
+                if property_name == key:
+                    return value
+    raise Exception(f"{property_name} not found in sandag_abm.properties file")
+
+
+def _old_set_property(properties_file, property_name, property_value):
+    """
+    property update by rewriting the file, as in the original set_property
+    """
+    with open(properties_file) as f:
+        y = f.read()
+    y = ReplacementOfString(property_name).sub(property_value, y)
+    with open(properties_file, "wt") as f:
+        f.write(y)
+
+
+def _property_names():
+    names = []
+    for line in PROPERTIES.splitlines():
+        if "=" in line and not line.startswith("#"):
+            names.append(line.split("=")[0].strip())
+    return list(dict.fromkeys(names))
+
+
+def test_properties_file_get_matches_old_lookup(tmp_path):
+    properties_file = tmp_path / "sandag_abm.properties"
+    properties_file.write_text(PROPERTIES)
+    properties = PropertiesFile(properties_file)
+
+    for name in _property_names():
+        assert properties.get(name) == _old_get_property(properties_file, name)
+        assert get_property(properties_file, name) == properties.get(name)
+    assert properties.get_float("rsm.min.sampling.rate") == 0.15
+    assert properties.get_int("Scenario.Year") == 2022
+    assert properties.get_bool("rsm.enabled") is True
+    assert properties.get_int("rsm.missing.key", default=3) == 3
+    with pytest.raises(KeyError):
+        properties.get("rsm.missing.key")
+    with pytest.raises(Exception, match="not found"):
+        get_property(properties_file, "rsm.missing.key")
+
+
+def test_properties_file_set_matches_old_rewrite(tmp_path):
+    updates = {
+        "rsm.enabled": "false",
+        "rsm.sample.rate": 1.0,
+        "Scenario.Year": 2035,
+        "duplicated.key": 2,
+        "empty.value": "x",
+        "indented.key": 7,
+        "rsm.missing.key": 1,
+    }
+    old_file = tmp_path / "old.properties"
+    old_file.write_text(PROPERTIES)
+    for name, value in updates.items():
+        _old_set_property(old_file, name, value)
+
+    new_file = tmp_path / "new.properties"
+    new_file.write_text(PROPERTIES)
+    with PropertiesFile(new_file) as properties:
+        properties.update(updates)
+        # nothing is written before the end of the block
+        assert new_file.read_text() == PROPERTIES
+
+    assert new_file.read_text() == old_file.read_text()
+
+
+def test_properties_file_keeps_crlf_lines(tmp_path):
+    properties_file = tmp_path / "sandag_abm.properties"
+    properties_file.write_bytes(PROPERTIES.replace("\n", "\r\n").encode())
+
+    set_property(properties_file, "Scenario.Year", 2035)
+
+    text = properties_file.read_bytes().decode()
+    assert text == PROPERTIES.replace("=2022", "=2035").replace("\n", "\r\n")
+
+
+def test_load_properties_is_shared_and_reloaded(tmp_path):
+    properties_file = tmp_path / "sandag_abm.properties"
+    properties_file.write_text(PROPERTIES)
+    properties = load_properties(properties_file)
+    assert load_properties(str(properties_file)) is properties
+
+    # a file changed by another program is parsed again
+    properties_file.write_text(PROPERTIES.replace("=2022", "=2050 "))
+    assert load_properties(properties_file).get("Scenario.Year") == "2050"
+
+    # unsaved updates are kept over changes on disk
+    properties.set("rsm.enabled", "false")
+    properties_file.write_text(PROPERTIES)
+    assert load_properties(properties_file).get("rsm.enabled") == "false"
+    properties.reload()
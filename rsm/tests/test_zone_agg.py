@@ -0,0 +1,152 @@
+import statistics
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+from sklearn.cluster import AgglomerativeClustering
+
+from rsm.zone_agg import (
+    WeightedAverage,
+    _aggregate_zone_data,
+    _cut_dendrogram,
+    _ward_dendrogram,
+)
+
+
+def _grid_data(n_side=30, seed=0):
+    """
+    cluster factors and rook adjacency of zones on an n_side x n_side grid
+    """
+    rng = np.random.default_rng(seed)
+    n_zones = n_side * n_side
+    data = rng.random((n_zones, 3))
+    zone = np.arange(n_zones).reshape(n_side, n_side)
+    rows = np.r_[zone[:, :-1].ravel(), zone[:-1, :].ravel()]
+    cols = np.r_[zone[:, 1:].ravel(), zone[1:, :].ravel()]
+    adjacency = sparse.coo_matrix(
+        (np.ones(len(rows)), (rows, cols)), shape=(n_zones, n_zones)
+    )
+    return data, (adjacency + adjacency.T).tocsr()
+
+
+def _same_partition(labels, other_labels):
+    pairs = np.unique(np.column_stack([labels, other_labels]), axis=0)
+    return len(pairs) == len(np.unique(labels)) == len(np.unique(other_labels))
+
+
+@pytest.mark.parametrize("n_clusters", [2, 5, 17, 50, 99, 100, 300, 899, 900])
+def test_cut_dendrogram_matches_agglomerative_clustering(n_clusters):
+    data, adjacency = _grid_data()
+    children = _ward_dendrogram(data, adjacency)
+    labels = _cut_dendrogram(children, len(data), n_clusters)
+
+    agglom = AgglomerativeClustering(
+        n_clusters=n_clusters, linkage="ward", connectivity=adjacency
+    )
+    expected = agglom.fit_predict(data)
+
+    assert len(np.unique(labels)) == n_clusters
+    assert _same_partition(labels, expected)
+
+
+def test_cut_dendrogram_numbers_clusters_by_first_zone():
+    data, adjacency = _grid_data()
+    children = _ward_dendrogram(data, adjacency)
+    labels = _cut_dendrogram(children, len(data), 40)
+
+    _, first_zone = np.unique(labels, return_index=True)
+    assert np.all(np.diff(first_zone) > 0)
+
+
+def test_ward_dendrogram_cache(tmp_path):
+    data, adjacency = _grid_data(n_side=10)
+    children = _ward_dendrogram(data, adjacency, cache_dir=tmp_path)
+    assert len(list(tmp_path.glob("dendrogram_*.npz"))) == 1
+    cached = _ward_dendrogram(data, adjacency, cache_dir=tmp_path)
+    np.testing.assert_array_equal(children, cached)
+
+
+def test_weighted_average_matches_np_average():
+    rng = np.random.default_rng(1)
+    n_zones = 5000
+    zones = pd.DataFrame(
+        {
+            "cluster_id": rng.integers(0, 400, n_zones),
+            "value": rng.random(n_zones) * 100,
+            "pop": rng.integers(0, 50, n_zones).astype(float),
+            "emp": rng.integers(0, 50, n_zones).astype(float),
+            "land_use": rng.integers(0, 5, n_zones),
+        }
+    )
+    # clusters without weights fall back to the plain average
+    zones.loc[zones["cluster_id"] < 20, ["pop", "emp"]] = 0
+    backstop = 0.0
+
+    aggregated = _aggregate_zone_data(
+        zones,
+        {"value": WeightedAverage(["pop", "emp"]), "land_use": "mode", "pop": "sum"},
+        "cluster_id",
+        backstop,
+    )
+
+    def _average(group):
+        weights = group["pop"] + group["emp"] + backstop
+        if weights.sum() == 0:
+            return group["value"].mean()
+        return np.average(group["value"], weights=weights)
+
+    grouped = zones.groupby("cluster_id")
+    expected = grouped[["value", "pop", "emp"]].apply(_average)
+    np.testing.assert_allclose(
+        aggregated["value"].to_numpy(), expected.to_numpy(), rtol=1e-12
+    )
+    expected_mode = grouped["land_use"].agg(statistics.mode)
+    np.testing.assert_array_equal(
+        aggregated["land_use"].to_numpy(), expected_mode.to_numpy()
+    )
+    np.testing.assert_array_equal(
+        aggregated["pop"].to_numpy(), zones.groupby("cluster_id")["pop"].sum().to_numpy()
+    )
+
+
+def test_merge_zone_data_skips_zones_without_cluster():
+    import geopandas as gpd
+    from shapely.geometry import box
+
+    from rsm.zone_agg import merge_zone_data
+
+    zones = gpd.GeoDataFrame(
+        {
+            "cluster_id": [1, 1, 2, np.nan],
+            "pop": [0.0, 0.0, 10.0, 5.0],
+            "hh": [4.0, 6.0, 0.0, 2.0],
+            "empden": [1.0, 3.0, 5.0, 7.0],
+            "duden": [2.0, 4.0, 6.0, 8.0],
+            "totint": [10, 20, 30, 40],
+        },
+        geometry=[box(0, 0, 1, 1), box(1, 0, 3, 1), box(0, 1, 1, 2), box(1, 1, 2, 2)],
+    )
+    merged = merge_zone_data(
+        zones,
+        agg_instruction={
+            "pop": "sum",
+            "totint": "sum",
+            "empden": WeightedAverage(("pop",)),
+            "duden": WeightedAverage(("hh",)),
+        },
+    )
+
+    assert list(merged.index) == [1, 2]
+    np.testing.assert_array_equal(merged["totint"], [30, 30])
+    # zero population in cluster 1, the area backstop weights its zones
+    area_small = zones.area / zones.area.mean() / 1000
+    np.testing.assert_allclose(
+        merged["empden"],
+        [np.average([1.0, 3.0], weights=area_small[:2]), 5.0],
+        rtol=1e-12,
+    )
+    np.testing.assert_allclose(
+        merged["duden"], [np.average([2.0, 4.0], weights=[4.0, 6.0] + area_small[:2]), 6.0]
+    )
+    assert merged.geometry.area.tolist() == [3.0, 1.0]
@@ -1,32 +1,498 @@
+from __future__ import absolute_import
+
 import os
-#import logging
+import hashlib
+import json
+import logging
+import multiprocessing
+import time
+from collections import namedtuple
+
+import numpy as np
 import pandas as pd
 import openmatrix as omx
 import shutil
+from scipy import sparse
 
-#logger = logging.getLogger(__name__)
+logger = logging.getLogger(__name__)
 
- 
-def _aggregate_matrix(input_mtx_array, aggregate_mapping_dict):
-    matrix_df = pd.DataFrame(input_mtx_array, columns = list(aggregate_mapping_dict.keys()))
-    
-    matrix_agg_df = matrix_df.rename(columns=(aggregate_mapping_dict))
-    matrix_agg_df.index = list(aggregate_mapping_dict.values())
-    
-    matrix_agg_df = matrix_agg_df.stack().groupby(level=[0,1]).sum().unstack()
-    matrix_agg_df = matrix_agg_df[sorted(matrix_agg_df.columns)]
-    matrix_agg_df = matrix_agg_df.sort_index()
-    
-    output_mtx = matrix_agg_df.to_numpy()
-    
-    return output_mtx
+
+ZoneOperator = namedtuple(
+    "ZoneOperator", ["indicator", "codes", "order", "starts", "agg_zones"]
+)
+
+# aggregation rules for matrix cores, "sum" is for demand, the others for skims
+RULES = ("sum", "mean", "weighted_mean", "min", "max")
+
+# handling of intrazonal cells for the skim rules
+INTRAZONAL = (None, "exclude", "half_nearest")
+
+
+def _zone_operator(aggregate_mapping_dict):
+    """
+    builds the original zone to aggregated zone operator from the zone mapping
+
+    The operator is built once per crosswalk and applied to every core.  Rows
+    and columns of the input matrices are expected in the order of the mapping
+    keys, aggregated zones are returned in sorted order.
+
+    Parameters
+    ----------
+    aggregate_mapping_dict : aggregate_mapping_dict (dict)
+        original zone to aggregated zone, in the zone order of the matrices
+
+    Returns
+    -------
+    ZoneOperator
+        indicator: sparse (original zones x aggregated zones) indicator matrix P
+        codes: position of each original zone's aggregated zone in agg_zones
+        order: permutation grouping the original zones by aggregated zone
+        starts: offset of each aggregated zone within order
+        agg_zones: sorted aggregated zone ids
+    """
+    agg_zones, codes = np.unique(
+        np.asarray(list(aggregate_mapping_dict.values())), return_inverse=True
+    )
+    n_zones = len(codes)
+    indicator = sparse.csr_matrix(
+        (np.ones(n_zones), (np.arange(n_zones), codes)),
+        shape=(n_zones, len(agg_zones)),
+    )
+    order = np.argsort(codes, kind="mergesort")
+    starts = np.searchsorted(codes[order], np.arange(len(agg_zones)))
+    return ZoneOperator(indicator, codes, order, starts, agg_zones)
+
+
+def _read_zone_mapping(agg_zone_mapping):
+    """
+    reads the zone crosswalk and returns the original to aggregated zone dict
+    """
+    if isinstance(agg_zone_mapping, pd.DataFrame):
+        agg_zone_mapping_df = agg_zone_mapping.copy()
+    else:
+        agg_zone_mapping_df = pd.read_csv(os.path.join(agg_zone_mapping))
+
+    agg_zone_mapping_df.columns= agg_zone_mapping_df.columns.str.strip().str.lower()
+    agg_zone_mapping_df = agg_zone_mapping_df.sort_values('taz')
+    zone_mapping = dict(zip(agg_zone_mapping_df['taz'], agg_zone_mapping_df['cluster_id']))
+
+    return zone_mapping
+
+
+def _check_matrix_shape(shape, zone_operator):
+    n_zones = len(zone_operator.codes)
+    if tuple(shape) != (n_zones, n_zones):
+        raise ValueError(
+            "matrix shape {} does not match the {} zones in the zone mapping".format(
+                tuple(shape), n_zones
+            )
+        )
+
+
+def _check_rule(rule, intrazonal=None, weight_matrix=None):
+    if rule not in RULES:
+        raise ValueError("unknown aggregation rule {!r}, use one of {}".format(rule, RULES))
+    if intrazonal not in INTRAZONAL:
+        raise ValueError(
+            "unknown intrazonal handling {!r}, use one of {}".format(intrazonal, INTRAZONAL)
+        )
+    if rule == "weighted_mean" and weight_matrix is None:
+        raise ValueError("the weighted_mean rule needs a weight matrix")
+
+
+def _aggregate_matrix(
+    input_mtx,
+    zone_operator,
+    rule="sum",
+    weight_mtx=None,
+    intrazonal=None,
+    block_rows=None,
+):
+    """
+    aggregates the cells of a matrix into the aggregated zone system
+
+    Sums are computed as P.T @ M @ P with the sparse zone indicator P, means
+    as the ratio of two such sums, min and max with `reduceat` over the zones
+    grouped by the operator.  All rules run in one pass over the rows of the
+    input; with `block_rows` only that many origin rows are read at a time,
+    e.g. from an omx core (PyTables array), so peak memory is bounded by the
+    block size rather than by the size of the input matrix.
+
+    Sums are accumulated in float64 whatever the input dtype and cast back
+    to it once at the end, so float32 demand does not lose precision over
+    many blocks.  The cells are still added in a different order than in a
+    pandas groupby, so float32 results can differ from it in the last unit
+    (ulp) of a cell, and float64 results by a few ulps.  Results with
+    different `block_rows` agree within the same tolerance.
+
+    Parameters
+    ----------
+    input_mtx : input_mtx (array-like or omx core)
+        square matrix in the original zone system
+    zone_operator : zone_operator (ZoneOperator or dict)
+        operator from `_zone_operator`, or the zone mapping dict to build it from
+    rule : rule (str)
+        "sum" (default) for demand.  For skims, "mean" averages all original
+        zone pairs of an aggregated pair, "weighted_mean" weights them by
+        `weight_mtx` (falling back to the plain mean where all weights are
+        zero), "min" and "max" take the extreme value.  Missing values are
+        skipped by every rule.
+    weight_mtx : weight_mtx (array-like or omx core, optional)
+        weights in the original zone system, e.g. AM trips, for "weighted_mean"
+    intrazonal : intrazonal (str, optional)
+        handling of intrazonal cells for the skim rules, ignored for "sum".
+        None (default) treats them like any other cell.  "exclude" leaves the
+        original intrazonal cells out, aggregated zones made of one original
+        zone keep its intrazonal value.  "half_nearest" sets each aggregated
+        intrazonal cell to half the smallest other value in its row.
+    block_rows : block_rows (int, optional)
+        number of origin rows read at a time, default is the whole matrix
+
+    Returns
+    -------
+    numpy.ndarray
+        keeps the dtype of the input matrix, means are at least float32
+    """
+    if not isinstance(zone_operator, ZoneOperator):
+        zone_operator = _zone_operator(zone_operator)
+    _check_rule(rule, intrazonal, weight_mtx)
+
+    if not hasattr(input_mtx, "shape"):
+        input_mtx = np.asarray(input_mtx)
+    _check_matrix_shape(input_mtx.shape, zone_operator)
+    if rule == "weighted_mean":
+        if not hasattr(weight_mtx, "shape"):
+            weight_mtx = np.asarray(weight_mtx)
+        _check_matrix_shape(weight_mtx.shape, zone_operator)
+
+    indicator, codes = zone_operator.indicator, zone_operator.codes
+    n_zones, n_agg_zones = indicator.shape
+    block_rows = block_rows or n_zones
+    dtype = input_mtx.dtype
+
+    def _sum_block(block, start, stop):
+        # P[start:stop].T @ block @ P
+        return indicator.T.dot(indicator[start:stop].T.dot(block).T).T
+
+    if rule in ("min", "max"):
+        reduce = np.fmin if rule == "min" else np.fmax
+        output_mtx = np.full((n_agg_zones, n_agg_zones), np.nan)
+    else:
+        output_mtx = np.zeros((n_agg_zones, n_agg_zones))
+    if rule in ("mean", "weighted_mean"):
+        weight_sum = np.zeros((n_agg_zones, n_agg_zones))
+    if rule == "weighted_mean":
+        plain_sum = np.zeros((n_agg_zones, n_agg_zones))
+        plain_count = np.zeros((n_agg_zones, n_agg_zones))
+    exclude_intrazonal = rule != "sum" and intrazonal == "exclude"
+    if exclude_intrazonal:
+        intrazonal_values = np.zeros(n_zones)
+
+    for start in range(0, n_zones, block_rows):
+        stop = min(start + block_rows, n_zones)
+        block = np.asarray(input_mtx[start:stop])
+
+        if rule == "sum":
+            # accumulate in float64, float32 demand is cast back once at the end
+            block = block.astype(np.float64, copy=False)
+            if np.isnan(block).any():
+                block = np.nan_to_num(block)
+            output_mtx += _sum_block(block, start, stop)
+            continue
+
+        block = block.astype(np.float64)
+        if exclude_intrazonal:
+            rows = np.arange(stop - start)
+            intrazonal_values[start:stop] = block[rows, rows + start]
+            block[rows, rows + start] = np.nan
+
+        if rule in ("min", "max"):
+            block_agg = reduce.reduceat(
+                block[:, zone_operator.order], zone_operator.starts, axis=1
+            )
+            row_order = np.argsort(codes[start:stop], kind="mergesort")
+            row_codes = codes[start:stop][row_order]
+            row_starts = np.flatnonzero(np.r_[True, row_codes[1:] != row_codes[:-1]])
+            row_codes = row_codes[row_starts]
+            output_mtx[row_codes] = reduce(
+                output_mtx[row_codes],
+                reduce.reduceat(block_agg[row_order], row_starts, axis=0),
+            )
+            continue
+
+        valid = ~np.isnan(block)
+        block[~valid] = 0
+        if rule == "weighted_mean":
+            weights = np.asarray(weight_mtx[start:stop], dtype=np.float64) * valid
+            plain_sum += _sum_block(block, start, stop)
+            plain_count += _sum_block(valid.astype(np.float64), start, stop)
+        else:
+            weights = valid.astype(np.float64)
+        output_mtx += _sum_block(block * weights, start, stop)
+        weight_sum += _sum_block(weights, start, stop)
+
+    if rule in ("mean", "weighted_mean"):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            output_mtx = output_mtx / weight_sum
+            if rule == "weighted_mean":
+                output_mtx = np.where(weight_sum > 0, output_mtx, plain_sum / plain_count)
+        dtype = np.promote_types(dtype, np.float32)
+
+    if exclude_intrazonal:
+        # aggregated zones of a single original zone have no other intrazonal cells
+        single = np.flatnonzero(np.diff(np.r_[zone_operator.starts, n_zones]) == 1)
+        output_mtx[single, single] = np.where(
+            np.isnan(output_mtx[single, single]),
+            intrazonal_values[zone_operator.order[zone_operator.starts[single]]],
+            output_mtx[single, single],
+        )
+
+    if rule != "sum" and intrazonal == "half_nearest" and n_agg_zones > 1:
+        other_cells = output_mtx.copy()
+        np.fill_diagonal(other_cells, np.nan)
+        nearest = np.fmin.reduce(other_cells, axis=1)
+        diagonal = np.arange(n_agg_zones)
+        output_mtx[diagonal, diagonal] = np.where(
+            np.isnan(nearest), output_mtx[diagonal, diagonal], 0.5 * nearest
+        )
+
+    return output_mtx.astype(dtype, copy=False)
+
+
+# rows hashed at a time when hashing omx cores
+_HASH_BLOCK_ROWS = 1000
+
+
+def _zone_operator_hash(zone_operator, rule="sum"):
+    """
+    hash of the crosswalk held by the zone operator and the aggregation rule
+    """
+    h = hashlib.sha1(rule.encode("utf-8"))
+    for array in (zone_operator.codes, zone_operator.agg_zones):
+        array = np.ascontiguousarray(array)
+        h.update(array.dtype.str.encode("utf-8"))
+        h.update(array.tobytes())
+    return h.hexdigest()
+
+
+def _core_hash(matrix, base_hash, block_rows=None):
+    """
+    content hash of an omx core (or array) combined with base_hash
+
+    The core is read `block_rows` rows at a time, so hashing does not need
+    more memory than the aggregation itself.
+    """
+    h = hashlib.sha1(base_hash.encode("utf-8"))
+    h.update(str((matrix.dtype.str, tuple(matrix.shape))).encode("utf-8"))
+    n_rows = matrix.shape[0]
+    block_rows = block_rows or _HASH_BLOCK_ROWS
+    for start in range(0, n_rows, block_rows):
+        h.update(np.ascontiguousarray(matrix[start:start + block_rows]).tobytes())
+    return h.hexdigest()
+
+
+def _rule_key(rule, options):
+    """
+    the aggregation rule of a core as hashed into the manifest
+    """
+    if rule == "sum":
+        return rule
+    key = "{}|intrazonal={}".format(rule, options.intrazonal)
+    if rule == "weighted_mean":
+        key += "|weights={}".format(options.weight_hash)
+    return key
+
+
+def _read_manifest(manifest_file):
+    if manifest_file is None or not os.path.isfile(manifest_file):
+        return {}
+    with open(manifest_file, "r") as f:
+        return json.load(f)
+
+
+def _write_manifest(manifest_file, manifest):
+    with open(manifest_file, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+def _output_stamp(output_file):
+    """
+    size and modification time of an output file as recorded in the manifest,
+    None if there is no such file
+    """
+    if not os.path.isfile(output_file):
+        return None
+    return [os.path.getsize(output_file), os.path.getmtime(output_file)]
+
+
+TranslateOptions = namedtuple(
+    "TranslateOptions",
+    [
+        "input_dir",
+        "output_dir",
+        "block_rows",
+        "core_rules",
+        "default_rule",
+        "intrazonal",
+        "weight_matrix",
+        "weight_hash",
+    ],
+)
+
+
+def _open_weight_matrix(weight_matrix, input_dir):
+    """
+    returns (weights, omx file to close) for an array or an (omx file, core) pair
+    """
+    if isinstance(weight_matrix, tuple):
+        weight_file = omx.open_file(os.path.join(input_dir, weight_matrix[0]), mode="r")
+        return weight_file[weight_matrix[1]], weight_file
+    return weight_matrix, None
+
+
+def _translate_omx_file(mat_name, zone_operator, options, cached_entry=None):
+    """
+    aggregates all cores of one omx file and writes them to output_dir
+
+    If `cached_entry` (the file's manifest entry, with the input hash of
+    every core as "cores" and the size and modification time of the output
+    file as "output") is given, the input cores are hashed and cores whose
+    hash is unchanged are taken from the existing output file instead of
+    being aggregated again.  When no core has changed the output file is
+    left as it is.  Nothing is reused if the output file is not the one
+    recorded in the manifest, e.g. because an RSM iteration overwrote it.
+
+    Returns
+    -------
+    mat_name, n_cores, n_reused, seconds, entry : (str, int, int, float, dict or None)
+        entry is the new manifest entry of the file
+    """
+    start_time = time.time()
+
+    input_skim_file = os.path.join(options.input_dir, mat_name)
+    output_skim_file = os.path.join(options.output_dir, mat_name)
+
+    assert os.path.isfile(input_skim_file), input_skim_file
+
+    core_rules = options.core_rules or {}
+    weight_file = None
+    input_matrix = omx.open_file(input_skim_file, mode="r") 
+    try:
+        input_mapping_name = input_matrix.list_mappings()[0]
+        input_cores = input_matrix.list_matrices()
+        rules = dict(
+            (core, core_rules.get(core, options.default_rule)) for core in input_cores
+        )
+
+        core_hashes = None
+        reused = {}
+        if cached_entry is not None:
+            cached_hashes = {}
+            if cached_entry.get("output") == _output_stamp(output_skim_file):
+                cached_hashes = cached_entry.get("cores", {})
+            base_hashes = dict(
+                (rule, _zone_operator_hash(zone_operator, _rule_key(rule, options)))
+                for rule in set(rules.values())
+            )
+            core_hashes = dict(
+                (
+                    core,
+                    _core_hash(input_matrix[core], base_hashes[rules[core]], options.block_rows),
+                )
+                for core in input_cores
+            )
+            unchanged = [
+                core for core in input_cores
+                if cached_hashes.get(core) == core_hashes[core]
+            ]
+            if unchanged and os.path.isfile(output_skim_file):
+                if len(unchanged) == len(input_cores) == len(cached_hashes):
+                    return (
+                        mat_name, len(input_cores), len(input_cores),
+                        time.time() - start_time, cached_entry,
+                    )
+                previous_matrix = omx.open_file(output_skim_file, mode="r")
+                try:
+                    previous_cores = previous_matrix.list_matrices()
+                    for core in unchanged:
+                        if core in previous_cores:
+                            reused[core] = previous_matrix[core].read()
+                finally:
+                    previous_matrix.close()
+
+        weights = None
+        if "weighted_mean" in rules.values():
+            weights, weight_file = _open_weight_matrix(
+                options.weight_matrix, options.input_dir
+            )
+            if weight_file is not None and not options.block_rows:
+                weights = weights.read()
+
+        n_reused = len(reused)
+        output_matrix = omx.open_file(output_skim_file, mode="w")
+        try:
+            for core in input_cores:
+                if core in reused:
+                    output_matrix[core] = reused.pop(core)
+                    continue
+                matrix = input_matrix[core]
+                if not options.block_rows:
+                    matrix = matrix.read()
+                output_matrix[core] = _aggregate_matrix(
+                    matrix,
+                    zone_operator,
+                    rule=rules[core],
+                    weight_mtx=weights,
+                    intrazonal=options.intrazonal,
+                    block_rows=options.block_rows,
+                )
+
+            output_matrix.create_mapping(
+                title=input_mapping_name, entries=list(zone_operator.agg_zones)
+            )
+        finally:
+            output_matrix.close()
+    finally:
+        input_matrix.close()
+        if weight_file is not None:
+            weight_file.close()
+
+    entry = None
+    if core_hashes is not None:
+        entry = {"cores": core_hashes, "output": _output_stamp(output_skim_file)}
+    return mat_name, len(input_cores), n_reused, time.time() - start_time, entry
+
+
+# zone operator and options of a pool worker, set once per process by _init_worker
+_worker_zone_operator = None
+_worker_options = None
+
+
+def _init_worker(zone_operator, options):
+    global _worker_zone_operator, _worker_options
+    _worker_zone_operator = zone_operator
+    _worker_options = options
+
+
+def _translate_omx_file_worker(args):
+    mat_name, cached_entry = args
+    return _translate_omx_file(
+        mat_name, _worker_zone_operator, _worker_options, cached_entry
+    )
 
 
 def translate_omx_demand(
     matrix_names,
     agg_zone_mapping,
     input_dir=".",
-    output_dir="."
+    output_dir=".",
+    max_workers=1,
+    block_rows=None,
+    cache_manifest=None,
+    core_rules=None,
+    default_rule="sum",
+    weight_matrix=None,
+    intrazonal=None,
 ): 
     """
     aggregates the omx demand matrix to aggregated zone system
@@ -42,47 +508,142 @@ def translate_omx_demand(
         default "."
     output_dir : output_dir (path_like) 
         default "."
+    max_workers : max_workers (int, optional)
+        number of processes translating omx files in parallel, each worker
+        translates whole files.  1 (default) translates the files one at a
+        time in this process, None uses all available cores.
+        When called from a script with max_workers other than 1, the script
+        must be guarded by `if __name__ == "__main__":`.
+    block_rows : block_rows (int, optional)
+        stream each core in blocks of this many origin rows instead of reading
+        the whole core into memory.  Peak memory per core is then bounded by
+        the block size, useful for very large (e.g. MGRA-level) matrices.
+        None (default) reads whole cores.
+    cache_manifest : cache_manifest (path_like, optional)
+        json manifest holding a hash of every input core, the crosswalk and
+        the aggregation rule from previous runs, relative paths are taken
+        from output_dir.  Cores whose hash is unchanged are reused from the
+        existing output file instead of being aggregated again.  The size and
+        modification time of each output file are recorded as well, nothing
+        is reused from an output file that was changed since, e.g. by an RSM
+        iteration.  None (default) aggregates every core.
+    core_rules : core_rules (dict, optional)
+        aggregation rule by core name, one of "sum", "mean", "weighted_mean",
+        "min" or "max".  Cores not listed use `default_rule`.
+    default_rule : default_rule (str)
+        default "sum", which is correct for demand.  Use the other rules to
+        aggregate time, distance and cost skims.
+    weight_matrix : weight_matrix (tuple or array-like, optional)
+        weights for the "weighted_mean" rule in the original zone system, as
+        (omx filename in input_dir, core name), e.g. ("trip_AM.omx", "SOV_GP_AM"),
+        or as an array
+    intrazonal : intrazonal (str, optional)
+        handling of intrazonal cells for the skim rules, None (default),
+        "exclude" or "half_nearest", see `_aggregate_matrix`
     
     Returns
     -------
     
     """
     
-    agg_zone_mapping_df = pd.read_csv(os.path.join(agg_zone_mapping))
-    agg_zone_mapping_df = agg_zone_mapping_df.sort_values('taz')
+    zone_operator = _zone_operator(_read_zone_mapping(agg_zone_mapping))
 
-    agg_zone_mapping_df.columns= agg_zone_mapping_df.columns.str.strip().str.lower()
-    zone_mapping = dict(zip(agg_zone_mapping_df['taz'], agg_zone_mapping_df['cluster_id']))
-    agg_zones = sorted(agg_zone_mapping_df['cluster_id'].unique())
+    for rule in set((core_rules or {}).values()) | set([default_rule]):
+        _check_rule(rule, intrazonal, weight_matrix)
 
+    mat_names = []
     for mat_name in matrix_names:
         if '.omx' not in mat_name:
             mat_name = mat_name + ".omx"
-        
-        #logger.info("Aggregating Matrix: " + mat_name + " ...")
+        mat_names.append(mat_name)
 
-        input_skim_file = os.path.join(input_dir, mat_name)
-        print(input_skim_file)
-        output_skim_file = os.path.join(output_dir, mat_name)
+    if cache_manifest is not None:
+        cache_manifest = os.path.join(output_dir, cache_manifest)
+        manifest = _read_manifest(cache_manifest)
+        cached_entries = dict((mat_name, manifest.pop(mat_name, {})) for mat_name in mat_names)
+        # entries come back as files complete, so an interrupted run never
+        # leaves a manifest entry pointing at a partially written file
+        _write_manifest(cache_manifest, manifest)
+    else:
+        manifest = None
+        cached_entries = dict((mat_name, None) for mat_name in mat_names)
 
-        assert os.path.isfile(input_skim_file)
+    weight_hash = None
+    if cache_manifest is not None and weight_matrix is not None:
+        weights, weight_file = _open_weight_matrix(weight_matrix, input_dir)
+        try:
+            if not hasattr(weights, "shape"):
+                weights = np.asarray(weights)
+            weight_hash = _core_hash(weights, "", block_rows)
+        finally:
+            if weight_file is not None:
+                weight_file.close()
 
-        input_matrix = omx.open_file(input_skim_file, mode="r") 
-        input_mapping_name = input_matrix.list_mappings()[0]
-        input_cores = input_matrix.list_matrices()
+    options = TranslateOptions(
+        input_dir,
+        output_dir,
+        block_rows,
+        core_rules,
+        default_rule,
+        intrazonal,
+        weight_matrix,
+        weight_hash,
+    )
 
-        output_matrix = omx.open_file(output_skim_file, mode="w")
-    
-        for core in input_cores:
-            matrix = input_matrix[core]
-            matrix_array = matrix.read()
-            matrix_agg = _aggregate_matrix(matrix_array, zone_mapping)
-            output_matrix[core] = matrix_agg
+    if max_workers is None:
+        max_workers = multiprocessing.cpu_count()
+    max_workers = max(1, min(int(max_workers), len(mat_names)))
 
-        output_matrix.create_mapping(title=input_mapping_name, entries=agg_zones)
+    start_time = time.time()
+    logger.info(
+        "Aggregating {} omx files with {} worker(s)".format(len(mat_names), max_workers)
+    )
 
-        input_matrix.close()
-        output_matrix.close()
+    if max_workers == 1:
+        pool = None
+        results = (
+            _translate_omx_file(
+                mat_name, zone_operator, options, cached_entries[mat_name]
+            )
+            for mat_name in mat_names
+        )
+    else:
+        # the operator is pickled once per worker rather than once per file
+        pool = multiprocessing.Pool(
+            processes=max_workers,
+            initializer=_init_worker,
+            initargs=(zone_operator, options),
+        )
+        results = pool.imap_unordered(
+            _translate_omx_file_worker,
+            [(mat_name, cached_entries[mat_name]) for mat_name in mat_names],
+        )
+
+    total_cores = 0
+    total_reused = 0
+    try:
+        for mat_name, n_cores, n_reused, seconds, entry in results:
+            logger.info(
+                "Aggregated {} ({} cores, {} reused) in {:.2f} s".format(
+                    mat_name, n_cores, n_reused, seconds
+                )
+            )
+            total_cores += n_cores
+            total_reused += n_reused
+            if manifest is not None:
+                manifest[mat_name] = entry
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if manifest is not None:
+            _write_manifest(cache_manifest, manifest)
+
+    logger.info(
+        "Aggregated {} omx files in {:.2f} s, {} of {} cores unchanged and skipped".format(
+            len(mat_names), time.time() - start_time, total_reused, total_cores
+        )
+    )
 
 
 def translate_emmebank_demand(
@@ -90,6 +651,10 @@ def translate_emmebank_demand(
     output_databank,
     cores_to_aggregate,
     agg_zone_mapping,
+    core_rules=None,
+    default_rule="sum",
+    weight_matrix=None,
+    intrazonal=None,
 ): 
     """
     aggregates the demand matrix cores from one emme databank and loads them into another databank
@@ -105,6 +670,19 @@ def translate_emmebank_demand(
     agg_zone_mapping: agg_zone_mapping (Path-like or pandas.DataFrame)
         zone number mapping between original and aggregated zones. 
         columns: original zones as 'taz' and aggregated zones as 'cluster_id'
+    core_rules : core_rules (dict, optional)
+        aggregation rule by core name, one of "sum", "mean", "weighted_mean",
+        "min" or "max".  Cores not listed use `default_rule`.
+    default_rule : default_rule (str)
+        default "sum", which is correct for demand.  Use the other rules to
+        aggregate time, distance and cost skims.
+    weight_matrix : weight_matrix (str or array-like, optional)
+        weights for the "weighted_mean" rule in the original zone system, as
+        the name of a matrix in the input databank, e.g. "mfAM_SOV_TR_M",
+        or as an array
+    intrazonal : intrazonal (str, optional)
+        handling of intrazonal cells for the skim rules, None (default),
+        "exclude" or "half_nearest", see `_aggregate_matrix`
     
     Returns
     -------
@@ -112,17 +690,26 @@ def translate_emmebank_demand(
     
     """
     
-    agg_zone_mapping_df = pd.read_csv(os.path.join(agg_zone_mapping))
-    agg_zone_mapping_df = agg_zone_mapping_df.sort_values('taz')
-    
-    agg_zone_mapping_df.columns= agg_zone_mapping_df.columns.str.strip().str.lower()
-    zone_mapping = dict(zip(agg_zone_mapping_df['taz'], agg_zone_mapping_df['cluster_id']))
+    zone_operator = _zone_operator(_read_zone_mapping(agg_zone_mapping))
+    core_rules = core_rules or {}
+    rules = dict((core, core_rules.get(core, default_rule)) for core in cores_to_aggregate)
+    for rule in set(rules.values()):
+        _check_rule(rule, intrazonal, weight_matrix)
+
+    if "weighted_mean" in rules.values() and isinstance(weight_matrix, str):
+        weight_matrix = input_databank.matrix(weight_matrix).get_data().to_numpy()
         
     for core in cores_to_aggregate: 
         matrix = input_databank.matrix(core).get_data()
         matrix_array = matrix.to_numpy()
         
-        matrix_agg = _aggregate_matrix(matrix_array, zone_mapping)
+        matrix_agg = _aggregate_matrix(
+            matrix_array,
+            zone_operator,
+            rule=rules[core],
+            weight_mtx=weight_matrix,
+            intrazonal=intrazonal,
+        )
         
         output_matrix = output_databank.matrix(core)
         output_matrix.set_numpy_data(matrix_agg)
@@ -3,6 +3,7 @@ import glob
 import shutil
 import os
 import logging
+import tempfile
 import geopandas as gpd
 import pandas as pd
 import numpy as np
@@ -56,40 +57,168 @@ def copy_file(src, dest):
     """
     shutil.copy(src, dest)
 
-def get_property(properties_file, property_name):
+class PropertiesFile:
     """
-    Extracts the property_value for a property_name from sandag_abm.properties files
+    A sandag_abm.properties file, parsed once and held in memory.
+
+    Every line is kept as read, comments and layout included, with an index
+    from each key to its lines.  Lookups are served from memory and updates
+    are batched until `save`, which rewrites the file once, atomically.
+    Used as a context manager, the updates are saved on leaving the block.
+
+    Parameters
+    ----------
+    properties_file : properties_file (path_like)
     """
-    with open(properties_file, "r") as f:
-        lines = f.readlines()
-        key_found = False
-        for line in lines:
-            if property_name in line:
-                key = line.split("=")[0].strip()
-                value = line.split("=")[1].strip()
+    _NO_DEFAULT = object()
+
+    def __init__(self, properties_file):
+        self.path = os.fspath(properties_file)
+        self.reload()
+
+    def reload(self):
+        """
+        read the file again, dropping unsaved updates
+        """
+        with open(self.path, "r", newline="") as f:
+            self._lines = f.readlines()
+        self._index = {}
+        for i, line in enumerate(self._lines):
+            if "=" in line:
+                self._index.setdefault(line.split("=")[0].strip(), []).append(i)
+        self._stat = self._file_stat()
+        self.dirty = False
+
+    def _file_stat(self):
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def changed_on_disk(self):
+        return self._file_stat() != self._stat
+
+    def __contains__(self, property_name):
+        return property_name in self._index
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.save()
+
+    def get(self, property_name, default=_NO_DEFAULT):
+        """
+        value of the first line with this key, as a string
+        """
+        if property_name not in self._index:
+            if default is not self._NO_DEFAULT:
+                return default
+            raise KeyError("{} not found in {}".format(property_name, self.path))
+        return self._lines[self._index[property_name][0]].split("=")[1].strip()
+
+    def get_int(self, property_name, default=_NO_DEFAULT):
+        value = self.get(property_name, default)
+        return value if value is default else int(value)
+
+    def get_float(self, property_name, default=_NO_DEFAULT):
+        value = self.get(property_name, default)
+        return value if value is default else float(value)
+
+    def get_bool(self, property_name, default=_NO_DEFAULT):
+        """
+        "true"/"1"/"yes" or "false"/"0"/"no", in any case
+        """
+        value = self.get(property_name, default)
+        if value is default:
+            return value
+        if value.lower() in ("true", "1", "yes"):
+            return True
+        if value.lower() in ("false", "0", "no"):
+            return False
+        raise ValueError("{} is not a boolean: {!r}".format(property_name, value))
+
+    def set(self, property_name, property_value):
+        """
+        replace the value on every line with this key, keeping any comment
+        after it.  The file is only written by `save`.
+        """
+        lines = self._index.get(property_name, [])
+        for i in lines:
+            line = self._lines[i]
+            body = line.rstrip("\r\n")
+            newline = line[len(body):]
+            key, _, rest = body.partition("=")
+            value = rest.lstrip(" \t\f\v")
+            prefix = key + "=" + rest[: len(rest) - len(value)]
+            comment = value[value.index("#"):] if "#" in value else ""
+            self._lines[i] = f"{prefix}{property_value}{comment}{newline}"
+        if lines:
+            self.dirty = True
+        logger.info(f"For '{property_name}': {len(lines)} substitutions made")
+
+    def update(self, properties):
+        """
+        set several properties from a dict
+        """
+        for property_name, property_value in properties.items():
+            self.set(property_name, property_value)
+
+    def save(self):
+        """
+        write the updates, replacing the file in one step
+        """
+        if not self.dirty:
+            return
+        folder = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", newline="") as f:
+                f.writelines(self._lines)
+            shutil.copymode(self.path, temp_path)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        self._stat = self._file_stat()
+        self.dirty = False
+
+
+_properties_files = {}
+
+
+def load_properties(properties_file):
+    """
+    PropertiesFile for a path, shared by all callers in the process.
 
-                if property_name == key:
-                    key_found = True
-                    break
+    The file is parsed again only when it has changed on disk and the shared
+    instance has no unsaved updates.
+    """
+    path = os.path.realpath(properties_file)
+    properties = _properties_files.get(path)
+    if properties is None:
+        properties = _properties_files[path] = PropertiesFile(path)
+    elif not properties.dirty and properties.changed_on_disk():
+        properties.reload()
+    return properties
 
-    if not key_found:
-        raise Exception("{} not found in sandag_abm.properties file".format(property_name))
 
-    return value
+def get_property(properties_file, property_name):
+    """
+    Extracts the property_value for a property_name from sandag_abm.properties files
+    """
+    properties = load_properties(properties_file)
+    if property_name not in properties:
+        raise Exception("{} not found in sandag_abm.properties file".format(property_name))
+    return properties.get(property_name)
 
 def set_property(properties_file, property_name, property_value):
     """
     Modifies the sandag properties file
 
     """
-
-    with open(properties_file) as f:
-        y = f.read()
-
-    y = ReplacementOfString(property_name).sub(property_value, y)
-
-    with open(properties_file, 'wt') as f:
-        f.write(y)
+    properties = load_properties(properties_file)
+    properties.set(property_name, property_value)
+    properties.save()
 
 def fix_zero_enrollment(mgra_df):
 
@@ -114,6 +243,61 @@ def fix_zero_enrollment(mgra_df):
         
     return mgra_df
 
+def nearest_mgra(x, y, mgra_nodes, k=8):
+    """
+    nearest MGRA node of every point, found with a KD-tree.
+
+    Ties go to the first of the equally near nodes in mgra_nodes, as when
+    taking the first minimum of the distances to all nodes.
+
+    Parameters
+    ----------
+    x, y : x, y (array-like)
+        point coordinates
+    mgra_nodes : mgra_nodes (pandas.DataFrame)
+        MGRA nodes with "mgra", "x" and "y"
+    k : k (int)
+        nodes checked for ties per point, points with more near ties than
+        this are checked against all nodes
+
+    Returns
+    -------
+    numpy.ndarray
+        mgra of the nearest node, NaN for points without coordinates
+    """
+    from scipy.spatial import cKDTree
+
+    node_x = mgra_nodes['x'].to_numpy(dtype=np.float64)
+    node_y = mgra_nodes['y'].to_numpy(dtype=np.float64)
+    node_mgra = mgra_nodes['mgra'].to_numpy()
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    valid = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+    if len(valid) < len(x) or len(node_x) == 0:
+        near = np.full(len(x), np.nan)
+    else:
+        near = np.empty(len(x), dtype=node_mgra.dtype)
+    if len(valid) == 0 or len(node_x) == 0:
+        return near
+    x, y = x[valid, None], y[valid, None]
+
+    k = min(k, len(node_x))
+    tree = cKDTree(np.column_stack([node_x, node_y]))
+    candidates = tree.query(np.column_stack([x[:, 0], y[:, 0]]), k=k)[1].reshape(len(valid), k)
+    # same arithmetic as the distance to every node, so ties are exact
+    dist = np.sqrt((x - node_x[candidates])**2 + (y - node_y[candidates])**2)
+    min_dist = dist.min(axis=1, keepdims=True)
+    first = np.where(dist == min_dist, candidates, len(node_x)).min(axis=1)
+
+    # nodes beyond the k candidates could still tie
+    for i in np.flatnonzero(dist[:, -1] <= min_dist[:, 0] * (1 + 1e-9)):
+        all_dist = np.sqrt((x[i, 0] - node_x)**2 + (y[i, 0] - node_y)**2)
+        first[i] = np.flatnonzero(all_dist == all_dist.min())[0]
+
+    near[valid] = node_mgra[first]
+    return near
+
+
 def add_intersection_count(model_dir, mgra_data):
     
     RSM_ABM_PROPERTIES = os.path.join(model_dir, "conf", "sandag_abm.properties")
@@ -162,12 +346,7 @@ def add_intersection_count(model_dir, mgra_data):
 
     mgra_nodes = nodes[nodes.MGRA > 0][['MGRA','XCOORD','YCOORD']]
     mgra_nodes.columns = ['mgra','x','y']
-    int_dict = {}
-    for int in intersections.iterrows():
-        mgra_nodes['dist'] = np.sqrt((int[1][1] - mgra_nodes['x'])**2+(int[1][2] - mgra_nodes['y'])**2)
-        int_dict[int[1][0]] = mgra_nodes.loc[mgra_nodes['dist'] == mgra_nodes['dist'].min()]['mgra'].values[0]
-
-    intersections['near_mgra'] = intersections['N'].map(int_dict)
+    intersections['near_mgra'] = nearest_mgra(intersections['X'], intersections['Y'], mgra_nodes)
     intersections = intersections.groupby('near_mgra', as_index = False).count()[['near_mgra','N']].rename(columns = {'near_mgra':'mgra','N':'icnt'})
     
     try:
@@ -177,6 +356,90 @@ def add_intersection_count(model_dir, mgra_data):
         
     return mgra_data
 
+def buffer_densities(mgra_data, equiv_min, pop_col='pop', int_radius=0.65, oth_radius=0.65):
+    """
+    density variables within a walk buffer around every MGRA.
+
+    The buffers are sparse MGRA x MGRA indicator matrices built once from
+    the equivalent minutes table, and every buffer total is taken in one
+    sparse matrix product with the MGRA data.
+
+    Parameters
+    ----------
+    mgra_data : mgra_data (pandas.DataFrame)
+        MGRA data with "mgra", "emp_total", "emp_retail",
+        "emp_personal_svcs_retail", "emp_restaurant_bar", "hh", pop_col,
+        "land_acres" and "icnt"
+    equiv_min : equiv_min (pandas.DataFrame)
+        walk equivalent minutes with "i", "j" and the distance "dist" in miles
+    pop_col : pop_col (str)
+        population column
+    int_radius : int_radius (float)
+        buffer radius in miles for the intersection count
+    oth_radius : oth_radius (float)
+        buffer radius in miles for the other totals
+
+    Returns
+    -------
+    pandas.DataFrame
+        "totint", "duden", "empden", "popden", "retempden" and
+        "PopEmpDenPerMi", indexed like mgra_data.  All are zero for MGRAs
+        without land in their buffer.
+    """
+    from scipy import sparse
+
+    oth_cols = ['emp_total', 'emp_retail', 'emp_personal_svcs_retail', 'emp_restaurant_bar',
+                'hh', pop_col, 'land_acres']
+    mgra_ids = pd.Index(mgra_data['mgra'].dropna().unique())
+    n_ids = len(mgra_ids)
+    row_code = mgra_ids.get_indexer(mgra_data['mgra'])
+    has_id = np.flatnonzero(row_code >= 0)
+
+    # totals of the rows of each mgra, missing values count as zero
+    rows_by_id = sparse.csr_matrix(
+        (np.ones(len(has_id)), (row_code[has_id], has_id)), shape=(n_ids, len(mgra_data))
+    )
+    values = np.nan_to_num(mgra_data[oth_cols + ['icnt']].to_numpy(dtype=np.float64))
+    values_by_id = rows_by_id @ values
+
+    i_code = mgra_ids.get_indexer(equiv_min['i'])
+    j_code = mgra_ids.get_indexer(equiv_min['j'])
+    dist = equiv_min['dist'].to_numpy()
+
+    def _buffer(radius):
+        pairs = (i_code >= 0) & (j_code >= 0) & (dist < radius)
+        buffer = sparse.csr_matrix(
+            (np.ones(pairs.sum()), (i_code[pairs], j_code[pairs])), shape=(n_ids, n_ids)
+        )
+        # an mgra counts once however often it appears in the table
+        buffer.sum_duplicates()
+        buffer.data[:] = 1
+        return buffer
+
+    oth_buffer = _buffer(oth_radius)
+    int_buffer = oth_buffer if int_radius == oth_radius else _buffer(int_radius)
+    oth_totals = oth_buffer @ values_by_id[:, :-1]
+    tot_int = int_buffer @ values_by_id[:, -1]
+
+    # mgras missing from the data have empty buffers
+    totals = np.zeros((len(mgra_data), len(oth_cols) + 1))
+    totals[has_id, :-1] = oth_totals[row_code[has_id]]
+    totals[has_id, -1] = tot_int[row_code[has_id]]
+    tot_emp, tot_ret1, tot_ret2, tot_ret3, tot_hh, tot_pop, tot_acres, tot_int = totals.T
+    tot_ret = tot_ret1 + tot_ret2 + tot_ret3
+
+    has_land = tot_acres > 0
+    acres = np.where(has_land, tot_acres, 1)
+    return pd.DataFrame({
+        'totint': np.where(has_land, tot_int, 0),
+        'duden': np.where(has_land, tot_hh / acres, 0),
+        'empden': np.where(has_land, tot_emp / acres, 0),
+        'popden': np.where(has_land, tot_pop / acres, 0),
+        'retempden': np.where(has_land, tot_ret / acres, 0),
+        'PopEmpDenPerMi': np.where(has_land, (tot_emp + tot_pop) / (acres / 640), 0),  # acres to miles
+    }, index=mgra_data.index)
+
+
 def add_density_variables(model_dir, mgra_data):
     #new_cols = ['totint','duden','empden','popden','retempden','totintbin','empdenbin','dudenbin','PopEmpDenPerMi']
     new_cols = ['totint', 'duden', 'empden', 'popden', 'retempden', 'PopEmpDenPerMi']
@@ -188,40 +451,13 @@ def add_density_variables(model_dir, mgra_data):
     #all street distance
     RSM_ABM_PROPERTIES = os.path.join(model_dir, "conf", "sandag_abm.properties")
     equivmins_file = get_property(RSM_ABM_PROPERTIES, "active.logsum.matrix.file.walk.mgra")
-    equiv_min = pd.read_csv(os.path.join(model_dir, "output", equivmins_file))
+    equiv_min = pd.read_csv(os.path.join(model_dir, "output", equivmins_file), usecols=['i', 'j', 'actual'])
 
     equiv_min['dist'] = equiv_min['actual']/60*3
 
-    def _density_function(mgra_in):
-        int_radius = 0.65 #mile
-        oth_radius = 0.65 #mile
-        eqmn = equiv_min[equiv_min['i'] == mgra_in]
-        mgra_circa_int = eqmn[eqmn['dist'] < int_radius]['j'].unique()
-        mgra_circa_oth = eqmn[eqmn['dist'] < oth_radius]['j'].unique()
-        totEmp = mgra_data[mgra_data.mgra.isin(mgra_circa_oth)]['emp_total'].sum()
-        totRet = mgra_data[mgra_data.mgra.isin(mgra_circa_oth)]['emp_retail'].sum() + mgra_data[mgra_data.mgra.isin(mgra_circa_oth)]['emp_personal_svcs_retail'].sum() + mgra_data[mgra_data.mgra.isin(mgra_circa_oth)]['emp_restaurant_bar'].sum()
-        totHH = mgra_data[mgra_data.mgra.isin(mgra_circa_oth)]['hh'].sum()
-        totPop = mgra_data[mgra_data.mgra.isin(mgra_circa_oth)]['pop'].sum()
-        totAcres = mgra_data[mgra_data.mgra.isin(mgra_circa_oth)]['land_acres'].sum()
-        totInt = mgra_data[mgra_data.mgra.isin(mgra_circa_int)]['icnt'].sum()
-        if(totAcres>0):
-            empDen = totEmp/totAcres
-            retDen = totRet/totAcres
-            duDen = totHH/totAcres
-            popDen = totPop/totAcres
-            popEmpDenPerMi = (totEmp+totPop)/(totAcres/640) #Acres to miles
-            tot_icnt = totInt
-        else:
-            empDen = 0
-            retDen = 0
-            duDen = 0
-            popDen = 0
-            popEmpDenPerMi = 0
-            tot_icnt = 0
-        
-        return tot_icnt,duDen,empDen,popDen,retDen,popEmpDenPerMi
-        
-    mgra_data["totint"],mgra_data["duden"],mgra_data["empden"],mgra_data["popden"],mgra_data["retempden"],mgra_data["PopEmpDenPerMi"] = zip(*mgra_data['mgra'].map(_density_function))
+    densities = buffer_densities(mgra_data, equiv_min)
+    for col in new_cols:
+        mgra_data[col] = densities[col]
 
     # mgra_data["totintbin"] = np.where(mgra_data["totint"] < 80, 1, np.where(mgra_data["totint"] < 130, 2, 3))
     # mgra_data["empdenbin"] = np.where(mgra_data["empden"] < 10, 1, np.where(mgra_data["empden"] < 30, 2,3))
@@ -232,18 +468,34 @@ def add_density_variables(model_dir, mgra_data):
     return mgra_data
 
 
-def scaleup_to_rsm_samplingrate(df, 
-                                household, 
-                                taz_crosswalk, 
-                                scale_factor, 
-                                study_area_tazs=None):
+def household_scale_factors(household, 
+                            taz_crosswalk, 
+                            scale_factor, 
+                            study_area_tazs=None, 
+                            household_weights=None):
     """
-    scales up the trips based on the sampling rate. 
-    
+    scale factor of every household, read once and shared by the trip tables.
+
+    Parameters
+    ----------
+    household : household (path_like)
+        synthetic household file with "hhid" and "taz"
+    taz_crosswalk : taz_crosswalk (path_like)
+        crosswalk from taz to RSM zone ("taz", "cluster_id")
+    scale_factor : scale_factor (int or float)
+        scale factor outside of the study area
+    study_area_tazs : study_area_tazs (list, optional)
+        RSM zones of the study area, scaled by 1
+    household_weights : household_weights (path_like, optional)
+        expansion weights written by the sampler ("hhid", "weight").  When
+        given, these replace scale_factor for the households listed in it.
+
+    Returns
+    -------
+    pandas.Series
+        scale factor indexed by hhid
     """
-    
-    hh = pd.read_csv(household)
-    hh = hh[['hhid', 'taz']]
+    hh = pd.read_csv(household, usecols=['hhid', 'taz'])
 
     rsm_zones = pd.read_csv(taz_crosswalk)
     dict_clusters = dict(zip(rsm_zones["taz"], rsm_zones["cluster_id"]))
@@ -253,10 +505,62 @@ def scaleup_to_rsm_samplingrate(df,
     
     if study_area_tazs:
         hh.loc[hh['taz'].isin(study_area_tazs), 'scale_factor'] = 1
+
+    scale_factors = hh.set_index('hhid')['scale_factor']
+
+    if household_weights is not None:
+        weights = pd.read_csv(household_weights).set_index('hhid')['weight']
+        scale_factors = scale_factors.astype(float)
+        scale_factors.update(weights)
+
+    return scale_factors
+
+def scaleup_to_rsm_samplingrate(df, 
+                                household, 
+                                taz_crosswalk, 
+                                scale_factor, 
+                                study_area_tazs=None,
+                                weighted=False):
+    """
+    scales up the trips based on the sampling rate. 
+
+    Parameters
+    ----------
+    df : df (pandas.DataFrame)
+        trips with "hh_id"
+    household : household (path_like or pandas.Series)
+        synthetic household file, or scale factors by hhid from
+        `household_scale_factors`, which then override scale_factor
+        and study_area_tazs
+    taz_crosswalk : taz_crosswalk (path_like)
+    scale_factor : scale_factor (int)
+    study_area_tazs : study_area_tazs (list, optional)
+        RSM zones of the study area, not scaled up
+    weighted : weighted (bool)
+        False (default) repeats every trip by its household's scale factor
+        (rounded down to whole trips).  True keeps one row per trip and adds
+        the scale factor as a "weight" column instead.
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
     
-    df = pd.merge(df, hh, left_on='hh_id', right_on='hhid', how='left')
-    final_df = df.loc[np.repeat(df.index, df['scale_factor'])]
-    final_df = final_df.drop(columns=['hhid', 'scale_factor', 'taz'])
+    if isinstance(household, pd.Series):
+        scale_factors = household
+    else:
+        scale_factors = household_scale_factors(
+            household, taz_crosswalk, scale_factor, study_area_tazs
+        )
+
+    factors = df['hh_id'].map(scale_factors)
+
+    if weighted:
+        final_df = df.copy()
+        final_df['weight'] = factors.astype(float)
+        return final_df
+
+    final_df = df.loc[np.repeat(df.index, factors.astype(int))]
     
     return final_df
 
@@ -1,81 +1,211 @@
+import hashlib
 import logging
+import multiprocessing
+from collections import namedtuple
 from functools import partial
 from numbers import Number
-from statistics import mode
+from pathlib import Path
 
 import geopandas as gpd
-import networkx as nx
 import numpy as np
 import pandas as pd
 import pyproj
+import shapely
+from shapely.ops import unary_union
+from scipy import sparse
 from scipy.optimize import minimize_scalar
-from sklearn.cluster import AgglomerativeClustering, KMeans
+from scipy.sparse.csgraph import connected_components
+from sklearn.cluster import (
+    AgglomerativeClustering,
+    Birch,
+    KMeans,
+    MiniBatchKMeans,
+    ward_tree,
+)
 from sklearn.preprocessing import OneHotEncoder
 from rsm.utility import *
 
 logger = logging.getLogger(__name__)
 
 
+# weighted average of a column by the sum of one or more weight columns
+WeightedAverage = namedtuple("WeightedAverage", ["weights"])
+
+
+def _grouped_mode(values, codes, n_groups):
+    """
+    Most common value in each group, the first one seen on ties (as `statistics.mode`).
+    """
+    value_codes, uniques = pd.factorize(values)
+    pairs = pd.DataFrame(
+        {"group": codes, "value": value_codes, "first": np.arange(len(codes))}
+    )
+    pairs = pairs[pairs["value"] >= 0]
+    counts = pairs.groupby(["group", "value"]).agg(
+        count=("first", "size"), first=("first", "min")
+    )
+    counts = counts.reset_index().sort_values(
+        ["group", "count", "first"], ascending=[True, False, True]
+    )
+    counts = counts.drop_duplicates("group")
+    result = pd.Series(np.nan, index=np.arange(n_groups), dtype=object)
+    result.iloc[counts["group"].to_numpy()] = uniques.take(counts["value"].to_numpy())
+    return result
+
+
+def _aggregate_zone_data(gdf, agg_instruction, cluster_id, weight_backstop):
+    """
+    Group-by aggregation of zone data, with weighted averages and modes vectorized.
+
+    Instructions that are a `WeightedAverage` or "mode" are computed for all
+    groups at once; everything else is passed to `DataFrame.groupby().agg`.
+    `weight_backstop` is a scalar or one value per row of gdf, rows without
+    a cluster id are dropped from both.
+    """
+    clustered = gdf[cluster_id].notna().to_numpy()
+    backstop = np.broadcast_to(np.asarray(weight_backstop, dtype=float), len(gdf))[clustered]
+    gdf = gdf[clustered]
+    special = {
+        c: f
+        for c, f in agg_instruction.items()
+        if isinstance(f, WeightedAverage) or (isinstance(f, str) and f == "mode")
+    }
+    others = {c: f for c, f in agg_instruction.items() if c not in special}
+
+    grouped = gdf.groupby(cluster_id)
+    if others:
+        aggregated = grouped.agg(others)
+    else:
+        aggregated = pd.DataFrame(index=grouped.size().index)
+    if not special:
+        return aggregated
+
+    group_ids, codes = np.unique(gdf[cluster_id].to_numpy(), return_inverse=True)
+    n_groups = len(group_ids)
+    sizes = np.bincount(codes, minlength=n_groups)
+
+    results = {}
+    for c, f in special.items():
+        if isinstance(f, WeightedAverage):
+            values = gdf[c].to_numpy(dtype=float)
+            weights = gdf[f.weights[0]]
+            for w in f.weights[1:]:
+                weights = weights + gdf[w]
+            weights = weights.to_numpy(dtype=float) + backstop
+            weight_sums = np.bincount(codes, weights=weights, minlength=n_groups)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                result = (
+                    np.bincount(codes, weights=values * weights, minlength=n_groups)
+                    / weight_sums
+                )
+                # zero weights fall back to the plain average
+                result = np.where(
+                    weight_sums == 0,
+                    np.bincount(codes, weights=values, minlength=n_groups) / sizes,
+                    result,
+                )
+            results[c] = result
+        else:
+            modes = _grouped_mode(gdf[c].to_numpy(), codes, n_groups)
+            if not modes.isna().any():
+                modes = modes.astype(gdf[c].dtype)
+            results[c] = modes.to_numpy()
+
+    results = pd.DataFrame(results, index=aggregated.index)
+    return pd.concat([aggregated, results], axis=1)[list(agg_instruction)]
+
+
+def _dissolve_geometry(gdf, cluster_id):
+    """
+    Union the geometry of gdf by cluster, like `dissolve`.
+
+    Zones that tile the region with shared edges, such as the topology
+    simplified MGRAs from `simplify_shapefile`, are merged with a coverage
+    union, which only drops the shared edges and so is much faster than a
+    full overlay and leaves no slivers.  Clusters whose zones are not a
+    clean coverage fall back to the full union.
+
+    Returns
+    -------
+    GeoDataFrame
+        indexed by sorted cluster id
+    """
+    codes, clusters = pd.factorize(gdf[cluster_id], sort=True)
+    keep = np.flatnonzero(codes >= 0)
+    order = keep[np.argsort(codes[keep], kind="stable")]
+    geoms = np.asarray(gdf.geometry.values[order], dtype=object)
+    bounds = np.r_[0, np.cumsum(np.bincount(codes[keep], minlength=len(clusters)))]
+    # shapely < 2 has no coverage union
+    coverage_union = getattr(shapely, "coverage_union_all", None)
+    merged = []
+    n_fallback = 0
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        parts = geoms[start:stop]
+        union = None
+        if coverage_union is not None:
+            try:
+                union = coverage_union(parts)
+            except shapely.errors.GEOSException:
+                pass
+        if union is None or not union.is_valid:
+            union = unary_union(list(parts))
+            n_fallback += 1
+        merged.append(union)
+    if n_fallback:
+        logger.info(f"{n_fallback} clusters are not a clean coverage")
+    return gpd.GeoDataFrame(
+        geometry=merged,
+        index=pd.Index(clusters, name=cluster_id),
+        crs=gdf.crs,
+    )
+
+
 def merge_zone_data(
     gdf,
     agg_instruction=None,
     cluster_id="cluster_id",
 ):
-    if agg_instruction is None:
-        # make a sliver of area series as a backstop for weighted avg on other things
-        # we add this small value to each weighting, so that if the desired weighting values
-        # are all zero for any weighted average, the geographic area becomes the backup
-        # weight ... and if any are non-zero, then these areas round off to effectively nil.
-        
-        if "geometry" in gdf.columns:
-            gdf_area_small = gdf.area / gdf.area.mean() / 1000
-        else:
-            gdf_area_small = 0.000000001
+    """
+    Aggregate zone data (e.g. MGRAs) to clusters.
 
-        def wgt_avg_by(x, c):
-            try:
-                if "geometry" in gdf.columns:
-                    return np.average(
-                        x, weights=gdf.loc[x.index, c] + gdf_area_small.loc[x.index]
-                    )
-                else:
-                    return np.average(
-                        x, weights=gdf.loc[x.index, c] + gdf_area_small
-                    )
-                    
-            except ZeroDivisionError:
-                return np.average(x)
-
-        wgt_avg_by_hh = lambda x: wgt_avg_by(x, "hh")
-        wgt_avg_hpc = lambda x: wgt_avg_by(x, "hstallssam")
-        wgt_avg_dpc = lambda x: wgt_avg_by(x, "dstallssam")
-        wgt_avg_mpc = lambda x: wgt_avg_by(x, "mstallssam")
-        wgt_avg_by_pop = lambda x: wgt_avg_by(x, "pop")
-        wgt_avg_empden = lambda x: wgt_avg_by(x, "emp_total")
-        wgt_avg_popden = lambda x: wgt_avg_by(x, "pop")
-        wgt_avg_rtempden = lambda x: wgt_avg_by(x, "emp_retail")
-
-        def wgt_avg_peden(x):
-            try:
-                if "geometry" in gdf.columns:
-                    return np.average(
-                        x,
-                        weights=gdf.loc[x.index, "emp_total"]
-                        + gdf.loc[x.index, "pop"]
-                        + gdf_area_small.loc[x.index],
-                    )
-                else:
-                    return np.average(
-                        x,
-                        weights=gdf.loc[x.index, "emp_total"]
-                        + gdf.loc[x.index, "pop"]
-                        + gdf_area_small,
-                    )
-                    
-            except ZeroDivisionError:
-                return np.average(x)
+    Parameters
+    ----------
+    gdf : gdf (pandas.DataFrame or geopandas.GeoDataFrame)
+        zone data, with geometry if the clusters should be dissolved
+    agg_instruction : agg_instruction (dict, optional)
+        aggregation by column, as for `DataFrame.groupby().agg`.  Two more
+        instructions are computed for all clusters at once:
+        `WeightedAverage(weights)` averages a column weighted by the sum of the
+        `weights` columns, and "mode" takes the most common value.  Default
+        is the instruction for the SANDAG MGRA data.
+    cluster_id : cluster_id (str)
+        column of the cluster ids
 
-        get_mode = lambda x: mode(x)
+    Returns
+    -------
+    pandas.DataFrame or geopandas.GeoDataFrame
+    """
+    # make a sliver of area series as a backstop for weighted avg on other things
+    # we add this small value to each weighting, so that if the desired weighting values
+    # are all zero for any weighted average, the geographic area becomes the backup
+    # weight ... and if any are non-zero, then these areas round off to effectively nil.
+    if "geometry" in gdf.columns:
+        gdf_area_small = (gdf.area / gdf.area.mean() / 1000).to_numpy()
+    else:
+        gdf_area_small = 0.000000001
+
+    if agg_instruction is None:
+        wgt_avg_by_hh = WeightedAverage(("hh",))
+        wgt_avg_hpc = WeightedAverage(("hstallssam",))
+        wgt_avg_dpc = WeightedAverage(("dstallssam",))
+        wgt_avg_mpc = WeightedAverage(("mstallssam",))
+        wgt_avg_by_pop = WeightedAverage(("pop",))
+        wgt_avg_empden = WeightedAverage(("emp_total",))
+        wgt_avg_popden = WeightedAverage(("pop",))
+        wgt_avg_rtempden = WeightedAverage(("emp_retail",))
+        wgt_avg_peden = WeightedAverage(("emp_total", "pop"))
+
+        get_mode = "mode"
         agg_instruction = {
             "hs": "sum",
             "hs_sf": "sum",
@@ -181,11 +311,15 @@ def merge_zone_data(
         }  
     
     if "geometry" in gdf.columns:
-        dissolved = gdf[[cluster_id, "geometry"]].dissolve(by=cluster_id)
-        other_data = gdf.groupby(cluster_id).agg(agg_instruction)
+        dissolved = _dissolve_geometry(gdf, cluster_id)
+        other_data = _aggregate_zone_data(
+            gdf, agg_instruction, cluster_id, gdf_area_small
+        )
         dissolved = dissolved.join(other_data)
     else:
-        dissolved = gdf.groupby(cluster_id).agg(agg_instruction)
+        dissolved = _aggregate_zone_data(
+            gdf, agg_instruction, cluster_id, gdf_area_small
+        )
 
     # adding bins
     dissolved["totintbin"] = np.where(dissolved["totint"] < 80, 1, np.where(dissolved["totint"] < 130, 2, 3))
@@ -195,6 +329,217 @@ def merge_zone_data(
     return dissolved
 
 
+def _ward_dendrogram(data, connectivity, cache_dir=None):
+    """
+    Full merge tree of the connectivity-constrained Ward clustering of data.
+
+    Parameters
+    ----------
+    data : data (array)
+        cluster factors, one row per zone
+    connectivity : connectivity (sparse matrix)
+        adjacency of the zones
+    cache_dir : cache_dir (path_like, optional)
+        The tree is saved here, keyed by a hash of data and connectivity,
+        and loaded instead of being built again.
+
+    Returns
+    -------
+    numpy.ndarray
+        children, the (n_zones - 1, 2) merges as in `AgglomerativeClustering`
+    """
+    data = np.ascontiguousarray(data, dtype=np.float64)
+    connectivity = sparse.csr_matrix(connectivity)
+    cache_file = None
+    if cache_dir is not None:
+        key = hashlib.sha1(str(data.shape).encode("utf-8"))
+        key.update(data.tobytes())
+        for array in (connectivity.indptr, connectivity.indices):
+            key.update(np.ascontiguousarray(array, dtype=np.int64).tobytes())
+        cache_file = Path(cache_dir).expanduser().joinpath(
+            f"dendrogram_{key.hexdigest()[:16]}.npz"
+        )
+        if cache_file.exists():
+            logger.info(f"loading dendrogram from {cache_file}")
+            return np.load(cache_file)["children"]
+
+    children = ward_tree(data, connectivity=connectivity)[0]
+
+    if cache_file is not None:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        np.savez(cache_file, children=children)
+        logger.info(f"saved dendrogram to {cache_file}")
+    return children
+
+
+def _cut_dendrogram(children, n_leaves, n_clusters):
+    """
+    Cluster labels from cutting a full merge tree into n_clusters.
+
+    The clusters are those left after the first n_leaves - n_clusters
+    merges, the partition `AgglomerativeClustering` returns for n_clusters.
+    They are numbered in the order of their first zone.
+    """
+    n_merges = n_leaves - n_clusters
+    parents = np.arange(n_leaves + n_merges)
+    parents[children[:n_merges].ravel()] = np.repeat(
+        np.arange(n_leaves, n_leaves + n_merges), 2
+    )
+    # follow the parents up to the head of each cluster
+    while True:
+        heads = parents[parents]
+        if np.array_equal(heads, parents):
+            break
+        parents = heads
+    _, first_zone, labels = np.unique(
+        heads[:n_leaves], return_index=True, return_inverse=True
+    )
+    order = np.empty(len(first_zone), dtype=np.intp)
+    order[np.argsort(first_zone)] = np.arange(len(first_zone))
+    return order[labels]
+
+
+def _rook_adjacency(gdf, cache_dir=None):
+    """
+    Sparse adjacency matrix of the zones in gdf sharing a border.
+
+    Parameters
+    ----------
+    gdf : gdf (GeoDataFrame)
+    cache_dir : cache_dir (path_like, optional)
+        The matrix is saved here, keyed by a hash of the geometry, and loaded
+        instead of being built again.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        in the row order of gdf
+    """
+    from libpysal.weights import Rook
+
+    cache_file = None
+    if cache_dir is not None:
+        key = hashlib.sha1(str(len(gdf)).encode("utf-8"))
+        for wkb in gdf.geometry.to_wkb():
+            key.update(wkb)
+        cache_file = Path(cache_dir).expanduser().joinpath(
+            f"rook_{key.hexdigest()[:16]}.npz"
+        )
+        if cache_file.exists():
+            logger.info(f"loading rook adjacency from {cache_file}")
+            return sparse.load_npz(cache_file).tocsr()
+
+    w_rook = Rook.from_dataframe(gdf)
+    adjacency = sparse.csr_matrix(w_rook.sparse)
+
+    if cache_file is not None:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        sparse.save_npz(cache_file, adjacency)
+        logger.info(f"saved rook adjacency to {cache_file}")
+    return adjacency
+
+
+def _subset_adjacency(adjacency, mask):
+    keep = np.flatnonzero(np.asarray(mask))
+    return sparse.csr_matrix(adjacency)[keep][:, keep]
+
+
+def _uses_adjacency(method, repair_contiguity):
+    if repair_contiguity is None:
+        repair_contiguity = method in ("minibatch_kmeans", "birch")
+    return method == "agglom_adj" or bool(repair_contiguity)
+
+
+def _birch_labels(data, n_clusters, threshold=None):
+    """
+    Cluster labels from BIRCH, followed by Ward clustering of its subclusters.
+
+    The default threshold is the typical radius of a cluster when the data is
+    split evenly into n_clusters, which keeps the subclusters few enough for
+    the Ward step.  It is halved until there are at
+    least n_clusters subclusters.
+    """
+    if threshold is None:
+        threshold = np.sqrt(np.var(data, axis=0).sum() / n_clusters)
+    while True:
+        birch = Birch(threshold=threshold, n_clusters=None)
+        birch.fit(data)
+        n_subclusters = len(birch.subcluster_centers_)
+        if n_subclusters >= n_clusters or threshold == 0:
+            break
+        logger.info(
+            f"birch threshold {threshold:.4g} gave {n_subclusters} subclusters, "
+            f"fewer than {n_clusters}"
+        )
+        threshold /= 2
+    logger.info(f"birch made {n_subclusters} subclusters for {len(data)} zones")
+    agglom = AgglomerativeClustering(n_clusters=n_clusters, linkage="ward")
+    subcluster_labels = agglom.fit_predict(birch.subcluster_centers_)
+    return subcluster_labels[birch.predict(data)]
+
+
+def _repair_contiguity(cluster_id, adjacency):
+    """
+    Make each cluster spatially connected.
+
+    The largest connected part of each cluster keeps its label.  Every other
+    part moves to the adjacent cluster it shares the most borders with
+    (ties go to the lower label), repeating until all parts are attached.
+    Parts with no neighbors at all, such as islands, are left as they are.
+
+    Parameters
+    ----------
+    cluster_id : cluster_id (array[int])
+        cluster label of each zone
+    adjacency : adjacency (sparse matrix)
+        adjacency of the zones, in the same order as cluster_id
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    cluster_id = np.asarray(cluster_id).copy()
+    adjacency = sparse.coo_matrix(adjacency)
+    rows, cols = adjacency.row, adjacency.col
+    n = len(cluster_id)
+    while True:
+        same = cluster_id[rows] == cluster_id[cols]
+        within = sparse.csr_matrix(
+            (np.ones(same.sum()), (rows[same], cols[same])), shape=(n, n)
+        )
+        n_parts, part = connected_components(within, directed=False)
+        part_size = np.bincount(part, minlength=n_parts)
+        part_label = np.zeros(n_parts, dtype=cluster_id.dtype)
+        part_label[part] = cluster_id
+        # the largest part of each cluster, first found wins ties
+        order = np.lexsort((-part_size, part_label))
+        is_main = np.zeros(n_parts, dtype=bool)
+        sorted_label = part_label[order]
+        is_main[order[np.r_[True, sorted_label[1:] != sorted_label[:-1]]]] = True
+        if is_main.all():
+            return cluster_id
+
+        # borders between fragments and the main parts of other clusters
+        border = ~is_main[part[rows]] & is_main[part[cols]]
+        if not border.any():
+            logger.warning(
+                f"{(~is_main).sum()} cluster fragments have no neighbors to join"
+            )
+            return cluster_id
+        fragment = part[rows[border]]
+        target = part_label[part[cols[border]]]
+        pairs, n_borders = np.unique(
+            np.stack([fragment, target]), axis=1, return_counts=True
+        )
+        # most borders first, then lowest label
+        order = np.lexsort((pairs[1], -n_borders, pairs[0]))
+        pairs = pairs[:, order]
+        first = np.r_[True, pairs[0, 1:] != pairs[0, :-1]]
+        new_label = part_label.copy()
+        new_label[pairs[0, first]] = pairs[1, first]
+        cluster_id = new_label[part]
+
+
 def aggregate_zones(
     mgra_gdf,
     method="kmeans",
@@ -207,6 +552,12 @@ def aggregate_zones(
     explicit_col="mgra",
     agg_instruction=None,
     start_cluster_ids=13,
+    dendrogram_cache=None,
+    repair_contiguity=None,
+    birch_threshold=None,
+    adjacency=None,
+    adjacency_cache=None,
+    return_labels=False,
 ):
     """
     Aggregate zones.
@@ -216,7 +567,9 @@ def aggregate_zones(
     mgra_gdf : mgra_gdf (GeoDataFrame)
         Geometry and attibutes of MGRAs
     method : method (array)
-        default {'kmeans', 'agglom', 'agglom_adj'}
+        default {'kmeans', 'agglom', 'agglom_adj', 'minibatch_kmeans', 'birch'}
+        'minibatch_kmeans' and 'birch' scale to many more input zones than
+        the agglomerative methods, whose memory and time grow quickly.
     n_zones : n_zones (int)
     random_state : random_state (RandomState or int)
     cluster_factors : cluster_factors (dict)
@@ -236,10 +589,34 @@ def aggregate_zones(
         Cluster id's start at this value.  Can be 1, but typically SANDAG has the
         smallest id's reserved for external zones, so starting at a greater value
         is typical.
+    dendrogram_cache : dendrogram_cache (path_like, optional)
+        Directory for the full merge tree of the 'agglom_adj' clustering, saved
+        under a hash of the cluster factors and the adjacency.  The tree is
+        built once and then cut at any `n_zones`, giving the same clusters as
+        clustering from scratch (numbered in the order of their first zone).
+        Default None clusters from scratch.
+    repair_contiguity : repair_contiguity (bool, optional)
+        Reassign the parts of each cluster that are not connected to its
+        largest part to the adjacent cluster they share the most borders with,
+        so clusters are spatially connected as with 'agglom_adj'.  Default
+        None repairs 'minibatch_kmeans' and 'birch' clusters only.
+    birch_threshold : birch_threshold (float, optional)
+        Subcluster radius for 'birch', in the units of the cluster factors.
+        Default None sizes it from the spread of the data and `n_zones`.
+    adjacency : adjacency (sparse matrix, optional)
+        Rook adjacency of the rows of mgra_gdf, used by 'agglom_adj' and the
+        contiguity repair.  Default None builds it from the geometry.
+    adjacency_cache : adjacency_cache (path_like, optional)
+        Directory where a built adjacency is saved under a hash of the
+        geometry, and loaded from when the same zones are aggregated again.
+    return_labels : return_labels (bool, default False)
+        Also return the cluster id of each row of mgra_gdf, for `make_crosswalk`.
 
     Returns
     -------
     GeoDataFrame
+    pandas.Series, optional
+        cluster id indexed like mgra_gdf, if return_labels
     """
 
     if cluster_factors is None:
@@ -272,6 +649,13 @@ def aggregate_zones(
         mgra_gdf_explicit = None
         n_zones_algorithm = n_zones
 
+    def _algo_adjacency():
+        if adjacency is None:
+            return _rook_adjacency(mgra_gdf_algo, adjacency_cache)
+        if mgra_gdf_explicit is None:
+            return sparse.csr_matrix(adjacency)
+        return _subset_adjacency(adjacency, ~in_explicit)
+
     if use_xy:
         geometry = mgra_gdf_algo.centroid
         X = list(geometry.apply(lambda p: p.x))
@@ -306,21 +690,41 @@ def aggregate_zones(
         )
         agglom.fit_predict(data)
         cluster_id = agglom.labels_
-    elif method == "agglom_adj":
-        from libpysal.weights import Rook
-
-        w_rook = Rook.from_dataframe(mgra_gdf_algo)
-        adj_mat = nx.adjacency_matrix(w_rook.to_networkx())
-        agglom = AgglomerativeClustering(
+    elif method == "minibatch_kmeans":
+        kmeans = MiniBatchKMeans(
             n_clusters=n_zones_algorithm,
-            affinity="euclidean",
-            linkage="ward",
-            connectivity=adj_mat,
+            random_state=random_state,
+            batch_size=4096,
+            n_init=3,
         )
-        agglom.fit_predict(data)
-        cluster_id = agglom.labels_
+        kmeans.fit(data)
+        cluster_id = kmeans.labels_
+    elif method == "birch":
+        cluster_id = _birch_labels(data, n_zones_algorithm, birch_threshold)
+    elif method == "agglom_adj":
+        adj_mat = _algo_adjacency()
+        if dendrogram_cache is not None:
+            children = _ward_dendrogram(data, adj_mat, dendrogram_cache)
+            cluster_id = _cut_dendrogram(children, len(data), n_zones_algorithm)
+        else:
+            agglom = AgglomerativeClustering(
+                n_clusters=n_zones_algorithm,
+                affinity="euclidean",
+                linkage="ward",
+                connectivity=adj_mat,
+            )
+            agglom.fit_predict(data)
+            cluster_id = agglom.labels_
     else:
         raise NotImplementedError(method)
+
+    if repair_contiguity is None:
+        repair_contiguity = method in ("minibatch_kmeans", "birch")
+    if repair_contiguity and method != "agglom_adj":
+        cluster_id = _repair_contiguity(cluster_id, _algo_adjacency())
+    if method in ("minibatch_kmeans", "birch") or repair_contiguity:
+        cluster_id = np.unique(cluster_id, return_inverse=True)[1]
+        n_zones_algorithm = int(cluster_id.max()) + 1
     mgra_gdf_algo["cluster_id"] = cluster_id
 
     if mgra_gdf_explicit is None or len(mgra_gdf_explicit) == 0:
@@ -353,6 +757,12 @@ def aggregate_zones(
         combined = pd.concat(pending, ignore_index=False)
     combined = combined.reset_index(drop=True)
 
+    if return_labels:
+        labels = pd.Series(n + np.asarray(cluster_id), index=mgra_gdf_algo.index)
+        if mgra_gdf_explicit is not None:
+            labels = pd.concat([labels, mgra_gdf_explicit["cluster_id"]])
+        labels = labels.reindex(mgra_gdf.index).rename("cluster_id")
+        return combined, labels
     return combined
 
 
@@ -383,7 +793,40 @@ def aggregate_zones_within_districts(
     agg_instruction=None,
     district_col="district27",
     district_focus=None,
+    dendrogram_cache=None,
+    repair_contiguity=None,
+    birch_threshold=None,
+    max_workers=1,
+    adjacency_cache=None,
 ):
+    """
+    Aggregate zones separately within each district.
+
+    The number of zones in each district is scaled from its share of the
+    input zones, `district_focus` scales it further for chosen districts.
+    Other parameters are as in `aggregate_zones`, each district is clustered
+    with `random_state` plus the district number.
+
+    Parameters
+    ----------
+    district_col : district_col (str)
+        column of mgra_gdf with the district of each zone
+    district_focus : district_focus (dict, optional)
+        factor on the number of zones by district
+    max_workers : max_workers (int, optional)
+        number of processes clustering districts in parallel.  1 (default)
+        clusters the districts one at a time in this process, None uses all
+        available cores.  The result is the same either way.
+        When called from a script with max_workers other than 1, the script
+        must be guarded by `if __name__ == "__main__":`.
+    adjacency_cache : adjacency_cache (path_like, optional)
+        The Rook adjacency of all of mgra_gdf is built once, or loaded from
+        here, and sliced for each district.
+
+    Returns
+    -------
+    GeoDataFrame
+    """
     logger.info("aggregate_zones_within_districts...")
     if district_focus is None:
         district_focus = {}
@@ -398,30 +841,117 @@ def aggregate_zones_within_districts(
     agg_by_district = (
         _scale_zones(zone_factor, zones_by_district, district_focus).round().astype(int)
     )
-    out = []
+    if _uses_adjacency(method, repair_contiguity):
+        adjacency = _rook_adjacency(mgra_gdf, adjacency_cache)
+    else:
+        adjacency = None
+    tasks = []
     for district_n, district_z in agg_by_district.items():
-        district_gdf = mgra_gdf[mgra_gdf[district_col] == district_n]
+        in_district = mgra_gdf[district_col] == district_n
+        district_gdf = mgra_gdf[in_district]
         logger.info(
             f"combining district {district_n} from {len(district_gdf)} zones into {district_z} zones"
         )
-        out.append(
-            aggregate_zones(
+        tasks.append(
+            (
                 district_gdf,
-                method=method,
-                n_zones=district_z,
-                random_state=random_state + district_n,
-                cluster_factors=cluster_factors,
-                cluster_factors_onehot=cluster_factors_onehot,
-                use_xy=use_xy,
-                explicit_agg=explicit_agg,
-                explicit_col=explicit_col,
-                agg_instruction=agg_instruction,
+                dict(
+                    method=method,
+                    n_zones=district_z,
+                    random_state=random_state + district_n,
+                    cluster_factors=cluster_factors,
+                    cluster_factors_onehot=cluster_factors_onehot,
+                    use_xy=use_xy,
+                    explicit_agg=explicit_agg,
+                    explicit_col=explicit_col,
+                    agg_instruction=agg_instruction,
+                    dendrogram_cache=dendrogram_cache,
+                    repair_contiguity=repair_contiguity,
+                    birch_threshold=birch_threshold,
+                    adjacency=(
+                        None
+                        if adjacency is None
+                        else _subset_adjacency(adjacency, in_district)
+                    ),
+                ),
             )
         )
+
+    if max_workers == 1:
+        out = [_aggregate_district(task) for task in tasks]
+    else:
+        # largest districts first to balance the workers, results are put
+        # back in district order so the output matches the sequential run
+        order = sorted(range(len(tasks)), key=lambda i: -len(tasks[i][0]))
+        out = [None] * len(tasks)
+        with multiprocessing.Pool(processes=max_workers) as pool:
+            results = pool.imap_unordered(
+                _aggregate_district_worker, [(i, tasks[i]) for i in order]
+            )
+            for i, result in results:
+                out[i] = result
     return pd.concat(out).reset_index(drop=True)
 
 
-def make_crosswalk(new_zones, old_zones, new_index="cluster_id", old_index=None):
+def _aggregate_district(task):
+    district_gdf, kwargs = task
+    return aggregate_zones(district_gdf, **kwargs)
+
+
+def _aggregate_district_worker(args):
+    i, task = args
+    return i, _aggregate_district(task)
+
+
+def _containing_zone(new_zones, old_zones):
+    """
+    Index of the new zone containing a representative point of each old zone.
+    """
+    points = old_zones.representative_point().to_crs(new_zones.crs)
+    point_i, zone_i = new_zones.sindex.query(points.values, predicate="within")
+    point_i, first = np.unique(point_i, return_index=True)
+    if len(point_i) < len(old_zones):
+        missing = np.setdiff1d(np.arange(len(old_zones)), point_i)
+        raise ValueError(
+            f"{len(missing)} zones are not within any new zone, "
+            f"e.g. {list(old_zones.index[missing[:5]])}"
+        )
+    return new_zones.index.values[zone_i[first]]
+
+
+def make_crosswalk(
+    new_zones,
+    old_zones,
+    new_index="cluster_id",
+    old_index=None,
+    labels=None,
+    label_key=None,
+):
+    """
+    Crosswalk from old zones to the new zones containing them.
+
+    Parameters
+    ----------
+    new_zones : new_zones (GeoDataFrame)
+    old_zones : old_zones (GeoDataFrame)
+    new_index : new_index (str)
+        column or index of new_zones with the new zone id
+    old_index : old_index (str, optional)
+        column or index of old_zones with the old zone id
+    labels : labels (pandas.Series, optional)
+        new zone id by old zone, as returned by `aggregate_zones` with
+        `return_labels`.  The crosswalk is then taken from the labels, and
+        only old zones without a label are located in the new zone geometry.
+        Default None locates every old zone.
+    label_key : label_key (str, optional)
+        column of old_zones to look up in the labels, e.g. 'taz' to map MGRAs
+        by the labels of their TAZs.  Default None uses the old zone id.
+
+    Returns
+    -------
+    DataFrame
+        old and new zone ids, in the order of old_zones
+    """
     if new_index is not None and (
         new_index in new_zones.columns or not isinstance(new_index, str)
     ):
@@ -430,15 +960,26 @@ def make_crosswalk(new_zones, old_zones, new_index="cluster_id", old_index=None)
         old_index in old_zones.columns or not isinstance(old_index, str)
     ):
         old_zones = old_zones.set_index(old_index)
-    crosswalk = new_zones[["geometry"]].sjoin(
-        gpd.GeoDataFrame(
-            geometry=old_zones.representative_point(),
-            index=old_zones.index,
-        ).to_crs(new_zones.crs),
-        how="right",
-        predicate="contains",
-    )
-    crosswalk = crosswalk["index_left"].astype(int).rename(new_index).to_frame()
+    if labels is None:
+        crosswalk = new_zones[["geometry"]].sjoin(
+            gpd.GeoDataFrame(
+                geometry=old_zones.representative_point(),
+                index=old_zones.index,
+            ).to_crs(new_zones.crs),
+            how="right",
+            predicate="contains",
+        )
+        crosswalk = crosswalk["index_left"].astype(int).rename(new_index).to_frame()
+    else:
+        keys = old_zones.index if label_key is None else old_zones[label_key]
+        new_zone = np.array(labels.reindex(keys), dtype=np.float64)
+        unlabeled = np.isnan(new_zone)
+        if unlabeled.any():
+            logger.info(f"locating {unlabeled.sum()} unlabeled zones")
+            new_zone[unlabeled] = _containing_zone(new_zones, old_zones[unlabeled])
+        crosswalk = pd.DataFrame(
+            {new_index: new_zone.astype(int)}, index=old_zones.index
+        )
     if old_zones.index.name:
         crosswalk = crosswalk.rename_axis(index=old_zones.index.name)
     return crosswalk.reset_index()
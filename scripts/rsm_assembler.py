@@ -37,16 +37,21 @@ HOUSEHOLDS = os.path.join(rsm_dir, "input", "households.csv")
 MGRA_CROSSWALK = os.path.join(rsm_dir, "input", "mgra_crosswalk.csv")
 TAZ_CROSSWALK = os.path.join(rsm_dir, "input", "taz_crosswalk.csv")
 STUDY_AREA = os.path.join(rsm_dir, "input", "study_area.csv")
+HOUSEHOLD_WEIGHTS = os.path.join(rsm_dir, "input", "sampled_household_weights.csv")
+DONOR_TRIP_CACHE = os.path.join(rsm_dir, "output", "donor_trip_cache")
 
 #creating copy of individual and joint trips file
-shutil.copy(RSM_INDIV_TRIPS, os.path.join(rsm_dir, "output", "indivTripData_abm_"+ str(iteration) + ".csv"))
+RSM_INDIV_TRIPS_COPY = os.path.join(rsm_dir, "output", "indivTripData_abm_"+ str(iteration) + ".csv")
+shutil.copy(RSM_INDIV_TRIPS, RSM_INDIV_TRIPS_COPY)
 shutil.copy(RSM_JOINT_TRIPS, os.path.join(rsm_dir, "output", "jointTripData_abm_"+ str(iteration) + ".csv"))
 
 ABM_PROPERTIES_FOLDER = os.path.join(rsm_dir, "conf")
 ABM_PROPERTIES = os.path.join(ABM_PROPERTIES_FOLDER, "sandag_abm.properties")
-RUN_ASSEMBLER = int(get_property(ABM_PROPERTIES, "run.rsm.assembler"))
-SAMPLE_RATE = float(get_property(ABM_PROPERTIES, "rsm.default.sampling.rate"))
-USE_DIFFERENTIAL_SAMPLING = int(get_property(ABM_PROPERTIES, "use.differential.sampling"))
+properties = load_properties(ABM_PROPERTIES)
+RUN_ASSEMBLER = properties.get_int("run.rsm.assembler")
+SAMPLE_RATE = properties.get_float("rsm.default.sampling.rate")
+USE_DIFFERENTIAL_SAMPLING = properties.get_int("use.differential.sampling")
+WEIGHTED_OUTPUT = properties.get_int("rsm.assembler.weighted.output", default=0)
 
 if USE_DIFFERENTIAL_SAMPLING & os.path.exists(STUDY_AREA):
     logging.info(f"Study Area file: {STUDY_AREA}")
@@ -64,21 +69,29 @@ else:
     SA_TAZ = None
 
 #RSM Assembler
+# with the assembler on, individual trips are streamed from the copy of the
+# RSM trips straight into the final trip file
 final_ind_trips, final_jnt_trips = rsm_assemble(
     ORG_INDIV_TRIPS,
     ORG_JOINT_TRIPS,
-    RSM_INDIV_TRIPS,
+    RSM_INDIV_TRIPS_COPY,
     RSM_JOINT_TRIPS,
     HOUSEHOLDS,
     MGRA_CROSSWALK,
     TAZ_CROSSWALK,
     SAMPLE_RATE,
     SA_TAZ,
-    RUN_ASSEMBLER
+    RUN_ASSEMBLER,
+    weighted_output=WEIGHTED_OUTPUT,
+    household_weights=HOUSEHOLD_WEIGHTS if os.path.exists(HOUSEHOLD_WEIGHTS) else None,
+    donor_cache_dir=DONOR_TRIP_CACHE,
+    output_indiv=RSM_INDIV_TRIPS if RUN_ASSEMBLER == 1 else None,
+    trip_changes_file=os.path.join(rsm_dir, "output", "rsm_trip_changes_" + str(iteration) + ".csv"),
 )
 
 #save as csv files
-final_ind_trips.to_csv(os.path.join(rsm_dir, "output", "indivTripData_" + str(iteration) + ".csv"), index = False)
+if final_ind_trips is not None:
+    final_ind_trips.to_csv(os.path.join(rsm_dir, "output", "indivTripData_" + str(iteration) + ".csv"), index = False)
 final_jnt_trips.to_csv(os.path.join(rsm_dir, "output", "jointTripData_" + str(iteration) + ".csv"), index = False)
 
 logging.info("finished logging rsm_assembler")
\ No newline at end of file
@@ -7,6 +7,7 @@
 #   org_model_dir: Donor model directory
 #   num_rsm_zones: Number of RSM zones
 #   num_ext_zones: Number of external zones
+#   max_workers (optional): number of processes aggregating input files, default 1, 0 for all cores
 #
 # outputs:
 #   aggregated csv files
@@ -30,64 +31,69 @@ from rsm.zone_agg import (
 from rsm.input_agg import agg_input_files
 from rsm.utility import *
 
-rsm_main_dir = sys.argv[1]
-org_model_dir = sys.argv[2]
-num_rsm_zones = int(sys.argv[3])
-num_ext_zones = int(sys.argv[4])
+if __name__ == "__main__":
+    rsm_main_dir = sys.argv[1]
+    org_model_dir = sys.argv[2]
+    num_rsm_zones = int(sys.argv[3])
+    num_ext_zones = int(sys.argv[4])
+    max_workers = int(sys.argv[5]) if len(sys.argv) > 5 else 1
+    max_workers = max_workers or None
 
-logging_start(
-    filename=os.path.join(rsm_main_dir, "logFiles", "rsm-logging.log"), level=logging.INFO
-)
-logging.info("start logging rsm_input_aggregator")
+    logging_start(
+        filename=os.path.join(rsm_main_dir, "logFiles", "rsm-logging.log"), level=logging.INFO
+    )
+    logging.info("start logging rsm_input_aggregator")
 
-RSM_ABM_PROPERTIES = os.path.join(rsm_main_dir, "conf", "sandag_abm.properties")
-INPUT_RSM_ZONE_FILE = os.path.join(rsm_main_dir, get_property(RSM_ABM_PROPERTIES, "mgra.socec.file"))
-INPUT_MGRA_CROSSWALK = os.path.join(rsm_main_dir, get_property(RSM_ABM_PROPERTIES, "mgra.to.cluster.crosswalk.file"))
-OUTPUT_RSM_ZONE_FILE = os.path.join(rsm_main_dir, get_property(RSM_ABM_PROPERTIES, "mgra.socec.file"))
+    RSM_ABM_PROPERTIES = os.path.join(rsm_main_dir, "conf", "sandag_abm.properties")
+    rsm_properties = load_properties(RSM_ABM_PROPERTIES)
+    INPUT_RSM_ZONE_FILE = os.path.join(rsm_main_dir, rsm_properties.get("mgra.socec.file"))
+    INPUT_MGRA_CROSSWALK = os.path.join(rsm_main_dir, rsm_properties.get("mgra.to.cluster.crosswalk.file"))
+    OUTPUT_RSM_ZONE_FILE = os.path.join(rsm_main_dir, rsm_properties.get("mgra.socec.file"))
 
-# save a copy of the orig mgra landuse data
-shutil.copy(INPUT_RSM_ZONE_FILE, INPUT_RSM_ZONE_FILE.replace(".csv", "_orig.csv"))
+    # save a copy of the orig mgra landuse data
+    shutil.copy(INPUT_RSM_ZONE_FILE, INPUT_RSM_ZONE_FILE.replace(".csv", "_orig.csv"))
 
-#merge crosswalks with input mgra file
-mgra = pd.read_csv(INPUT_RSM_ZONE_FILE)
+    #merge crosswalks with input mgra file
+    mgra = pd.read_csv(INPUT_RSM_ZONE_FILE)
 
-# in the original model, these variables are computed in the 4Ds module
-mgra = add_intersection_count(rsm_main_dir, mgra)
-mgra = add_density_variables(org_model_dir, mgra)
+    # in the original model, these variables are computed in the 4Ds module
+    mgra = add_intersection_count(rsm_main_dir, mgra)
+    mgra = add_density_variables(org_model_dir, mgra)
 
-rsm_cwk = pd.read_csv(INPUT_MGRA_CROSSWALK)
-rsm_cwk_dict = dict(zip(rsm_cwk['MGRA'], rsm_cwk['cluster_id']))
-mgra['cluster_id'] = mgra['mgra'].map(rsm_cwk_dict)
+    rsm_cwk = pd.read_csv(INPUT_MGRA_CROSSWALK)
+    rsm_cwk_dict = dict(zip(rsm_cwk['MGRA'], rsm_cwk['cluster_id']))
+    mgra['cluster_id'] = mgra['mgra'].map(rsm_cwk_dict)
 
-mgra_agg  = merge_zone_data(mgra, cluster_id="cluster_id")
-mgra_agg  = mgra_agg.reset_index()
-mgra_agg  = mgra_agg.rename(columns = {"cluster_id" : "taz"})
-mgra_agg['mgra'] = range(1, len(mgra_agg )+1)
-mgra_agg.insert(0, 'mgra', mgra_agg.pop('mgra'))
-mgra_agg.insert(1, 'taz', mgra_agg.pop('taz'))
+    mgra_agg  = merge_zone_data(mgra, cluster_id="cluster_id")
+    mgra_agg  = mgra_agg.reset_index()
+    mgra_agg  = mgra_agg.rename(columns = {"cluster_id" : "taz"})
+    mgra_agg['mgra'] = range(1, len(mgra_agg )+1)
+    mgra_agg.insert(0, 'mgra', mgra_agg.pop('mgra'))
+    mgra_agg.insert(1, 'taz', mgra_agg.pop('taz'))
 
-#for school enrollments and high school enrollments - checks
-mgra_agg  = fix_zero_enrollment(mgra_agg)
-mgra_agg['taz'] = mgra_agg['taz'] + num_ext_zones
-mgra_agg.to_csv(OUTPUT_RSM_ZONE_FILE, index=False)
+    #for school enrollments and high school enrollments - checks
+    mgra_agg  = fix_zero_enrollment(mgra_agg)
+    mgra_agg['taz'] = mgra_agg['taz'] + num_ext_zones
+    mgra_agg.to_csv(OUTPUT_RSM_ZONE_FILE, index=False)
 
-# Input Aggregation
-agg_input_files(
-    model_dir = org_model_dir, 
-    rsm_dir = rsm_main_dir,
-    taz_cwk_file = "taz_crosswalk.csv",
-    mgra_cwk_file = "mgra_crosswalk.csv",
-    agg_zones = num_rsm_zones,
-    ext_zones = num_ext_zones,
-    input_files = ["microMgraEquivMinutes.csv", "microMgraTapEquivMinutes.csv", 
-    "walkMgraTapEquivMinutes.csv", "walkMgraEquivMinutes.csv", "bikeTazLogsum.csv",
-    "bikeMgraLogsum.csv", "zone.term", "zones.park", "tap.ptype", "accessam.csv",
-    "ParkLocationAlts.csv", "CrossBorderDestinationChoiceSoaAlternatives.csv", 
-    "TourDcSoaDistanceAlts.csv", "DestinationChoiceAlternatives.csv", "SoaTazDistAlts.csv",
-    "TripMatrices.csv", "transponderModelAccessibilities.csv", "crossBorderTours.csv", 
-    "internalExternalTrips.csv", "visitorTours.csv", "visitorTrips.csv", "householdAVTrips.csv", 
-    "crossBorderTrips.csv", "TNCTrips.csv", "airport_out.SAN.csv", "airport_out.CBX.csv", 
-    "TNCtrips.csv"] #, "households.csv"]
-)
+    # Input Aggregation
+    agg_input_files(
+        model_dir = org_model_dir, 
+        rsm_dir = rsm_main_dir,
+        taz_cwk_file = "taz_crosswalk.csv",
+        mgra_cwk_file = "mgra_crosswalk.csv",
+        agg_zones = num_rsm_zones,
+        ext_zones = num_ext_zones,
+        input_files = ["microMgraEquivMinutes.csv", "microMgraTapEquivMinutes.csv", 
+        "walkMgraTapEquivMinutes.csv", "walkMgraEquivMinutes.csv", "bikeTazLogsum.csv",
+        "bikeMgraLogsum.csv", "zone.term", "zones.park", "tap.ptype", "accessam.csv",
+        "ParkLocationAlts.csv", "CrossBorderDestinationChoiceSoaAlternatives.csv", 
+        "TourDcSoaDistanceAlts.csv", "DestinationChoiceAlternatives.csv", "SoaTazDistAlts.csv",
+        "TripMatrices.csv", "transponderModelAccessibilities.csv", "crossBorderTours.csv", 
+        "internalExternalTrips.csv", "visitorTours.csv", "visitorTrips.csv", "householdAVTrips.csv", 
+        "crossBorderTrips.csv", "TNCTrips.csv", "airport_out.SAN.csv", "airport_out.CBX.csv", 
+        "TNCtrips.csv"], #, "households.csv"]
+        max_workers = max_workers,
+    )
 
-logging.info("finished logging rsm_input_aggregator")
\ No newline at end of file
+    logging.info("finished logging rsm_input_aggregator")
@@ -9,6 +9,7 @@
 # outputs:
 #   sampled_households.csv
 #   sampled_persons.csv
+#   sampled_household_weights.csv
 #
 
 import logging
@@ -37,17 +38,19 @@ EXPILICT_AGG_TAZ = os.path.join(rsm_dir, "input", "study_area.csv")
 OUTPUT_RSM_DIR = os.path.join(rsm_dir, "output")
 OUTPUT_RSM_SAMPLED_HOUSHOLDS = os.path.join(rsm_dir, "input", "sampled_households.csv")
 OUTPUT_RSM_SAMPLED_PERSONS = os.path.join(rsm_dir, "input", "sampled_person.csv")
+OUTPUT_RSM_HOUSEHOLD_WEIGHTS = os.path.join(rsm_dir, "input", "sampled_household_weights.csv")
 
 logging_start(
     filename=os.path.join(rsm_dir, "logFiles", "rsm-logging.log"), level=logging.INFO
 )
 logging.info(f"start logging rsm_sampler for iteration {iteration}")
 
-run_rsm_sampling = int(get_property(ABM_PROPERTIES, "run.rsm.sampling"))
-sampling_rate = float(get_property(ABM_PROPERTIES, "rsm.default.sampling.rate"))
-min_sampling_rate = float(get_property(ABM_PROPERTIES, "rsm.min.sampling.rate"))
-baseline_run_dir = get_property(ABM_PROPERTIES, "rsm.baseline.run.dir")
-use_differential_sampling = int(get_property(ABM_PROPERTIES, "use.differential.sampling"))
+properties = load_properties(ABM_PROPERTIES)
+run_rsm_sampling = properties.get_int("run.rsm.sampling")
+sampling_rate = properties.get_float("rsm.default.sampling.rate")
+min_sampling_rate = properties.get_float("rsm.min.sampling.rate")
+baseline_run_dir = properties.get("rsm.baseline.run.dir")
+use_differential_sampling = properties.get_int("use.differential.sampling")
 
 if run_rsm_sampling == 1:
     CURR_ITER_ACCESS = os.path.join(
@@ -102,6 +105,8 @@ rsm_household_sampler(
     lower_bound_sampling_rate=min_sampling_rate,
     output_household=OUTPUT_RSM_SAMPLED_HOUSHOLDS,
     output_person=OUTPUT_RSM_SAMPLED_PERSONS,
+    person_chunksize=500_000,
+    output_household_weights=OUTPUT_RSM_HOUSEHOLD_WEIGHTS,
 )
 
 logging.info(f"finished logging rsm_sampler for iteration {iteration}")
\ No newline at end of file
@@ -11,16 +11,22 @@ properties_file = os.path.join(main_dir, "conf", "sandag_abm.properties")
 input_dir = os.path.join(main_dir, "input")
 output_dir = os.path.join(main_dir, "output")
 
-set_property(properties_file, 'acc.read.input.file', 'false')
-set_property(properties_file, 'PopulationSynthesizer.InputToCTRAMP.HouseholdFile', 'input/sampled_households.csv')
-set_property(properties_file, 'PopulationSynthesizer.InputToCTRAMP.PersonFile', 'input/sampled_person.csv')
+# updates are batched and written to the properties file once, at the end
+properties = load_properties(properties_file)
+properties.update({
+    'acc.read.input.file': 'false',
+    'PopulationSynthesizer.InputToCTRAMP.HouseholdFile': 'input/sampled_households.csv',
+    'PopulationSynthesizer.InputToCTRAMP.PersonFile': 'input/sampled_person.csv',
+})
 
 if iteration == 1: 
     # modifies the sandag_abm.properties file to run the shadow pricing in first iteration
-    set_property(properties_file, 'UsualWorkLocationChoice.ShadowPrice.Input.File', '')
-    set_property(properties_file, 'UsualSchoolLocationChoice.ShadowPrice.Input.File', '')
-    set_property(properties_file, 'uwsl.ShadowPricing.Work.MaximumIterations', 10)
-    set_property(properties_file, 'uwsl.ShadowPricing.School.MaximumIterations', 10)
+    properties.update({
+        'UsualWorkLocationChoice.ShadowPrice.Input.File': '',
+        'UsualSchoolLocationChoice.ShadowPrice.Input.File': '',
+        'uwsl.ShadowPricing.Work.MaximumIterations': 10,
+        'uwsl.ShadowPricing.School.MaximumIterations': 10,
+    })
     
     # delete shadow price files if present
     for file in os.scandir(input_dir):
@@ -43,7 +49,11 @@ else:
     )
 
     # modifies the sandag_abm.properties file to reflect the shadow pricing files
-    set_property(properties_file, 'UsualWorkLocationChoice.ShadowPrice.Input.File', 'input/' + work_file)
-    set_property(properties_file, 'UsualSchoolLocationChoice.ShadowPrice.Input.File', 'input/' + sch_file)
-    set_property(properties_file, 'uwsl.ShadowPricing.Work.MaximumIterations', 1)
-    set_property(properties_file, 'uwsl.ShadowPricing.School.MaximumIterations', 1)
\ No newline at end of file
+    properties.update({
+        'UsualWorkLocationChoice.ShadowPrice.Input.File': 'input/' + work_file,
+        'UsualSchoolLocationChoice.ShadowPrice.Input.File': 'input/' + sch_file,
+        'uwsl.ShadowPricing.Work.MaximumIterations': 1,
+        'uwsl.ShadowPricing.School.MaximumIterations': 1,
+    })
+
+properties.save()
@@ -7,15 +7,18 @@
 #   rsm_main_dir: RSM main directory
 #   org_model_dir: Donor model main directory
 #   agg_zone_mapping: TAZ to RSM zone crosswalk
+#   max_workers (optional): number of processes aggregating omx files, default 1, 0 for all cores
 #
 # Outputs:
 #   Aggregated OMX files based on new zone structure
 #
-# Please note that logging couldn't be included in the module because of the different python environments
+# Please note that rsm.logging is not used here because this script runs in the python 2 environment,
+# the standard library logging is configured instead
 #
 
 import os
 import sys
+import logging
 import openmatrix as omx
 main_path = os.path.dirname(os.path.realpath(__file__)) + "/../"
 sys.path.append(main_path)
@@ -25,78 +28,96 @@ from rsm.translate import (
 )
 
 
-rsm_main_dir = os.path.join(sys.argv[1])
-rsm_input_dir = os.path.join(sys.argv[1], "input")
-org_model_input_dir = os.path.join(sys.argv[2], "input")
-agg_zone_mapping = os.path.join(rsm_main_dir, sys.argv[3])
-
-rsm_output_dir = os.path.join(sys.argv[1], "output")
-org_model_output_dir = os.path.join(sys.argv[2], "output")
-
-periods = ["_EA", "_AM", "_MD", "_PM", "_EV"]
-vot_bins = ["_low", "_med", "_high"]
-file_ext = '.omx'
-
-mat_names = []
-for period in periods:
-    mat_names.append('trip'+period+file_ext)
-
-translate_omx_demand(
-    mat_names,
-    agg_zone_mapping,
-    org_model_input_dir,
-    rsm_input_dir
-)
-
-
-agg_mats = []
-
-for period in periods:
-    for vot in vot_bins: 
-        agg_mats.append('autoAirportTrips.CBX'+period+vot+file_ext)
-        agg_mats.append('autoAirportTrips.SAN'+period+vot+file_ext)
-        agg_mats.append('autoCrossBorderTrips'+period+vot+file_ext)
-        agg_mats.append('autoInternalExternalTrips'+period+vot+file_ext)
-        agg_mats.append('autoVisitorTrips'+period+vot+file_ext)
-
-
-for period in periods:
-    agg_mats.append('nmotAirportTrips.CBX'+period+file_ext)
-    agg_mats.append('nmotAirportTrips.SAN'+period+file_ext)
-    agg_mats.append('nmotCrossBorderTrips'+period+file_ext)
-    agg_mats.append('nmotInternalExternalTrips'+period+file_ext)
-    agg_mats.append('nmotVisitorTrips'+period+file_ext)
-
-    agg_mats.append('othrAirportTrips.CBX'+period+file_ext)
-    agg_mats.append('othrAirportTrips.SAN'+period+file_ext)
-    agg_mats.append('othrCrossBorderTrips'+period+file_ext)
-    agg_mats.append('othrInternalExternalTrips'+period+file_ext)
-    agg_mats.append('othrVisitorTrips'+period+file_ext)
-
-    agg_mats.append('TNCVehicleTrips'+period+file_ext)
-
-agg_mats.append('EmptyAVTrips'+file_ext)
-
-#Aggregating the trips based on new zone structure
-translate_omx_demand(
-    agg_mats,
-    agg_zone_mapping,
-    org_model_output_dir,
-    rsm_output_dir
-)
-
-#copying transit demand matrices 
-copy_mats = []
-for period in periods:
-    copy_mats.append('tranAirportTrips.SAN'+period+file_ext)
-    copy_mats.append('tranCrossBorderTrips'+period+file_ext)
-    copy_mats.append('tranInternalExternalTrips'+period+file_ext)
-    #copy_mats.append('tranTrips'+period+file_ext)
-    copy_mats.append('tranVisitorTrips'+period+file_ext)
-
-copy_transit_demand(
-    copy_mats,
-    org_model_output_dir,
-    rsm_output_dir
-)
-
+if __name__ == "__main__":
+    rsm_main_dir = os.path.join(sys.argv[1])
+    rsm_input_dir = os.path.join(sys.argv[1], "input")
+    org_model_input_dir = os.path.join(sys.argv[2], "input")
+    agg_zone_mapping = os.path.join(rsm_main_dir, sys.argv[3])
+    max_workers = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+    max_workers = max_workers or None
+
+    # cores unchanged since the last run against the same donor model are not re-aggregated
+    cache_manifest = "rsm_translate_manifest.json"
+
+    rsm_output_dir = os.path.join(sys.argv[1], "output")
+    org_model_output_dir = os.path.join(sys.argv[2], "output")
+
+    logging.basicConfig(
+        filename=os.path.join(rsm_main_dir, "logFiles", "rsm-logging.log"),
+        format="%(asctime)s %(levelname)s: %(message)s",
+        level=logging.INFO,
+    )
+    logging.info("start logging rsm_trip_matrix_aggregator")
+
+    periods = ["_EA", "_AM", "_MD", "_PM", "_EV"]
+    vot_bins = ["_low", "_med", "_high"]
+    file_ext = '.omx'
+
+    mat_names = []
+    for period in periods:
+        mat_names.append('trip'+period+file_ext)
+
+    translate_omx_demand(
+        mat_names,
+        agg_zone_mapping,
+        org_model_input_dir,
+        rsm_input_dir,
+        max_workers=max_workers,
+        cache_manifest=cache_manifest,
+    )
+
+
+    agg_mats = []
+
+    for period in periods:
+        for vot in vot_bins: 
+            agg_mats.append('autoAirportTrips.CBX'+period+vot+file_ext)
+            agg_mats.append('autoAirportTrips.SAN'+period+vot+file_ext)
+            agg_mats.append('autoCrossBorderTrips'+period+vot+file_ext)
+            agg_mats.append('autoInternalExternalTrips'+period+vot+file_ext)
+            agg_mats.append('autoVisitorTrips'+period+vot+file_ext)
+
+
+    for period in periods:
+        agg_mats.append('nmotAirportTrips.CBX'+period+file_ext)
+        agg_mats.append('nmotAirportTrips.SAN'+period+file_ext)
+        agg_mats.append('nmotCrossBorderTrips'+period+file_ext)
+        agg_mats.append('nmotInternalExternalTrips'+period+file_ext)
+        agg_mats.append('nmotVisitorTrips'+period+file_ext)
+
+        agg_mats.append('othrAirportTrips.CBX'+period+file_ext)
+        agg_mats.append('othrAirportTrips.SAN'+period+file_ext)
+        agg_mats.append('othrCrossBorderTrips'+period+file_ext)
+        agg_mats.append('othrInternalExternalTrips'+period+file_ext)
+        agg_mats.append('othrVisitorTrips'+period+file_ext)
+
+        agg_mats.append('TNCVehicleTrips'+period+file_ext)
+
+    agg_mats.append('EmptyAVTrips'+file_ext)
+
+    #Aggregating the trips based on new zone structure
+    translate_omx_demand(
+        agg_mats,
+        agg_zone_mapping,
+        org_model_output_dir,
+        rsm_output_dir,
+        max_workers=max_workers,
+        cache_manifest=cache_manifest,
+    )
+
+    #copying transit demand matrices 
+    copy_mats = []
+    for period in periods:
+        copy_mats.append('tranAirportTrips.SAN'+period+file_ext)
+        copy_mats.append('tranCrossBorderTrips'+period+file_ext)
+        copy_mats.append('tranInternalExternalTrips'+period+file_ext)
+        #copy_mats.append('tranTrips'+period+file_ext)
+        copy_mats.append('tranVisitorTrips'+period+file_ext)
+
+    copy_transit_demand(
+        copy_mats,
+        org_model_output_dir,
+        rsm_output_dir
+    )
+
+    logging.info("finished logging rsm_trip_matrix_aggregator")
@@ -41,7 +41,7 @@ NUM_EXT_ZONES = int(sys.argv[4])
 
 #input files
 FULL_ABM_PROPERTIES = os.path.join(full_model_dir, "conf", "sandag_abm.properties")
-FULL_ABM_MGRA_FILE = os.path.join(full_model_dir, get_property(FULL_ABM_PROPERTIES, "mgra.socec.file"))
+FULL_ABM_MGRA_FILE = os.path.join(full_model_dir, load_properties(FULL_ABM_PROPERTIES).get("mgra.socec.file"))
 FULL_ABM_MGRA_SHAPEFILE = os.path.join(rsm_main_dir, "input", "MGRASHAPE.zip")
 FULL_ABM_AM_HIGHWAY_SKIM = os.path.join(full_model_dir, "output", "traffic_skims_AM.omx")
 FULL_ABM_TRIP_DIR = os.path.join(full_model_dir, "output")
@@ -52,9 +52,10 @@ EXPILICT_AGG_TAZ = os.path.join(rsm_main_dir, "input", "study_area.csv")
 
 #output files
 RSM_ABM_PROPERTIES = os.path.join(rsm_main_dir, "conf", "sandag_abm.properties")
-OUTPUT_MGRA_CROSSWALK = os.path.join(rsm_main_dir, get_property(RSM_ABM_PROPERTIES, "mgra.to.cluster.crosswalk.file"))
-OUTPUT_TAZ_CROSSWALK = os.path.join(rsm_main_dir, get_property(RSM_ABM_PROPERTIES, "taz.to.cluster.crosswalk.file"))
-OUTPUT_CLUSTER_CENTROIDS = os.path.join(rsm_main_dir, get_property(RSM_ABM_PROPERTIES, "cluster.zone.centroid.file"))
+rsm_properties = load_properties(RSM_ABM_PROPERTIES)
+OUTPUT_MGRA_CROSSWALK = os.path.join(rsm_main_dir, rsm_properties.get("mgra.to.cluster.crosswalk.file"))
+OUTPUT_TAZ_CROSSWALK = os.path.join(rsm_main_dir, rsm_properties.get("taz.to.cluster.crosswalk.file"))
+OUTPUT_CLUSTER_CENTROIDS = os.path.join(rsm_main_dir, rsm_properties.get("cluster.zone.centroid.file"))
 
 logging_start(
     filename=os.path.join(rsm_main_dir, "logFiles", "rsm-logging.log"), level=logging.INFO
@@ -111,7 +112,7 @@ tazs, cluster_factors = attach_poi_taz_skims(
 )
 
 logging.info("aggregating zones")
-agglom3full = aggregate_zones(
+agglom3full, taz_labels = aggregate_zones(
     tazs,
     cluster_factors=cluster_factors,
     n_zones=NUM_RSM_ZONES,
@@ -119,11 +120,16 @@ agglom3full = aggregate_zones(
     use_xy=1e-4,
     explicit_agg=EXPLICIT_ZONE_AGG,
     explicit_col="taz",
+    return_labels=True,
 )
 
 logging.info("printing outputs")
-taz_crosswalk = make_crosswalk(agglom3full, tazs, old_index="taz").sort_values("taz")
-mgra_crosswalk = make_crosswalk(agglom3full, mgra, old_index="MGRA").sort_values("MGRA")
+taz_crosswalk = make_crosswalk(
+    agglom3full, tazs, old_index="taz", labels=taz_labels
+).sort_values("taz")
+mgra_crosswalk = make_crosswalk(
+    agglom3full, mgra, old_index="MGRA", labels=taz_labels, label_key="taz"
+).sort_values("MGRA")
 agglom3full = mark_centroids(agglom3full)
 
 cluster_centroids = agglom3full[["cluster_id", "centroid_x", "centroid_y"]]